@@ -0,0 +1,89 @@
+import os
+import re
+import time
+
+from cache import LRUCache, tensor_nbytes
+
+# Adapter names map to files in the adapter directory, nothing that could walk out of it
+ADAPTER_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+
+class UnknownAdapter(ValueError):
+    pass
+
+
+class AdapterManager:
+    """
+    Hot-swaps LoRA adapters on the shared Nunchaku transformer.
+
+    Adapter weights are read from `<directory>/<name>.safetensors` once and kept in host
+    memory, least recently used first out, under `max_bytes`. Only one adapter is applied
+    at a time. Switching replaces the transformer's LoRA weights in place, so the base
+    model is never reloaded, and jobs for the adapter that is already applied pay nothing.
+    Called from the scheduler thread only.
+    """
+
+    def __init__(self, directory, max_bytes, max_entries=16):
+        self.directory = directory
+        self.cache = LRUCache(max_entries, max_bytes, sizeof=lambda state_dict: tensor_nbytes(*state_dict.values()))
+        self.active = None  # (name, scale) applied to the transformer
+        self.swaps = 0
+
+    def path(self, name):
+        if not ADAPTER_NAME.match(name):
+            raise UnknownAdapter(f"Invalid adapter name '{name}'.")
+        path = os.path.join(self.directory, f"{name}.safetensors")
+        if not os.path.isfile(path):
+            raise UnknownAdapter(f"Adapter '{name}' was not found in {self.directory}.")
+        return path
+
+    def load(self, name):
+        """Returns (state_dict, resident) for the adapter, reading it from disk on a miss."""
+        state_dict = self.cache.get(name)
+        if state_dict is not None:
+            return state_dict, True
+
+        from safetensors.torch import load_file
+
+        state_dict = load_file(self.path(name))
+        self.cache.put(name, state_dict)
+        return state_dict, False
+
+    def activate(self, transformer, name, scale):
+        """Applies adapter `name` at `scale`, or removes any adapter for None. Returns the timing report."""
+        report = {"name": name, "scale": scale, "load_ms": 0.0, "swap_ms": 0.0, "resident": True, "swapped": False}
+        target = (name, scale) if name is not None else None
+        if target == self.active:
+            return report
+
+        if name is not None:
+            start = time.perf_counter()
+            state_dict, report["resident"] = self.load(name)
+            report["load_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+        start = time.perf_counter()
+        if name is None:
+            self._reset(transformer)
+        elif self.active is not None and self.active[0] == name:
+            # Same weights, only the strength changes
+            transformer.set_lora_strength(scale)
+        else:
+            transformer.update_lora_params(state_dict)
+            transformer.set_lora_strength(scale)
+        report["swap_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        report["swapped"] = True
+
+        self.active = target
+        self.swaps += 1
+        return report
+
+    @staticmethod
+    def _reset(transformer):
+        if hasattr(transformer, "reset_lora"):
+            transformer.reset_lora()
+        else:
+            # Older Nunchaku releases can only turn the LoRA branch off
+            transformer.set_lora_strength(0)
+
+    def stats(self):
+        return {**self.cache.stats(), "swaps": self.swaps, "active": self.active[0] if self.active else None}
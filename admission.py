@@ -0,0 +1,259 @@
+import json
+import os
+import resource
+import tempfile
+import threading
+from collections import deque
+
+import torch
+
+
+class AdmissionRejected(Exception):
+    """Raised for a job that could never fit in the memory budget, before any work is spent on it."""
+
+    def __init__(self, estimated_bytes, capacity_bytes):
+        super().__init__(
+            f"Job needs an estimated {estimated_bytes / 2**30:.2f} GiB but at most "
+            f"{capacity_bytes / 2**30:.2f} GiB of the memory budget is ever free."
+        )
+        self.estimated_bytes = estimated_bytes
+        self.capacity_bytes = capacity_bytes
+
+
+def _read_status_kib(field):
+    # /proc/self/status reports these in kB
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    # Resets the process' RSS high-water mark (VmHWM) on Linux, so host peaks are per batch too
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_memory_bytes(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    peak = _read_status_kib("VmHWM")
+    if peak is not None:
+        return peak
+    # Host RSS high-water mark of the whole process, reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def memory_in_use(device):
+    if device.type == "cuda":
+        return torch.cuda.memory_allocated(device)
+    current = _read_status_kib("VmRSS")
+    return current if current is not None else peak_memory_bytes(device)
+
+
+def memory_total(device):
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def memory_free(device):
+    """Memory that could be allocated right now, including what other processes leave."""
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        # Blocks cached by the allocator but not holding tensors are free to this process too
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemoryCostModel:
+    """
+    Predicts the memory a batch allocates above what was in use when it started.
+
+    A batch's cost is the pixels it works on: output plus conditioning pixels, summed over
+    its jobs. The peak it adds is fitted as `fixed + per_pixel * pixels` by least squares over
+    the last `window` measured batches. Every bucket is about a megapixel, so batch pixel
+    counts cluster and the slope is only fitted once their spread is at least `min_spread`
+    of their mean, e.g. from batches of different sizes; before that, and with a single
+    size, only a per-pixel ratio is calibrated. The slope never exceeds the highest bytes per
+    pixel a batch was measured at. With no measurements the `prior` (fixed, per_pixel) is
+    used. Estimates are padded by `margin` and by the largest underestimate the fit makes on
+    its own data, itself capped at `margin` of the largest measured peak.
+    """
+
+    def __init__(self, prior, margin=0.1, window=256, min_spread=0.25):
+        self.prior = prior
+        self.margin = margin
+        self.min_spread = min_spread
+        self.samples = deque(maxlen=window)  # (pixels, bytes)
+        self.fixed, self.per_pixel = prior
+        self.slack = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def observations(self):
+        return len(self.samples)
+
+    @property
+    def largest_observed(self):
+        """Pixels of the largest measured batch, 0 without measurements."""
+        with self._lock:
+            return max((x for x, _ in self.samples), default=0)
+
+    def estimate(self, pixels):
+        with self._lock:
+            return int((self.fixed + self.per_pixel * pixels) * (1 + self.margin) + self.slack)
+
+    def observe(self, pixels, peak_bytes):
+        with self._lock:
+            self.samples.append((pixels, max(0, peak_bytes)))
+            self._fit()
+
+    def _fit(self):
+        xs = [x for x, _ in self.samples]
+        ys = [y for _, y in self.samples]
+        mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+        spread = sum((x - mean_x) ** 2 for x in xs)
+        if mean_x and (spread / len(xs)) ** 0.5 >= self.min_spread * mean_x:
+            highest_ratio = max(y / x for x, y in self.samples if x)
+            slope = sum((x - mean_x) * (y - mean_y) for x, y in self.samples) / spread
+            per_pixel = min(max(0.0, slope), highest_ratio)
+            fixed = max(0.0, mean_y - per_pixel * mean_x)
+        else:
+            fixed, per_pixel = 0.0, mean_y / mean_x if mean_x else self.prior[1]
+        self.fixed, self.per_pixel = fixed, per_pixel
+        underestimate = max(y - (fixed + per_pixel * x) for x, y in self.samples)
+        self.slack = min(max(0.0, underestimate), self.margin * max(ys))
+
+    def to_dict(self):
+        with self._lock:
+            return {"samples": list(self.samples), "fixed": self.fixed, "per_pixel": self.per_pixel}
+
+    def load(self, state):
+        with self._lock:
+            self.samples.extend(tuple(sample) for sample in state.get("samples", []))
+            if self.samples:
+                self._fit()
+
+
+class AdmissionController:
+    """
+    Decides how many queued jobs may run as the next batch without going past `budget_bytes`.
+
+    Headroom is the budget minus the memory in use right now, further capped by what the
+    device (or host, for CPU runs) actually has free. That includes memory held by other
+    processes and, on CPU, by encoders still finishing earlier outputs, so jobs that do not
+    fit yet are delayed and looked at again as it is released. Only a job that would not fit
+    even with the worker idle is rejected, at submission if possible, once the cost model
+    has `min_samples` measurements and never when a batch at least as large has already
+    run. Until then such a job runs alone, which is how the model learns, and estimates
+    from the prior only limit batch sizes.
+    Measurements are written to `state_path`, when given, so calibration survives restarts.
+    """
+
+    def __init__(self, device, budget_bytes, prior, margin=0.1, min_samples=3, state_path=None):
+        self.device = device
+        self.budget = budget_bytes
+        self.min_samples = min_samples
+        self.state_path = state_path
+        self.model = MemoryCostModel(prior, margin=margin)
+        # Memory in use while no batch runs: weights and caches, as of the last batch's start
+        self.idle_bytes = None
+        self.stats = {"admitted": 0, "delayed": 0, "rejected": 0}
+
+        if state_path and os.path.isfile(state_path):
+            try:
+                with open(state_path) as f:
+                    self.model.load(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"Ignoring admission model state in {state_path}: {e}")
+
+    @property
+    def calibrated(self):
+        return self.model.observations >= self.min_samples
+
+    def capacity(self):
+        """Bytes a batch may add when nothing else is running."""
+        idle = self.idle_bytes if self.idle_bytes is not None else memory_in_use(self.device)
+        return self.budget - idle
+
+    def fits_when_idle(self, pixels):
+        """Whether a single job could run once nothing else holds memory."""
+        # A job no larger than a batch that already ran does fit, whatever the fit says
+        if not self.calibrated or pixels <= self.model.largest_observed:
+            return True
+        return self.model.estimate(pixels) <= self.capacity()
+
+    def check(self, pixels):
+        """Returns the estimate for a single job, raising AdmissionRejected if it can never run."""
+        estimated = self.model.estimate(pixels)
+        if not self.fits_when_idle(pixels):
+            self.stats["rejected"] += 1
+            raise AdmissionRejected(estimated, self.capacity())
+        return estimated
+
+    def admit(self, pixels_per_job, count):
+        """
+        How many of `count` jobs of `pixels_per_job` each fit right now. With 0 the jobs wait,
+        unless `fits_when_idle` says the first one never will.
+        """
+        headroom = self.budget - memory_in_use(self.device)
+        free = memory_free(self.device)
+        if free is not None:
+            headroom = min(headroom, free)
+
+        admitted = 0
+        while admitted < count and self.model.estimate(pixels_per_job * (admitted + 1)) <= headroom:
+            admitted += 1
+        if admitted == 0 and not self.calibrated:
+            # The estimate is not to be trusted yet, a single job is how the model learns
+            admitted = 1
+
+        if admitted:
+            self.stats["admitted"] += 1
+        else:
+            self.stats["delayed" if self.fits_when_idle(pixels_per_job) else "rejected"] += 1
+        return admitted
+
+    def record(self, pixels, start_bytes, added_bytes):
+        """Feeds a finished batch to the cost model: the memory in use when it started and what its peak added."""
+        self.idle_bytes = start_bytes
+        self.model.observe(pixels, added_bytes)
+        if self.state_path:
+            self._save()
+
+    def _save(self):
+        directory = os.path.dirname(self.state_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.model.to_dict(), f)
+        os.replace(tmp_path, self.state_path)
+
+    def report(self):
+        return {
+            **self.stats,
+            "budget_bytes": self.budget,
+            "idle_bytes": self.idle_bytes,
+            "calibrated": self.calibrated,
+            "observations": self.model.observations,
+            "fixed_bytes": int(self.model.fixed),
+            "bytes_per_pixel": round(self.model.per_pixel, 2),
+        }
@@ -0,0 +1,125 @@
+"""
+Checks the per-bucket compile cache on CPU with a small stand-in transformer and VAE decoder.
+
+Each run is a fresh process, as a new worker would be, pointed at the same cache directory.
+The first run compiles every bucket; later ones must load all of them from disk. The script
+prints per-bucket status and compile time and exits non-zero when a later run still compiles
+a graph or does not take less than `--max-warm-ratio` of the cold compile time:
+
+    python bench/bench_compile_cache.py
+    python bench/bench_compile_cache.py --buckets 1024x1024,1184x880 --runs 3 --cache-dir /tmp/compile-cache
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+def make_pipeline(dim):
+    import torch
+
+    class StandInTransformer(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.blocks = torch.nn.ModuleList(
+                torch.nn.Sequential(torch.nn.LayerNorm(dim), torch.nn.Linear(dim, dim * 2), torch.nn.GELU(),
+                                    torch.nn.Linear(dim * 2, dim))
+                for _ in range(4)
+            )
+
+        def forward(self, hidden_states):
+            for block in self.blocks:
+                hidden_states = hidden_states + block(hidden_states)
+            return hidden_states
+
+    decoder = torch.nn.Sequential(
+        torch.nn.Conv2d(dim, 32, 3, padding=1), torch.nn.SiLU(), torch.nn.Upsample(scale_factor=2),
+        torch.nn.Conv2d(32, 16, 3, padding=1), torch.nn.SiLU(), torch.nn.Upsample(scale_factor=2),
+        torch.nn.Conv2d(16, 3, 3, padding=1),
+    )
+    return SimpleNamespace(transformer=StandInTransformer().eval(), vae=SimpleNamespace(decoder=decoder.eval()))
+
+
+def run_worker(args):
+    """One worker's lifetime: compile setup, then the first call per bucket. Prints a JSON report."""
+    import torch
+
+    from compile_cache import CompileCache
+
+    start = time.perf_counter()
+    compile_cache = CompileCache(args.cache_dir)
+    pipeline = make_pipeline(args.dim)
+    compile_cache.compile_pipeline(pipeline)
+
+    buckets = {}
+    with torch.no_grad():
+        for bucket in args.buckets.split(","):
+            width, height = (int(side) for side in bucket.split("x"))
+            # Scaled down from the 16 pixel Flux patch grid to keep the stand-in cheap on CPU
+            rows, columns = height // 64, width // 64
+            tokens = torch.randn(1, rows * columns, args.dim)
+            hidden, report = compile_cache.run(("denoise", width, height, 1), lambda: pipeline.transformer(tokens))
+            latents = hidden.transpose(1, 2).reshape(1, args.dim, rows, columns)
+            _, decode_report = compile_cache.run(("vae_decode", width, height, 1),
+                                                 lambda: pipeline.vae.decoder(latents))
+            buckets[bucket] = {"denoise": report, "vae_decode": decode_report}
+
+    print(json.dumps({"total_ms": round((time.perf_counter() - start) * 1000, 1),
+                      "stats": compile_cache.stats(), "buckets": buckets}))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buckets", default="1024x1024,1184x880,880x1184")
+    parser.add_argument("--runs", type=int, default=2, help="Worker processes started one after another.")
+    parser.add_argument("--cache-dir", default=None, help="Defaults to a fresh temporary directory.")
+    parser.add_argument("--dim", type=int, default=64)
+    parser.add_argument("--max-warm-ratio", type=float, default=0.5,
+                        help="Allowed compile time of a warm run relative to the cold one.")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix="compile-cache-")
+    env = {key: value for key, value in os.environ.items() if key not in ("TORCHINDUCTOR_CACHE_DIR", "TRITON_CACHE_DIR")}
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--buckets", args.buckets,
+               "--cache-dir", cache_dir, "--dim", str(args.dim)]
+
+    runs = []
+    print(f"cache dir: {cache_dir}")
+    print(f"{'run':>4} {'total ms':>9} {'compile ms':>11} {'hit':>4} {'miss':>5} {'warm':>5}")
+    for index in range(args.runs):
+        output = subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        runs.append(result)
+        stats = result["stats"]
+        print(f"{index:4d} {result['total_ms']:9.1f} {stats['compile_ms']:11.1f} "
+              f"{stats['hit']:4d} {stats['miss']:5d} {stats['warm']:5d}")
+
+    failures = []
+    cold_ms = runs[0]["stats"]["compile_ms"]
+    for index, result in enumerate(runs[1:], start=1):
+        stats = result["stats"]
+        if stats["miss"]:
+            failures.append(f"run {index} compiled {stats['miss']} shapes again")
+        if cold_ms and stats["compile_ms"] > cold_ms * args.max_warm_ratio:
+            failures.append(f"run {index}: compile {stats['compile_ms']} ms > {args.max_warm_ratio} x {cold_ms} ms")
+
+    print(json.dumps(runs, indent=2))
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,143 @@
+"""
+Checks that URL inputs are revalidated against a local HTTP server, through `main.handler`.
+
+The server serves one image under a fixed URL with an ETag or Last-Modified validator and
+answers conditional requests with 304 while the image is unchanged. The same URL is sent
+three times with the model replaced by `StubPipeline`: a first download, a repeat that
+must be served from the caches after a 304, and a repeat after the image was replaced,
+which must be downloaded and hashed again rather than reuse the remembered input. The
+script prints what the server saw and exits non-zero when any of that does not hold:
+
+    python bench/bench_fetch_revalidate.py
+    python bench/bench_fetch_revalidate.py --validator last-modified
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+class ImageServer:
+    """Serves one PNG at /input.png, its validator changing with every `replace`."""
+
+    def __init__(self, validator):
+        self.validator = validator
+        self.version = 0
+        self.body = b""
+        self.log = []  # (conditional, status)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                etag = f'"v{server.version}"'
+                last_modified = formatdate(1_700_000_000 + server.version * 60, usegmt=True)
+                if server.validator == "etag":
+                    conditional = self.headers.get("If-None-Match")
+                    current = conditional == etag
+                else:
+                    conditional = self.headers.get("If-Modified-Since")
+                    current = conditional == last_modified
+                status = 304 if current else 200
+                server.log.append((conditional is not None, status))
+
+                self.send_response(status)
+                if server.validator == "etag":
+                    self.send_header("ETag", etag)
+                else:
+                    self.send_header("Last-Modified", last_modified)
+                if status == 200:
+                    self.send_header("Content-Type", "image/png")
+                    self.send_header("Content-Length", str(len(server.body)))
+                self.end_headers()
+                if status == 200:
+                    self.wfile.write(server.body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, name="image-server", daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/input.png"
+
+    def replace(self, image):
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        self.body = buffer.getvalue()
+        self.version += 1
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+def make_image(seed):
+    from PIL import Image
+
+    rng = random.Random(seed)
+    return Image.frombytes("RGB", (512, 384), rng.randbytes(512 * 384 * 3))
+
+
+async def run_checks(main, server):
+    def event(index):
+        return {"id": f"revalidate-{index}", "input": {"image": server.url, "prompt": "a", "seed": 1, "ratio": "1:1"}}
+
+    results = []
+    server.replace(make_image(0))
+    results.append(await main.handler(event(0)))
+    results.append(await main.handler(event(1)))
+    server.replace(make_image(1))
+    results.append(await main.handler(event(2)))
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--validator", choices=("etag", "last-modified"), default="etag")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="fetch-revalidate-")
+    os.environ.update(
+        FETCH_CACHE_DIR=os.path.join(scratch, "fetch"), RESULT_CACHE_DIR=os.path.join(scratch, "results"),
+        MAX_BATCH_WAIT_MS="0",
+    )
+    import main
+    from bench_handler import install_stub
+
+    install_stub(main, argparse.Namespace(steps=2, step_delay_ms=0))
+    server = ImageServer(args.validator)
+    try:
+        results = asyncio.run(run_checks(main, server))
+    finally:
+        server.close()
+
+    failures = [f"request {index}: {result['error']}" for index, result in enumerate(results) if "error" in result]
+    if not failures:
+        # The repeat is answered from the result cache, which is keyed by the input's pixel hash
+        result_hits = [result["metrics"]["result_cache"]["hit"] for result in results]
+        expected_log = [(False, 200), (True, 304), (True, 200)]
+        if server.log != expected_log:
+            failures.append(f"server saw {server.log}, expected {expected_log}")
+        if result_hits != [False, True, False]:
+            failures.append(f"result cache hits were {result_hits}, expected [False, True, False]")
+        if main.fetcher.stats["not_modified"] != 1:
+            failures.append(f"fetcher served {main.fetcher.stats['not_modified']} not-modified responses, expected 1")
+
+    print(json.dumps({"validator": args.validator, "server_log": server.log, "fetcher": main.fetcher.stats,
+                      "result_cache": [result.get("metrics", {}).get("result_cache") for result in results]}, indent=2))
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
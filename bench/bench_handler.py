@@ -0,0 +1,230 @@
+"""
+Offline benchmark of the CPU-side work in `main.handler`.
+
+The model is replaced by `StubPipeline`, so validation, input decode and resize,
+preview rendering, output encoding and base64 are measured without a GPU. Each case of
+the input size x input format x ratio matrix reports per-stage latency percentiles,
+throughput and peak RSS, written as JSON so runs can be compared between commits. The
+script exits non-zero when admission control turns any job away:
+
+    python bench/bench_handler.py --output before.json
+    python bench/bench_handler.py --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+INPUT_SIZES = [(512, 512), (1024, 768), (2048, 1536), (4032, 3024)]
+INPUT_FORMATS = ["jpeg", "png", "webp"]
+RATIOS = ["original", "1:1", "16:9"]
+
+STAGES = [
+    "fetch_ms", "decode_ms", "resize_ms", "hash_ms", "queue_wait_ms", "text_encode_ms", "vae_encode_ms",
+    "denoise_ms", "preview_ms", "vae_decode_ms", "output_encode_ms", "base64_ms",
+]
+
+
+def percentiles(values):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+
+    def rank(p):
+        return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+    return {
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "mean": round(sum(values) / len(values), 2),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def make_input(size, input_format, rng):
+    """A noisy gradient, so encoders and decoders do realistic amounts of work."""
+    from PIL import Image
+
+    width, height = size
+    image = Image.linear_gradient("L").resize(size).convert("RGB")
+    noise = Image.frombytes("RGB", size, rng.randbytes(width * height * 3))
+    image = Image.blend(image, noise, 0.3)
+
+    buffer = BytesIO()
+    image.save(buffer, format=input_format.upper())
+    return f"data:image/{input_format};base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
+
+
+def install_stub(main, args):
+    from stub_pipeline import StubPipeline
+
+    pipeline = StubPipeline(num_inference_steps=args.steps, step_delay=args.step_delay_ms / 1000)
+    # Jobs run their quality preset's step count, so every preset runs --steps
+    for preset in main.QUALITY_PRESETS.values():
+        preset["steps"] = args.steps
+    main.load_model = lambda timings=None: pipeline
+    main.model = pipeline
+    main.ready.set()
+
+    preview_stats = {"count": 0, "bytes": 0}
+
+    def progress_update(job, progress):
+        preview_stats["count"] += 1
+        preview_stats["bytes"] += len(progress.get("image") or "")
+
+    main.runpod.serverless.progress_update = progress_update
+    return pipeline, preview_stats
+
+
+async def run_case(main, pipeline, preview_stats, inputs, ratio, args):
+    latencies = []
+    stage_values = {name: [] for name in STAGES}
+    output_bytes = []
+    errors = 0
+    rejected = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_one(index, image_source):
+        nonlocal errors, rejected
+        event = {"id": f"bench-{index}", "input": {
+            "image": image_source,
+            "prompt": "make it a watercolor painting",
+            "ratio": ratio,
+            "output_format": args.output_format,
+        }}
+        async with semaphore:
+            start = time.perf_counter()
+            result = await main.handler(event)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        if "error" in result:
+            errors += 1
+            # Turned away for memory, at submission or while queued
+            cancelled = result.get("cancelled") or {}
+            if result.get("error_type") == "AdmissionRejected" or cancelled.get("reason") == "memory_budget":
+                rejected += 1
+            return
+        output_bytes.append(result["metrics"]["output_bytes"])
+        timings = result["metrics"]["timings"]
+        for name in STAGES:
+            stage_values[name].append(timings.get(name))
+
+    previews_before = dict(preview_stats)
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one(index, image_source) for index, image_source in enumerate(inputs)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "jobs": len(inputs),
+        "errors": errors,
+        "rejected": rejected,
+        "latency_ms": percentiles(latencies),
+        "stages_ms": {name: percentiles(values) for name, values in stage_values.items()},
+        "throughput_jobs_s": round(len(inputs) / elapsed, 3),
+        "preview_bytes_per_job": round((preview_stats["bytes"] - previews_before["bytes"]) / len(inputs)),
+        "peak_rss_mb": peak_rss_mb(),
+        "output_bytes": percentiles(output_bytes),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    baseline_cases = {case["case"]: case for case in baseline["cases"]}
+    print(f"{'case':<40} {'p50 ms':>10} {'base':>10} {'delta':>8}")
+    for case in report["cases"]:
+        before = baseline_cases.get(case["case"])
+        if before is None or not case["latency_ms"] or not before["latency_ms"]:
+            continue
+        now, then = case["latency_ms"]["p50"], before["latency_ms"]["p50"]
+        delta = (now - then) / then * 100 if then else 0
+        print(f"{case['case']:<40} {now:>10.1f} {then:>10.1f} {delta:>+7.1f}%")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=5, help="Measured jobs per case.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Jobs in flight at once.")
+    parser.add_argument("--steps", type=int, default=28, help="Denoising steps run by the stub.")
+    parser.add_argument("--step-delay-ms", type=float, default=0, help="Simulated transformer time per step.")
+    parser.add_argument("--batch-wait-ms", type=int, default=0, help="Scheduler MAX_BATCH_WAIT_MS.")
+    parser.add_argument("--output-format", default="png", help="Output format requested from the handler.")
+    parser.add_argument("--sizes", default=None, help="Comma separated WxH input sizes.")
+    parser.add_argument("--formats", default=None, help="Comma separated input formats.")
+    parser.add_argument("--ratios", default=None, help="Comma separated ratios.")
+    parser.add_argument("--output", default="bench_output.json", help="Where to write the JSON report.")
+    parser.add_argument("--compare", default=None, help="Earlier report to compare median latency against.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Keep caches out of the way: every input is unique and on-disk caches live in a scratch directory
+    scratch = tempfile.mkdtemp(prefix="flux-kontext-bench-")
+    os.environ["MAX_BATCH_WAIT_MS"] = str(args.batch_wait_ms)
+    os.environ["RESULT_CACHE_DIR"] = os.path.join(scratch, "results")
+    os.environ["FETCH_CACHE_DIR"] = os.path.join(scratch, "inputs")
+
+    import main
+
+    pipeline, preview_stats = install_stub(main, args)
+
+    sizes = [tuple(map(int, size.split("x"))) for size in args.sizes.split(",")] if args.sizes else INPUT_SIZES
+    formats = args.formats.split(",") if args.formats else INPUT_FORMATS
+    ratios = args.ratios.split(",") if args.ratios else RATIOS
+    rng = random.Random(args.seed)
+
+    cases = []
+    for size, input_format, ratio in itertools.product(sizes, formats, ratios):
+        name = f"{size[0]}x{size[1]}/{input_format}/{ratio}"
+        # One extra job per case warms up allocator and codec state and is not recorded
+        inputs = [make_input(size, input_format, rng) for _ in range(args.iterations + 1)]
+        asyncio.run(run_case(main, pipeline, preview_stats, inputs[:1], ratio, args))
+        result = asyncio.run(run_case(main, pipeline, preview_stats, inputs[1:], ratio, args))
+        result["case"] = name
+        cases.append(result)
+        print(f"{name:<40} p50 {result['latency_ms']['p50']:8.1f} ms  {result['throughput_jobs_s']:6.2f} jobs/s")
+
+    report = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "cases": cases,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+    # The matrix mixes buckets and input sizes, every job fits the stub's memory, so none may be turned away
+    rejected = {case["case"]: case["rejected"] for case in cases if case["rejected"]}
+    if rejected:
+        print(f"FAILED: admission control rejected jobs: {rejected}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,289 @@
+"""
+Replays recorded jobs against the worker and sweeps concurrency.
+
+A trace is JSONL with one job per line, `{"input": {...}, "arrival_s": 12.5}`, the input being
+what the endpoint received. "timestamp" (epoch seconds) may stand in for "arrival_s"; lines
+without either follow the previous job immediately. Jobs arrive open-loop, at the trace's
+own timing (optionally sped up) or as Poisson arrivals at `--rate` jobs/s. At most
+`--concurrency` jobs are in flight; later arrivals wait on the client side.
+
+Targets are the handler in-process with `StubPipeline`, one fresh process per concurrency
+level, or RunPod's local test server (`python main.py --rp_serve_api`, or
+`--serve-stub` below for a CPU one). Each level reports client and worker queue wait,
+end-to-end latency percentiles, throughput and error rate, written as JSON so runs can be
+compared between commits:
+
+    python bench/bench_replay.py --synthetic 40 --rate 4 --concurrency 1,2,4,8 --output before.json
+    python bench/bench_replay.py --trace jobs.jsonl --arrivals trace --time-scale 2 --compare before.json
+    python bench/bench_replay.py --serve-stub --port 8000 &
+    python bench/bench_replay.py --synthetic 40 --target http://localhost:8000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from bench_handler import git_commit, install_stub, make_input, percentiles
+
+SYNTHETIC_SIZES = [(512, 512), (1024, 768), (768, 1024), (1600, 1200)]
+SYNTHETIC_RATIOS = ["original", "1:1", "16:9", "3:4"]
+SYNTHETIC_PROMPTS = ["make it a watercolor painting", "turn day into night", "add snow", "remove the background"]
+
+
+def load_trace(path):
+    """Returns [{"input", "offset_s"}] with offsets from the first arrival."""
+    jobs = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if not isinstance(record.get("input"), dict):
+                raise ValueError(f"{path}:{line_number}: every line needs an 'input' object.")
+            jobs.append({"input": record["input"], "arrival": record.get("arrival_s", record.get("timestamp"))})
+
+    first = next((job["arrival"] for job in jobs if job["arrival"] is not None), 0)
+    previous = 0.0
+    for job in jobs:
+        previous = job.pop("arrival") - first if job["arrival"] is not None else previous
+        job["offset_s"] = previous
+    return jobs
+
+
+def synthesize_trace(path, count, rate, seed):
+    """Writes `count` jobs over a mix of input sizes and ratios, arriving as a Poisson process."""
+    rng = random.Random(seed)
+    offset = 0.0
+    with open(path, "w") as f:
+        for index in range(count):
+            job_input = {
+                "image": make_input(rng.choice(SYNTHETIC_SIZES), "jpeg", rng),
+                "prompt": rng.choice(SYNTHETIC_PROMPTS),
+                "ratio": rng.choice(SYNTHETIC_RATIOS),
+                "output_format": "jpeg",
+            }
+            f.write(json.dumps({"input": job_input, "arrival_s": round(offset, 4)}) + "\n")
+            offset += rng.expovariate(rate)
+
+
+def arrival_offsets(jobs, args):
+    if args.arrivals == "poisson":
+        rng = random.Random(args.seed)
+        offsets, offset = [], 0.0
+        for _ in jobs:
+            offsets.append(offset)
+            offset += rng.expovariate(args.rate)
+        return offsets
+    return [job["offset_s"] / args.time_scale for job in jobs]
+
+
+class InProcessTarget:
+    def __init__(self, args):
+        # On-disk caches start empty for every level
+        scratch = tempfile.mkdtemp(prefix="flux-kontext-replay-")
+        os.environ["MAX_BATCH_WAIT_MS"] = str(args.batch_wait_ms)
+        os.environ["RESULT_CACHE_DIR"] = os.path.join(scratch, "results")
+        os.environ["FETCH_CACHE_DIR"] = os.path.join(scratch, "inputs")
+
+        import main
+
+        install_stub(main, args)
+        self.main = main
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def send(self, index, job_input):
+        return await self.main.handler({"id": f"replay-{index}", "input": dict(job_input)})
+
+
+class HttpTarget:
+    """RunPod's local test server; `/runsync` wraps the handler's return value in `output`."""
+
+    def __init__(self, base_url, timeout):
+        self.url = base_url.rstrip("/") + "/runsync"
+        self.timeout = timeout
+
+    async def __aenter__(self):
+        import aiohttp
+
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def send(self, index, job_input):
+        async with self.session.post(self.url, json={"input": job_input}) as response:
+            if response.status != 200:
+                return {"error": f"HTTP {response.status}: {(await response.text())[:200]}"}
+            body = await response.json()
+        if body.get("status") != "COMPLETED":
+            return {"error": body.get("error") or f"Job status {body.get('status')}"}
+        return body["output"]
+
+
+async def run_level(target, jobs, offsets, concurrency):
+    latencies, client_waits, worker_waits, errors = [], [], [], []
+    semaphore = asyncio.Semaphore(concurrency)
+    finished_at = []
+    start = time.perf_counter()
+
+    async def run_one(index, job, offset):
+        await asyncio.sleep(max(0.0, start + offset - time.perf_counter()))
+        arrived = time.perf_counter()
+        async with semaphore:
+            dispatched = time.perf_counter()
+            try:
+                result = await target.send(index, job["input"])
+            except Exception as e:
+                result = {"error": f"{type(e).__name__}: {e}"}
+            done = time.perf_counter()
+
+        finished_at.append(done)
+        if "error" in result:
+            errors.append(str(result["error"]))
+            return
+        latencies.append((done - arrived) * 1000)
+        client_waits.append((dispatched - arrived) * 1000)
+        worker_waits.append(result.get("metrics", {}).get("timings", {}).get("queue_wait_ms"))
+
+    await asyncio.gather(*(run_one(index, job, offset) for index, (job, offset) in enumerate(zip(jobs, offsets))))
+    elapsed = max(finished_at) - start
+
+    return {
+        "concurrency": concurrency,
+        "jobs": len(jobs),
+        "errors": len(errors),
+        "error_rate": round(len(errors) / len(jobs), 4),
+        # A few distinct messages are enough to tell what went wrong
+        "error_samples": sorted(set(errors))[:3],
+        "offered_jobs_s": round(len(jobs) / offsets[-1], 3) if offsets[-1] else None,
+        "throughput_jobs_s": round(len(latencies) / elapsed, 3),
+        "latency_ms": percentiles(latencies),
+        "client_queue_ms": percentiles(client_waits),
+        "worker_queue_wait_ms": percentiles(worker_waits),
+    }
+
+
+async def replay(args, jobs, concurrency):
+    offsets = arrival_offsets(jobs, args)
+    target = HttpTarget(args.target, args.timeout) if args.target != "inprocess" else InProcessTarget(args)
+    async with target:
+        return await run_level(target, jobs, offsets, concurrency)
+
+
+def run_level_in_subprocess(args, trace_path, concurrency):
+    """In-process levels get a fresh interpreter so caches, the scheduler and RSS start cold."""
+    command = [sys.executable, os.path.abspath(__file__), "--trace", trace_path, "--level", str(concurrency),
+               "--arrivals", args.arrivals, "--rate", str(args.rate), "--time-scale", str(args.time_scale),
+               "--steps", str(args.steps), "--step-delay-ms", str(args.step_delay_ms),
+               "--batch-wait-ms", str(args.batch_wait_ms), "--seed", str(args.seed)]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def serve_stub(args):
+    """Runs RunPod's local test server around the handler with the stub pipeline."""
+    import runpod
+
+    os.environ["MAX_BATCH_WAIT_MS"] = str(args.batch_wait_ms)
+    import main
+
+    install_stub(main, args)
+    sys.argv = [sys.argv[0], "--rp_serve_api", "--rp_api_host", "127.0.0.1", "--rp_api_port", str(args.port)]
+    runpod.serverless.start({"handler": main.handler, "concurrency_modifier": main.concurrency_modifier})
+
+
+def compare(report, baseline):
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    print(f"{'concurrency':>11} {'p50 ms':>9} {'base':>9} {'p95 ms':>9} {'base':>9} {'jobs/s':>8} {'base':>8}")
+    for level in report["levels"]:
+        before = baseline_levels.get(level["concurrency"])
+        if before is None or not level["latency_ms"] or not before["latency_ms"]:
+            continue
+        print(f"{level['concurrency']:>11} {level['latency_ms']['p50']:9.1f} {before['latency_ms']['p50']:9.1f} "
+              f"{level['latency_ms']['p95']:9.1f} {before['latency_ms']['p95']:9.1f} "
+              f"{level['throughput_jobs_s']:8.2f} {before['throughput_jobs_s']:8.2f}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trace", default=None, help="JSONL job trace to replay.")
+    parser.add_argument("--synthetic", type=int, default=0, help="Replay this many generated jobs instead.")
+    parser.add_argument("--save-trace", default=None, help="Where to keep the generated trace.")
+    parser.add_argument("--target", default="inprocess", help="'inprocess' or the local test server's base URL.")
+    parser.add_argument("--arrivals", choices=("trace", "poisson"), default="trace")
+    parser.add_argument("--rate", type=float, default=2.0, help="Poisson arrivals per second.")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Trace timing speed-up, 2 replays twice as fast.")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="Comma separated in-flight limits to sweep.")
+    parser.add_argument("--timeout", type=float, default=600, help="Per request, HTTP target only.")
+    parser.add_argument("--steps", type=int, default=8, help="Denoising steps run by the stub.")
+    parser.add_argument("--step-delay-ms", type=float, default=20, help="Simulated transformer time per step.")
+    parser.add_argument("--batch-wait-ms", type=int, default=50, help="Scheduler MAX_BATCH_WAIT_MS.")
+    parser.add_argument("--output", default="replay_output.json", help="Where to write the JSON report.")
+    parser.add_argument("--compare", default=None, help="Earlier report to compare against.")
+    parser.add_argument("--serve-stub", action="store_true", help="Serve the stub handler over HTTP instead.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--level", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_stub:
+        serve_stub(args)
+        return
+
+    if args.level is not None:
+        print(json.dumps(asyncio.run(replay(args, load_trace(args.trace), args.level))))
+        return
+
+    trace_path = args.trace
+    if trace_path is None:
+        if not args.synthetic:
+            parser.error("Pass --trace or --synthetic.")
+        trace_path = args.save_trace or os.path.join(tempfile.mkdtemp(prefix="flux-kontext-replay-"), "trace.jsonl")
+        synthesize_trace(trace_path, args.synthetic, args.rate, args.seed)
+    jobs = load_trace(trace_path)
+
+    levels = []
+    print(f"{'concurrency':>11} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queue p50':>10} {'jobs/s':>8} {'errors':>7}")
+    for concurrency in (int(level) for level in args.concurrency.split(",")):
+        if args.target == "inprocess":
+            level = run_level_in_subprocess(args, trace_path, concurrency)
+        else:
+            level = asyncio.run(replay(args, jobs, concurrency))
+        levels.append(level)
+        latency = level["latency_ms"] or {"p50": 0, "p95": 0, "p99": 0}
+        queue = level["client_queue_ms"] or {"p50": 0}
+        print(f"{concurrency:>11} {latency['p50']:9.1f} {latency['p95']:9.1f} {latency['p99']:9.1f} "
+              f"{queue['p50']:10.1f} {level['throughput_jobs_s']:8.2f} {level['error_rate']:7.1%}")
+
+    report = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {**vars(args), "trace": trace_path},
+        "levels": levels,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main_cli()
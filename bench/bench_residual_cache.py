@@ -0,0 +1,146 @@
+"""
+Checks the transformer residual cache on a small CPU stand-in for the Flux transformer.
+
+The same seeded flow-matching loop runs once without the cache and once per threshold.
+Each run reports wall time, steps served from the cache, blocks skipped, and output drift:
+the relative L2 distance of the final latents from the uncached run. The script exits
+non-zero when a threshold misses `--min-speedup` or goes past `--max-drift`:
+
+    python bench/bench_residual_cache.py
+    python bench/bench_residual_cache.py --thresholds 0.05,0.1 --min-speedup 1.2 --max-drift 0.02
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import torch
+
+from residual_cache import enable_residual_cache
+
+
+class StandInBlock(torch.nn.Module):
+    """Pre-norm residual MLP over both streams, with the diffusers Flux block calling convention."""
+
+    def __init__(self, dim):
+        super().__init__()
+        self.norm = torch.nn.LayerNorm(dim)
+        self.mlp = torch.nn.Sequential(torch.nn.Linear(dim, dim * 4), torch.nn.GELU(), torch.nn.Linear(dim * 4, dim))
+        self.context_mlp = torch.nn.Linear(dim, dim)
+
+    def forward(self, hidden_states, encoder_hidden_states, temb, image_rotary_emb=None, joint_attention_kwargs=None):
+        context = self.context_mlp(encoder_hidden_states.mean(dim=1, keepdim=True))
+        hidden_states = hidden_states + 0.1 * self.mlp(self.norm(hidden_states) + temb[:, None] + context)
+        encoder_hidden_states = encoder_hidden_states + 0.1 * self.context_mlp(encoder_hidden_states)
+        return encoder_hidden_states, hidden_states
+
+
+class StandInTransformer(torch.nn.Module):
+    """Loops over `transformer_blocks` then `single_transformer_blocks` the way FluxTransformer2DModel does."""
+
+    def __init__(self, dim=256, num_layers=4, num_single_layers=8):
+        super().__init__()
+        self.register_buffer("frequencies", torch.linspace(1, 6, dim // 2))
+        self.time_embed = torch.nn.Linear(dim, dim)
+        self.transformer_blocks = torch.nn.ModuleList(StandInBlock(dim) for _ in range(num_layers))
+        self.single_transformer_blocks = torch.nn.ModuleList(StandInBlock(dim) for _ in range(num_single_layers))
+        self.proj_out = torch.nn.Linear(dim, dim)
+
+    def forward(self, hidden_states, encoder_hidden_states, timestep):
+        # Sinusoidal features make the blocks' residuals change from step to step, as in the real model
+        angles = timestep.view(-1, 1) * self.frequencies
+        temb = self.time_embed(torch.cat([angles.sin(), angles.cos()], dim=-1))
+        for block in self.transformer_blocks:
+            encoder_hidden_states, hidden_states = block(
+                hidden_states=hidden_states, encoder_hidden_states=encoder_hidden_states, temb=temb,
+                image_rotary_emb=None, joint_attention_kwargs=None,
+            )
+        for block in self.single_transformer_blocks:
+            encoder_hidden_states, hidden_states = block(
+                hidden_states=hidden_states, encoder_hidden_states=encoder_hidden_states, temb=temb,
+                image_rotary_emb=None, joint_attention_kwargs=None,
+            )
+        return self.proj_out(hidden_states)
+
+
+def denoise(transformer, latents, context, steps):
+    """Euler steps of a flow-matching schedule from t=1 to t=0."""
+    timesteps = torch.linspace(1, 0, steps + 1)
+    with torch.no_grad():
+        for t, t_next in zip(timesteps[:-1], timesteps[1:]):
+            velocity = transformer(latents, context, t.expand(latents.shape[0]))
+            latents = latents + (t_next - t) * velocity
+    return latents
+
+
+def make_run(args, threshold):
+    torch.manual_seed(args.seed)
+    transformer = StandInTransformer(args.dim, args.layers, args.single_layers).eval()
+    cache = enable_residual_cache(transformer) if threshold is not None else None
+    if cache is not None:
+        cache.reset(threshold)
+
+    generator = torch.Generator().manual_seed(args.seed + 1)
+    latents = torch.randn((args.batch, args.tokens, args.dim), generator=generator)
+    context = torch.randn((args.batch, 64, args.dim), generator=generator)
+
+    best = None
+    output = None
+    for _ in range(args.repeats):
+        if cache is not None:
+            cache.reset()
+        start = time.perf_counter()
+        output = denoise(transformer, latents, context, args.steps)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return output, best * 1000, cache.stats if cache is not None else None
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--thresholds", default="0.05,0.08,0.15", help="Comma separated cache thresholds.")
+    parser.add_argument("--steps", type=int, default=28)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--tokens", type=int, default=1024)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--single-layers", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per configuration, the fastest is kept.")
+    parser.add_argument("--min-speedup", type=float, default=1.3, help="Required for the largest threshold.")
+    parser.add_argument("--max-drift", type=float, default=0.05, help="Allowed for every threshold.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    thresholds = [float(threshold) for threshold in args.thresholds.split(",")]
+    baseline, baseline_ms, _ = make_run(args, None)
+    print(f"{'threshold':>10} {'ms':>9} {'speedup':>8} {'cached':>7} {'skipped':>8} {'drift':>7}")
+    print(f"{'off':>10} {baseline_ms:9.1f} {1:8.2f} {0:7d} {0:8d} {0:7.4f}")
+
+    results = []
+    for threshold in thresholds:
+        output, ms, stats = make_run(args, threshold)
+        drift = ((output - baseline).norm() / baseline.norm()).item()
+        speedup = baseline_ms / ms
+        results.append({"threshold": threshold, "ms": round(ms, 1), "speedup": round(speedup, 3),
+                        "drift": round(drift, 5), **stats})
+        print(f"{threshold:10.3f} {ms:9.1f} {speedup:8.2f} {stats['steps_cached']:7d} "
+              f"{stats['blocks_skipped']:8d} {drift:7.4f}")
+
+    failures = [f"threshold {r['threshold']}: drift {r['drift']} > {args.max_drift}"
+                for r in results if r["drift"] > args.max_drift]
+    if results and results[-1]["speedup"] < args.min_speedup:
+        failures.append(f"threshold {results[-1]['threshold']}: speedup {results[-1]['speedup']} < {args.min_speedup}")
+
+    print(json.dumps({"baseline_ms": round(baseline_ms, 1), "results": results}, indent=2))
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
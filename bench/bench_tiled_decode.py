@@ -0,0 +1,124 @@
+"""
+Measures peak memory of the final decode against output size, on CPU with a small VAE stand-in.
+
+Two paths are compared for every output size. "full" is the pipeline's decode: the whole latent
+at once, the upscale on the full float image, then PNG encoding. "tiled" is `TiledDecoder`
+streaming rows into the PNG writer. Each measurement runs in a fresh process and reports the
+growth of its peak RSS over the process after setup. The script exits non-zero when the tiled
+peak at the largest size is above `--max-ratio` of the full decode's:
+
+    python bench/bench_tiled_decode.py
+    python bench/bench_tiled_decode.py --sizes 1024,2048,4096 --scale 4 --max-ratio 0.3
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+LATENT_CHANNELS = 16
+VAE_SCALE_FACTOR = 8
+
+
+def make_decoder():
+    """Three 2x upsampling stages like AutoencoderKL's decoder, narrower so it runs on CPU."""
+    import torch
+
+    torch.manual_seed(0)
+    layers = [torch.nn.Conv2d(LATENT_CHANNELS, 32, 3, padding=1)]
+    for channels_in, channels_out in ((32, 32), (32, 16), (16, 8)):
+        layers += [torch.nn.Upsample(scale_factor=2), torch.nn.Conv2d(channels_in, channels_out, 3, padding=1),
+                   torch.nn.SiLU()]
+    layers.append(torch.nn.Conv2d(8, 3, 3, padding=1))
+    return torch.nn.Sequential(*layers).eval()
+
+
+def peak_rss_bytes():
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_measurement(args):
+    """Decodes and encodes one output in this process and prints a JSON report."""
+    import torch
+    import torch.nn.functional as F
+    from PIL import Image
+
+    from encoders import encode_image, make_row_writer
+    from tiled_decode import TiledDecoder
+
+    decoder = make_decoder()
+    side = args.size // (VAE_SCALE_FACTOR * args.scale)
+    latents = torch.randn(1, LATENT_CHANNELS, side, side, generator=torch.Generator().manual_seed(1))
+    with torch.no_grad():
+        # Kernels and allocator pools are set up before the baseline is taken
+        decoder(latents[:, :, :8, :8])
+    baseline = peak_rss_bytes()
+
+    start = time.perf_counter()
+    if args.mode == "full":
+        with torch.no_grad():
+            pixels = decoder(latents)
+            if args.scale > 1:
+                pixels = F.interpolate(pixels, scale_factor=args.scale, mode="bicubic", align_corners=False)
+        pixels = (pixels / 2 + 0.5).clamp(0, 1).mul(255).round().to(torch.uint8)[0].permute(1, 2, 0).numpy()
+        buffer = encode_image(Image.fromarray(pixels), "png", compress_level=args.compress_level)
+    else:
+        tiled = TiledDecoder(decoder, vae_scale_factor=VAE_SCALE_FACTOR, tile_size=args.tile,
+                             overlap=args.tile // 4, upscale=args.scale)
+        writer = make_row_writer("png", *tiled.output_size(latents), compress_level=args.compress_level)
+        buffer = tiled.decode_into(latents, writer).buffer
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        "mode": args.mode, "size": args.size, "ms": round(elapsed * 1000, 1),
+        "peak_growth_bytes": peak_rss_bytes() - baseline, "output_bytes": buffer.getbuffer().nbytes,
+    }))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="512,1024,2048,3072", help="Comma separated output sides in pixels.")
+    parser.add_argument("--scale", type=int, default=2, help="output_scale, the latents are size / (8 * scale).")
+    parser.add_argument("--tile", type=int, default=32, help="Latent tile side.")
+    parser.add_argument("--compress-level", type=int, default=1)
+    parser.add_argument("--max-ratio", type=float, default=0.5,
+                        help="Allowed tiled peak relative to the full decode at the largest size.")
+    parser.add_argument("--mode", choices=("full", "tiled"), help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_measurement(args)
+        return
+
+    results = []
+    print(f"{'size':>6} {'mode':>6} {'ms':>9} {'peak MB':>9} {'output KB':>10}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        for mode in ("full", "tiled"):
+            command = [sys.executable, os.path.abspath(__file__), "--mode", mode, "--size", str(size),
+                       "--scale", str(args.scale), "--tile", str(args.tile),
+                       "--compress-level", str(args.compress_level)]
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{size:6d} {mode:>6} {result['ms']:9.1f} {result['peak_growth_bytes'] / 2**20:9.1f} "
+                  f"{result['output_bytes'] / 1024:10.0f}")
+
+    largest = {result["mode"]: result for result in results if result["size"] == results[-1]["size"]}
+    ratio = largest["tiled"]["peak_growth_bytes"] / max(largest["full"]["peak_growth_bytes"], 1)
+    print(json.dumps({"scale": args.scale, "tile": args.tile, "largest_ratio": round(ratio, 3),
+                      "results": results}, indent=2))
+    if ratio > args.max_ratio:
+        print(f"FAILED: tiled peak is {ratio:.2f} of the full decode's at {results[-1]['size']} px, "
+              f"more than {args.max_ratio}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,267 @@
+"""
+Checks the Gradio app's RunPod transport against a local mock of the RunPod API.
+
+A small aiohttp server stands in for `/run`, `/status` and `/stream`. Every mock job sits in
+the queue, makes progress, stalls for a while without changes and then completes. N jobs are
+watched concurrently through one `RunPodTransport`, once polling `/status` and once
+long-polling `/stream`, where the mock behaves like a worker started with STREAM_PROGRESS:
+the result is the last streamed chunk and `/status` returns the aggregated stream. The script
+checks that:
+
+- every job ends COMPLETED with its output,
+- updates only arrive on a change, with progress never going backwards,
+- the server never sees more than the rate limit (plus `--rate-slack`) in any one-second window,
+- a lone stalled job is polled at most half as often as it would be without backoff,
+- a lone queued job, whose `/stream` answers at once and empty, is asked just as rarely.
+
+It prints the request counts and exits non-zero when any check fails:
+
+    python bench/bench_transport.py
+    python bench/bench_transport.py --jobs 50 --rate 5
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The Gradio app's modules import each other by their bare names
+sys.path.insert(0, os.path.join(REPO_ROOT, "gradio_app"))
+
+from aiohttp import web
+
+from transport import RunPodTransport
+
+ENDPOINT_ID = "mock-endpoint"
+
+
+class MockJob:
+    """A job whose status follows the clock: queued, progressing, stalled, progressing again, done."""
+
+    def __init__(self, job_id, queued, step, steps, stall, aggregate=False):
+        self.aggregate = aggregate
+        self.id = job_id
+        self.start = time.monotonic()
+        # (seconds since submission, status, progress)
+        self.timeline = [(0.0, "IN_QUEUE", None)]
+        at = queued
+        for index in range(steps):
+            if index == steps // 2:
+                at += stall
+            self.timeline.append((at, "IN_PROGRESS", round((index + 1) / (steps + 1), 3)))
+            at += step
+        self.timeline.append((at, "COMPLETED", None))
+
+    def state(self):
+        elapsed = time.monotonic() - self.start
+        current = [entry for entry in self.timeline if entry[0] <= elapsed][-1]
+        return current[1], current[2]
+
+    def progress_output(self, progress):
+        # The preview only changes every other step, repeats must not be delivered again
+        index = [entry[2] for entry in self.timeline].index(progress)
+        return {"progress": progress, "image": f"preview-{index // 2}"}
+
+    def result(self):
+        return {"image": f"result-{self.id}"}
+
+    def status_body(self):
+        status, progress = self.state()
+        body = {"id": self.id, "status": status}
+        if status == "COMPLETED":
+            if self.aggregate:
+                # return_aggregate_stream: everything the handler yielded, the result last
+                body["output"] = [self.progress_output(entry[2]) for entry in self.timeline if entry[2] is not None]
+                body["output"].append(self.result())
+            else:
+                body["output"] = self.result()
+        elif progress is not None:
+            body["output"] = self.progress_output(progress)
+        return body
+
+
+class MockRunPod:
+    def __init__(self, args):
+        self.args = args
+        self.aggregate = False
+        self.jobs = {}
+        self.requests = []  # (monotonic time, route, job id)
+        self.streamed = {}  # job id -> progress values already sent on /stream
+        self._ids = itertools.count()
+
+        self.app = web.Application()
+        self.app.router.add_post(f"/v2/{ENDPOINT_ID}/run", self.run)
+        self.app.router.add_get(f"/v2/{ENDPOINT_ID}/status/{{job_id}}", self.status)
+        self.app.router.add_get(f"/v2/{ENDPOINT_ID}/stream/{{job_id}}", self.stream)
+
+    def add_job(self, stall=None, queued=None):
+        job_id = f"job-{next(self._ids)}"
+        self.jobs[job_id] = MockJob(job_id, self.args.queued if queued is None else queued, self.args.step,
+                                    self.args.steps, self.args.stall if stall is None else stall, self.aggregate)
+        return job_id
+
+    async def run(self, request):
+        self.requests.append((time.monotonic(), "run", None))
+        return web.json_response({"id": self.add_job(), "status": "IN_QUEUE"})
+
+    async def status(self, request):
+        job_id = request.match_info["job_id"]
+        self.requests.append((time.monotonic(), "status", job_id))
+        return web.json_response(self.jobs[job_id].status_body())
+
+    async def stream(self, request):
+        job_id = request.match_info["job_id"]
+        self.requests.append((time.monotonic(), "stream", job_id))
+        job = self.jobs[job_id]
+        sent = self.streamed.setdefault(job_id, [])
+        # Long poll: answer as soon as there is something new, or after a while with nothing.
+        # A queued job has no stream yet, that is answered at once.
+        deadline = time.monotonic() + self.args.stream_wait
+        while True:
+            status, progress = job.state()
+            fresh = progress is not None and progress not in sent
+            if fresh or status in ("IN_QUEUE", "COMPLETED") or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(0.02)
+        chunks = []
+        if fresh:
+            sent.append(progress)
+            chunks.append({"output": job.progress_output(progress)})
+        if status == "COMPLETED":
+            chunks.append({"output": job.result()})
+        return web.json_response({"status": status, "stream": chunks})
+
+
+def max_per_window(times, window=1.0):
+    times = sorted(times)
+    best, start = 0, 0
+    for end, moment in enumerate(times):
+        while moment - times[start] >= window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+def check_updates(job_id, updates):
+    """Problems with one job's update sequence."""
+    problems = []
+    if not updates or updates[-1].status != "COMPLETED" or not updates[-1].output:
+        problems.append(f"{job_id} did not end COMPLETED with an output")
+    progress = [update.progress for update in updates if update.progress is not None]
+    if progress != sorted(progress) or len(progress) != len(set(progress)):
+        problems.append(f"{job_id} progress went backwards or repeated: {progress}")
+    previews = [update.preview for update in updates if update.preview is not None]
+    if any(first == second for first, second in zip(previews, previews[1:])):
+        problems.append(f"{job_id} got the same preview twice in a row")
+    return problems
+
+
+async def watch_jobs(transport, job_ids):
+    async def collect(job_id):
+        return [update async for update in transport.watch(job_id)]
+
+    return dict(zip(job_ids, await asyncio.gather(*(collect(job_id) for job_id in job_ids))))
+
+
+async def run_checks(args):
+    mock = MockRunPod(args)
+    runner = web.AppRunner(mock.app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/v2"
+
+    report, failures = {}, []
+    try:
+        for mode in ("status", "stream"):
+            transport = RunPodTransport("mock-key", ENDPOINT_ID, base_url=base_url,
+                                        max_requests_per_second=args.rate, use_stream=mode == "stream")
+            mock.aggregate = mode == "stream"
+            mock.requests.clear()
+            start = time.monotonic()
+            job_ids = await asyncio.gather(*(transport.submit({"prompt": str(index)}) for index in range(args.jobs)))
+            results = await watch_jobs(transport, job_ids)
+            await transport.close()
+
+            for job_id, updates in results.items():
+                failures += [f"{mode}: {problem}" for problem in check_updates(job_id, updates)]
+            peak = max_per_window([moment for moment, _, _ in mock.requests])
+            if peak > args.rate + args.rate_slack:
+                failures.append(f"{mode}: {peak} requests in one second, the limit is {args.rate}")
+            report[mode] = {
+                "requests": len(mock.requests),
+                "peak_per_second": peak,
+                "seconds": round(time.monotonic() - start, 2),
+                "updates": sum(len(updates) for updates in results.values()),
+            }
+
+        # A lone job, so only the backoff and not the rate limit spaces out its polls
+        transport = RunPodTransport("mock-key", ENDPOINT_ID, base_url=base_url, max_requests_per_second=1000)
+        mock.aggregate = False
+        mock.requests.clear()
+        job_id = mock.add_job(stall=args.backoff_stall)
+        job = mock.jobs[job_id]
+        await watch_jobs(transport, [job_id])
+        await transport.close()
+
+        # The stall sits between the middle progress step and the next one
+        stall_start = job.start + job.timeline[args.steps // 2][0] + args.step
+        stall_end = stall_start + args.backoff_stall
+        polls = sum(1 for moment, route, _ in mock.requests if route == "status" and stall_start <= moment < stall_end)
+        without_backoff = args.backoff_stall / args.min_interval
+        if polls > without_backoff / 2:
+            failures.append(f"backoff: {polls} polls during a {args.backoff_stall} s stall, "
+                            f"{without_backoff:.0f} without backoff")
+        report["backoff"] = {"stall_seconds": args.backoff_stall, "polls": polls,
+                             "polls_without_backoff": round(without_backoff)}
+
+        # The same for a job that sits in the queue, watched through /stream
+        transport = RunPodTransport("mock-key", ENDPOINT_ID, base_url=base_url, max_requests_per_second=1000,
+                                    use_stream=True)
+        mock.aggregate = True
+        mock.requests.clear()
+        job_id = mock.add_job(queued=args.backoff_stall)
+        job = mock.jobs[job_id]
+        await watch_jobs(transport, [job_id])
+        await transport.close()
+
+        queue_end = job.start + args.backoff_stall
+        polls = sum(1 for moment, route, _ in mock.requests if route == "stream" and moment < queue_end)
+        if polls > without_backoff / 2:
+            failures.append(f"queued backoff: {polls} /stream requests during {args.backoff_stall} s in the queue, "
+                            f"{without_backoff:.0f} without backoff")
+        report["queued_backoff"] = {"queued_seconds": args.backoff_stall, "polls": polls,
+                                    "polls_without_backoff": round(without_backoff)}
+    finally:
+        await runner.cleanup()
+    return report, failures
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=20, help="Jobs watched concurrently.")
+    parser.add_argument("--rate", type=float, default=10, help="The transport's max_requests_per_second.")
+    parser.add_argument("--rate-slack", type=int, default=1,
+                        help="Requests per second allowed above --rate, for scheduling jitter.")
+    parser.add_argument("--queued", type=float, default=1.0, help="Seconds a mock job stays IN_QUEUE.")
+    parser.add_argument("--steps", type=int, default=6, help="Progress updates per mock job.")
+    parser.add_argument("--step", type=float, default=0.5, help="Seconds between progress updates.")
+    parser.add_argument("--stall", type=float, default=3.0, help="Seconds without change half way through a job.")
+    parser.add_argument("--backoff-stall", type=float, default=8.0, help="Stall of the lone job in the backoff check.")
+    parser.add_argument("--stream-wait", type=float, default=1.0, help="How long the mock /stream long-polls.")
+    # RunPodTransport.watch's default
+    parser.add_argument("--min-interval", type=float, default=0.2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    report, failures = asyncio.run(run_checks(args))
+    print(json.dumps({"jobs": args.jobs, "rate": args.rate, **report}, indent=2))
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,144 @@
+import time
+import zlib
+from types import SimpleNamespace
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from utils import LATENT_RGB_FACTORS
+
+
+class StubVAE:
+    """Decodes by projecting latents to RGB and upsampling, standing in for AutoencoderKL."""
+
+    dtype = torch.float32
+    config = SimpleNamespace(scaling_factor=1.0, shift_factor=0.0)
+
+    def __init__(self, scale_factor=8):
+        self.scale_factor = scale_factor
+        self.factors = torch.tensor(LATENT_RGB_FACTORS, dtype=self.dtype)
+
+    def decode(self, latents, return_dict=True):
+        rgb = torch.einsum("blhw,lr -> brhw", latents, self.factors.to(latents.dtype))
+        height, width = rgb.shape[-2:]
+        rgb = F.interpolate(rgb, size=(height * self.scale_factor, width * self.scale_factor), mode="bilinear")
+        return (rgb,) if not return_dict else SimpleNamespace(sample=rgb)
+
+
+def postprocess(images, output_type="pil"):
+    images = (((images + 1) / 2).clamp(0, 1) * 255).to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+    height, width = images.shape[1:3]
+    return [Image.frombytes("RGB", (width, height), row.numpy().tobytes()) for row in images]
+
+
+class StubPipeline:
+    """
+    Deterministic CPU stand-in for FluxKontextPipeline.
+
+    It exposes the attributes and methods `main.run_batch` relies on and runs a fake
+    denoising loop that emits random packed latents through `callback_on_step_end`,
+    so everything around the GPU work can be measured without a GPU. `step_delay`
+    simulates transformer time per step.
+    """
+
+    vae_scale_factor = 8
+    latent_channels = 16
+
+    def __init__(self, num_inference_steps=28, step_delay=0.0, embed_dim=64, text_tokens=16):
+        self.num_inference_steps = num_inference_steps
+        self.step_delay = step_delay
+        self.embed_dim = embed_dim
+        self.text_tokens = text_tokens
+
+        self._execution_device = torch.device("cpu")
+        self.vae = StubVAE(self.vae_scale_factor)
+        self.scheduler = SimpleNamespace(timesteps=torch.linspace(1, 0, num_inference_steps))
+        self.image_processor = SimpleNamespace(preprocess=self._preprocess, postprocess=postprocess)
+
+        self.calls = 0
+        self.callback_seconds = 0.0
+        self.pipeline_seconds = 0.0
+
+    def encode_prompt(self, prompt, prompt_2=None, device=None, **kwargs):
+        prompts = [prompt] if isinstance(prompt, str) else prompt
+        embeds = []
+        for text in prompts:
+            generator = torch.Generator().manual_seed(zlib.crc32(text.encode("utf-8")))
+            embeds.append(torch.randn((1, self.text_tokens, self.embed_dim), generator=generator))
+        prompt_embeds = torch.cat(embeds)
+        pooled_prompt_embeds = prompt_embeds.mean(dim=1)
+        text_ids = torch.zeros(self.text_tokens, 3)
+        return prompt_embeds, pooled_prompt_embeds, text_ids
+
+    def _preprocess(self, images, height, width):
+        tensors = []
+        for image in images:
+            if image.size != (width, height):
+                image = image.resize((width, height), Image.Resampling.LANCZOS)
+            pixels = torch.frombuffer(bytearray(image.convert("RGB").tobytes()), dtype=torch.uint8)
+            tensors.append(pixels.view(height, width, 3).permute(2, 0, 1).float() / 127.5 - 1)
+        return torch.stack(tensors)
+
+    def _encode_vae_image(self, image, generator=None):
+        latents = F.avg_pool2d(image, self.vae_scale_factor)
+        repeats = -(-self.latent_channels // latents.shape[1])
+        return latents.repeat(1, repeats, 1, 1)[:, :self.latent_channels]
+
+    @staticmethod
+    def _pack_latents(latents, batch_size, num_channels_latents, height, width):
+        latents = latents.view(batch_size, num_channels_latents, height // 2, 2, width // 2, 2)
+        latents = latents.permute(0, 2, 4, 1, 3, 5)
+        return latents.reshape(batch_size, (height // 2) * (width // 2), num_channels_latents * 4)
+
+    @staticmethod
+    def _unpack_latents(latents, height, width, vae_scale_factor):
+        batch_size, num_patches, channels = latents.shape
+        height = 2 * (int(height) // (vae_scale_factor * 2))
+        width = 2 * (int(width) // (vae_scale_factor * 2))
+        latents = latents.view(batch_size, height // 2, width // 2, channels // 4, 2, 2)
+        latents = latents.permute(0, 3, 1, 4, 2, 5)
+        return latents.reshape(batch_size, channels // (2 * 2), height, width)
+
+    def __call__(self, image=None, prompt=None, prompt_embeds=None, pooled_prompt_embeds=None,
+                 width=1024, height=1024, num_inference_steps=None, generator=None,
+                 callback_on_step_end=None, callback_on_step_end_tensor_inputs=None, output_type="pil", **kwargs):
+        start = time.perf_counter()
+        self.calls += 1
+
+        if prompt_embeds is not None:
+            batch_size = prompt_embeds.shape[0]
+        else:
+            batch_size = len(prompt) if isinstance(prompt, list) else 1
+
+        steps = num_inference_steps or self.num_inference_steps
+        self.scheduler.timesteps = torch.linspace(1, 0, steps)
+
+        generators = generator if isinstance(generator, list) else [generator] * batch_size
+        latent_height = 2 * (height // (self.vae_scale_factor * 2))
+        latent_width = 2 * (width // (self.vae_scale_factor * 2))
+        latents = torch.cat([
+            torch.randn((1, self.latent_channels, latent_height, latent_width), generator=g) for g in generators
+        ])
+        latents = self._pack_latents(latents, batch_size, self.latent_channels, latent_height, latent_width)
+
+        for step, timestep in enumerate(self.scheduler.timesteps):
+            if self.step_delay:
+                time.sleep(self.step_delay)
+            latents = latents * (1 - 1 / steps)
+
+            if callback_on_step_end is not None:
+                callback_start = time.perf_counter()
+                callback_outputs = callback_on_step_end(self, step, timestep, {"latents": latents})
+                self.callback_seconds += time.perf_counter() - callback_start
+                latents = callback_outputs.get("latents", latents)
+
+        if output_type == "latent":
+            self.pipeline_seconds += time.perf_counter() - start
+            return SimpleNamespace(images=latents)
+
+        unpacked = self._unpack_latents(latents, height, width, self.vae_scale_factor)
+        images = self.image_processor.postprocess(self.vae.decode(unpacked, return_dict=False)[0])
+
+        self.pipeline_seconds += time.perf_counter() - start
+        return SimpleNamespace(images=images)
@@ -0,0 +1,340 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def tensor_nbytes(*tensors):
+    return sum(tensor.element_size() * tensor.numel() for tensor in tensors)
+
+
+class LRUCache:
+    """
+    Thread-safe LRU map bounded by entry count and by total size in bytes.
+
+    `sizeof(value)` is used to account for each entry. An entry larger than the whole
+    byte budget is not stored at all. `on_evict(key, value)`, if given, is called for
+    entries pushed out by the budget.
+    """
+
+    def __init__(self, max_entries, max_bytes, sizeof, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        nbytes = self.sizeof(value)
+        if nbytes > self.max_bytes or self.max_entries <= 0:
+            return
+
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                evicted_key, (evicted_value, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+                evicted.append((evicted_key, evicted_value))
+
+        # Called outside the lock, eviction hooks may do slow I/O
+        if self.on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+        }
+
+
+class DiskCache:
+    """
+    Directory of opaque blobs with LRU eviction by total size.
+
+    Recency is tracked through file mtimes, so the cache survives restarts and can be
+    shared by workers mounting the same volume.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        # Write to a temporary file first so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        self._prune()
+
+    def _prune(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def normalize_prompt(prompt):
+    """Collapses whitespace so trivially different spellings of a prompt share an entry."""
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+class PromptEmbeddingCache:
+    """Caches the CLIP pooled and T5 sequence embeddings produced by `pipeline.encode_prompt`."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.cache = LRUCache(max_entries, max_bytes, sizeof=lambda value: tensor_nbytes(*value))
+
+    def encode(self, pipeline, prompts):
+        """
+        Returns batched (prompt_embeds, pooled_prompt_embeds) for `prompts` plus a per-prompt hit list.
+        All cache misses are encoded together in a single text-encoder pass.
+        """
+        normalized = [normalize_prompt(prompt) for prompt in prompts]
+        found = {}
+        hits = []
+        for prompt in normalized:
+            if prompt not in found:
+                found[prompt] = self.cache.get(prompt)
+            hits.append(found[prompt] is not None)
+
+        missing = [prompt for prompt, value in found.items() if value is None]
+        if missing:
+            with torch.no_grad():
+                prompt_embeds, pooled_prompt_embeds, _ = pipeline.encode_prompt(
+                    prompt=missing, prompt_2=None, device=pipeline._execution_device
+                )
+            for index, prompt in enumerate(missing):
+                value = (prompt_embeds[index:index + 1], pooled_prompt_embeds[index:index + 1])
+                found[prompt] = value
+                self.cache.put(prompt, value)
+
+        prompt_embeds = torch.cat([found[prompt][0] for prompt in normalized])
+        pooled_prompt_embeds = torch.cat([found[prompt][1] for prompt in normalized])
+        return prompt_embeds, pooled_prompt_embeds, hits
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def hash_image_pixels(image):
+    """Content hash of decoded pixels, independent of how the image was encoded or delivered."""
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size}".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def hash_image_source(image_source):
+    return hashlib.sha256(image_source.encode("utf-8")).hexdigest()
+
+
+# An input can be sent as "sha256:" followed by the hash of an input string the worker has seen before
+SOURCE_REF_PREFIX = "sha256:"
+
+
+def is_source_ref(image_source):
+    return image_source.startswith(SOURCE_REF_PREFIX)
+
+
+class SourceNotCached(LookupError):
+    """A `sha256:` input reference this worker cannot resolve, the client has to send the image itself."""
+
+
+class ConditioningImageCache:
+    """
+    Caches VAE-encoded conditioning images keyed by pixel hash and resolution bucket.
+
+    A second, much smaller map remembers which pixel hash a given input string (URL or
+    base64 payload) decoded to, so a repeated input can skip the download and decode
+    as well as the VAE encode, or not be sent at all but referenced by its hash. Latents evicted from memory are spilled to `spill_dir`
+    when one is configured.
+    """
+
+    def __init__(self, max_entries, max_bytes, spill_dir=None, spill_max_bytes=0):
+        self.disk = DiskCache(spill_dir, spill_max_bytes) if spill_dir else None
+        self.latents = LRUCache(max_entries, max_bytes, sizeof=tensor_nbytes, on_evict=self._spill)
+        self.sources = LRUCache(max_entries * 4, float("inf"), sizeof=lambda value: 0)
+
+    def _spill(self, key, latents):
+        if self.disk is None:
+            return
+        buffer = io.BytesIO()
+        torch.save(latents.cpu(), buffer)
+        self.disk.put(key, buffer.getvalue())
+
+    def lookup_source(self, image_source):
+        """Returns (pixel_hash, image_size) for an input, or a reference to one, seen before, otherwise None."""
+        if is_source_ref(image_source):
+            return self.sources.get(image_source[len(SOURCE_REF_PREFIX):])
+        return self.sources.get(hash_image_source(image_source))
+
+    def remember_source(self, image_source, pixel_hash, image_size):
+        self.sources.put(hash_image_source(image_source), (pixel_hash, image_size))
+
+    def get_latents(self, pixel_hash, bucket, device=None):
+        key = (pixel_hash, bucket)
+        latents = self.latents.get(key)
+        if latents is not None or self.disk is None:
+            return latents
+
+        data = self.disk.get(key)
+        if data is None:
+            return None
+        latents = torch.load(io.BytesIO(data), map_location=device or "cpu")
+        self.latents.put(key, latents)
+        return latents
+
+    def put_latents(self, pixel_hash, bucket, latents):
+        self.latents.put((pixel_hash, bucket), latents)
+
+    def stats(self):
+        stats = {"latents": self.latents.stats(), "sources": self.sources.stats()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
+
+
+class ResultCache:
+    """Disk-backed LRU of finished job results, keyed by everything that determines the output."""
+
+    def __init__(self, directory, max_bytes):
+        self.disk = DiskCache(directory, max_bytes)
+
+    @staticmethod
+    def make_key(**fields):
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        data = self.disk.get(key)
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def put(self, key, result):
+        self.disk.put(key, json.dumps(result).encode("utf-8"))
+
+    def stats(self):
+        return self.disk.stats()
+
+
+class RequestCoalescer:
+    """
+    Lets concurrent identical requests share one in-flight computation.
+
+    Must be used from a single event loop. The first caller for a key runs `compute`,
+    later callers with the same key await its outcome instead. Failures of a type in
+    `private_errors`, and cancellation, belong to the first caller's request alone, e.g. its
+    deadline; waiters then run the computation again rather than sharing that outcome.
+    """
+
+    def __init__(self, private_errors=()):
+        self.private_errors = (asyncio.CancelledError, *private_errors)
+        self._inflight = {}
+
+    async def run(self, key, compute):
+        """Returns (result, coalesced)."""
+        while True:
+            future = self._inflight.get(key)
+            if future is None:
+                break
+            result, error = await asyncio.shield(future)
+            if error is None:
+                return result, True
+            if not isinstance(error, self.private_errors):
+                raise error
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await compute()
+        except BaseException as e:
+            # Waiters get (result, error) pairs, so cancellation reaches them as a value they can inspect
+            future.set_result((None, e))
+            raise
+        else:
+            future.set_result((result, None))
+            return result, False
+        finally:
+            del self._inflight[key]
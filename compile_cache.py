@@ -0,0 +1,113 @@
+import os
+import tempfile
+import time
+
+import torch
+
+# Written next to inductor's own caches, restores everything they hold in one read
+ARTIFACTS_FILE = "artifacts.bin"
+
+
+class CompileCache:
+    """
+    Compiles the transformer and the VAE decoder with torch.compile and keeps the results on disk.
+
+    Outputs only come in the fixed resolution buckets, so each module gets one static graph per
+    shape it sees instead of a dynamic one. Inductor's caches are pointed at `cache_dir`: a worker
+    that starts with a populated directory (a volume, or one baked into the image) loads compiled
+    graphs instead of compiling them. `run` wraps the first call for every shape and records whether
+    it compiled ("miss"), loaded from disk ("hit"), or found the graph already in memory ("warm").
+    Called from the scheduler thread, and from startup before it runs.
+    """
+
+    def __init__(self, cache_dir, mode="default", max_graphs=64):
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.reports = {}  # shape key -> report of its first call
+        self.counts = {"hit": 0, "miss": 0, "warm": 0}
+        self.compile_ms = 0.0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        # Read by inductor and triton when they first need them, which is after this
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_dir, "inductor"))
+        os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(cache_dir, "triton"))
+
+        import torch._dynamo
+        import torch._inductor.config
+
+        torch._inductor.config.fx_graph_cache = True
+        # Every bucket and batch size is its own graph, the default limit of 8 would fall back to eager
+        for name in ("recompile_limit", "cache_size_limit"):
+            if hasattr(torch._dynamo.config, name):
+                setattr(torch._dynamo.config, name, max(getattr(torch._dynamo.config, name), max_graphs))
+
+        self.artifacts_loaded = self._load_artifacts()
+
+    @property
+    def artifacts_path(self):
+        return os.path.join(self.cache_dir, ARTIFACTS_FILE)
+
+    def _load_artifacts(self):
+        # Portable cache artifacts exist from torch 2.7, older releases only use the directories
+        if not hasattr(torch.compiler, "load_cache_artifacts") or not os.path.isfile(self.artifacts_path):
+            return False
+        with open(self.artifacts_path, "rb") as f:
+            torch.compiler.load_cache_artifacts(f.read())
+        return True
+
+    def save(self):
+        """Writes everything compiled so far as a single artifact file next to the caches."""
+        if not hasattr(torch.compiler, "save_cache_artifacts"):
+            return
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is None:
+            return
+        # Another worker may share the directory, never leave a half written file behind
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(artifacts[0])
+        os.replace(tmp_path, self.artifacts_path)
+
+    def compile_pipeline(self, pipeline):
+        """Compiles the transformer and the VAE decoder in place; the pipeline keeps the same modules."""
+        pipeline.transformer.compile(mode=self.mode, dynamic=False)
+        pipeline.vae.decoder.compile(mode=self.mode, dynamic=False)
+
+    def run(self, key, fn):
+        """Returns (fn(), report). Only the first call for a shape `key` is measured."""
+        if key in self.reports:
+            return fn(), {**self.reports[key], "first_call": False}
+
+        from torch._dynamo.utils import compilation_time_metrics, counters
+
+        def compiled_seconds():
+            return sum(compilation_time_metrics.get("_compile.compile_inner", []))
+
+        hits, misses = counters["inductor"]["fxgraph_cache_hit"], counters["inductor"]["fxgraph_cache_miss"]
+        compiled_before = compiled_seconds()
+        start = time.perf_counter()
+        value = fn()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        hits = counters["inductor"]["fxgraph_cache_hit"] - hits
+        misses = counters["inductor"]["fxgraph_cache_miss"] - misses
+        status = "miss" if misses else "hit" if hits else "warm"
+        compile_ms = round((compiled_seconds() - compiled_before) * 1000, 1)
+
+        report = {
+            "status": status,
+            "graphs_compiled": misses,
+            "graphs_loaded": hits,
+            "compile_ms": compile_ms,
+            "first_call_ms": round(elapsed_ms, 1),
+        }
+        self.reports[key] = report
+        self.counts[status] += 1
+        self.compile_ms += compile_ms
+        if misses:
+            self.save()
+        return value, {**report, "first_call": True}
+
+    def stats(self):
+        return {**self.counts, "shapes": len(self.reports), "compile_ms": round(self.compile_ms, 1),
+                "artifacts_loaded": self.artifacts_loaded}
@@ -0,0 +1,154 @@
+import os
+
+# --- Worker Concurrency ---
+# Number of jobs RunPod may hand to this worker at the same time
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "8"))
+
+# --- Micro-batching Scheduler ---
+# Jobs sharing a resolution bucket are merged into a single pipeline call
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "4"))
+# How long the oldest pending job may wait for others to join its batch
+MAX_BATCH_WAIT_MS = int(os.getenv("MAX_BATCH_WAIT_MS", "50"))
+# Jobs for the LoRA adapter that is already applied run first, unless others have waited this long
+ADAPTER_AFFINITY_MAX_WAIT_MS = int(os.getenv("ADAPTER_AFFINITY_MAX_WAIT_MS", "2000"))
+
+# --- Memory Admission ---
+# Batches are sized, and jobs delayed or rejected, so a batch's estimated peak memory stays in budget
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() in ("1", "true", "yes")
+# Device memory (host memory without a GPU) the worker may use; 0 takes ADMISSION_MEMORY_FRACTION of the total
+ADMISSION_MEMORY_BUDGET_BYTES = int(os.getenv("ADMISSION_MEMORY_BUDGET_BYTES", "0"))
+ADMISSION_MEMORY_FRACTION = float(os.getenv("ADMISSION_MEMORY_FRACTION", "0.9"))
+# Cost model before anything was measured: bytes per batch plus bytes per output and conditioning pixel
+ADMISSION_PRIOR_FIXED_BYTES = int(os.getenv("ADMISSION_PRIOR_FIXED_BYTES", str(512 * 1024 * 1024)))
+ADMISSION_PRIOR_BYTES_PER_PIXEL = float(os.getenv("ADMISSION_PRIOR_BYTES_PER_PIXEL", "1024"))
+# Estimates are padded by this fraction
+ADMISSION_MARGIN = float(os.getenv("ADMISSION_MARGIN", "0.1"))
+# Jobs are only rejected up front once this many batches have been measured
+ADMISSION_MIN_SAMPLES = int(os.getenv("ADMISSION_MIN_SAMPLES", "3"))
+# Jobs delayed for memory are looked at again after ADMISSION_RETRY_MS, and stopped with reason
+# "memory_budget" once they waited ADMISSION_MAX_DELAY_MS
+ADMISSION_RETRY_MS = int(os.getenv("ADMISSION_RETRY_MS", "100"))
+ADMISSION_MAX_DELAY_MS = int(os.getenv("ADMISSION_MAX_DELAY_MS", "30000"))
+# Measured batches are kept here so calibration survives restarts
+ADMISSION_STATE_FILE = os.getenv("ADMISSION_STATE_FILE") or None
+
+# --- LoRA Adapters ---
+# "lora": "<name>" selects <LORA_DIR>/<name>.safetensors
+LORA_DIR = os.getenv("LORA_DIR", "/runpod-volume/loras")
+# Host memory for loaded adapter weights, least recently used adapters are dropped first
+LORA_CACHE_MAX_ENTRIES = int(os.getenv("LORA_CACHE_MAX_ENTRIES", "16"))
+LORA_CACHE_MAX_BYTES = int(os.getenv("LORA_CACHE_MAX_BYTES", str(4 * 1024 * 1024 * 1024)))
+
+# --- Prompt Embedding Cache ---
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "256"))
+PROMPT_CACHE_MAX_BYTES = int(os.getenv("PROMPT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# --- Conditioning Image Cache ---
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "64"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Optional local directory that latents evicted from memory are spilled to
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR") or None
+IMAGE_CACHE_DISK_MAX_BYTES = int(os.getenv("IMAGE_CACHE_DISK_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# --- Result Cache ---
+# Finished results of seeded requests are kept on disk and shared by identical requests
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "/tmp/flux-kontext/results")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# --- Startup ---
+# Comma separated "WxH" buckets that get a tiny warmup generation before the worker takes jobs
+WARMUP_BUCKETS = [
+    tuple(int(side) for side in bucket.split("x"))
+    for bucket in os.getenv("WARMUP_BUCKETS", "1024x1024,1184x880,880x1184").split(",")
+    if bucket.strip()
+]
+WARMUP_STEPS = int(os.getenv("WARMUP_STEPS", "2"))
+
+# --- Compilation ---
+# Compiles the transformer and VAE decoder once per bucket shape with torch.compile
+COMPILE = os.getenv("COMPILE", "false").lower() in ("1", "true", "yes")
+# torch.compile mode, e.g. "default", "max-autotune-no-cudagraphs"
+COMPILE_MODE = os.getenv("COMPILE_MODE", "default")
+# Compiled graphs are kept here; a directory populated on a GPU worker can be baked into the image
+COMPILE_CACHE_DIR = os.getenv("COMPILE_CACHE_DIR", "/app/compile-cache")
+# "all" or comma separated "WxH" buckets compiled during startup, the rest compile on first use
+COMPILE_PREWARM_BUCKETS = os.getenv("COMPILE_PREWARM_BUCKETS", "")
+
+# --- Sampling Quality ---
+# The "quality" input picks the denoising steps and the residual cache threshold: when the first
+# transformer block's residual changed by less than this (relative L1) since the previous step,
+# the remaining blocks are skipped and their previous residual reused. 0 never skips.
+QUALITY_PRESETS = {
+    "draft": {
+        "steps": int(os.getenv("DRAFT_STEPS", "12")),
+        "cache_threshold": float(os.getenv("DRAFT_CACHE_THRESHOLD", "0.15")),
+    },
+    "standard": {
+        "steps": int(os.getenv("STANDARD_STEPS", "20")),
+        "cache_threshold": float(os.getenv("STANDARD_CACHE_THRESHOLD", "0.08")),
+    },
+    "final": {
+        "steps": int(os.getenv("FINAL_STEPS", "28")),
+        "cache_threshold": float(os.getenv("FINAL_CACHE_THRESHOLD", "0")),
+    },
+}
+# "final" is the full schedule without caching, as before the option existed
+DEFAULT_QUALITY = os.getenv("DEFAULT_QUALITY", "final")
+
+# --- Multi-output Requests ---
+# Upper bound on num_outputs / len(seeds); outputs run in MAX_BATCH_SIZE chunks
+MAX_NUM_OUTPUTS = int(os.getenv("MAX_NUM_OUTPUTS", "8"))
+
+# --- Tiled Output Decode ---
+# "output_scale" decodes in overlapping tiles, upscaling each one, and encodes rows as they finish
+MAX_OUTPUT_SCALE = int(os.getenv("MAX_OUTPUT_SCALE", "4"))
+# Side of a decoded tile in output pixels, tiles are never smaller than DECODE_TILE_MIN_LATENT latents
+DECODE_TILE_SIZE = int(os.getenv("DECODE_TILE_SIZE", "512"))
+DECODE_TILE_MIN_LATENT = int(os.getenv("DECODE_TILE_MIN_LATENT", "32"))
+# Rows are encoded on separate threads; decoding waits once this many strips of rows are pending
+ENCODE_QUEUE_STRIPS = int(os.getenv("ENCODE_QUEUE_STRIPS", "8"))
+
+# --- Progress Previews ---
+# Longest side of preview thumbnails in pixels, 0 keeps the latent resolution
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "128"))
+PREVIEW_EVERY_N_STEPS = int(os.getenv("PREVIEW_EVERY_N_STEPS", "5"))
+PREVIEW_MIN_INTERVAL_MS = int(os.getenv("PREVIEW_MIN_INTERVAL_MS", "500"))
+# Yield progress to RunPod's /stream instead of posting it to /status; clients then set RUNPOD_USE_STREAM
+STREAM_PROGRESS = os.getenv("STREAM_PROGRESS", "false").lower() == "true"
+
+# --- Output Delivery ---
+# Where `output_delivery: "url"` results are uploaded, e.g. "s3://bucket/outputs/" or "file:///tmp/outputs"
+OUTPUT_BUCKET_URL = os.getenv("OUTPUT_BUCKET_URL") or None
+# Custom endpoint for S3-compatible stores such as MinIO
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+OUTPUT_URL_EXPIRES_IN = int(os.getenv("OUTPUT_URL_EXPIRES_IN", "3600"))
+
+# --- Remote Input Fetcher ---
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", str(32 * 1024 * 1024)))
+FETCH_CONNECT_TIMEOUT = float(os.getenv("FETCH_CONNECT_TIMEOUT", "5"))
+FETCH_READ_TIMEOUT = float(os.getenv("FETCH_READ_TIMEOUT", "30"))
+FETCH_POOL_SIZE = int(os.getenv("FETCH_POOL_SIZE", "16"))
+# Downloads with an ETag or Last-Modified header are kept here and revalidated on reuse
+FETCH_CACHE_DIR = os.getenv("FETCH_CACHE_DIR", "/tmp/flux-kontext/inputs")
+FETCH_CACHE_MAX_BYTES = int(os.getenv("FETCH_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# --- Input Preprocessing ---
+# Inputs above this many pixels are rejected as likely decompression bombs
+INPUT_MAX_PIXELS = int(os.getenv("INPUT_MAX_PIXELS", str(50_000_000)))
+
+# --- Metrics ---
+# Prometheus text export, written at most every METRICS_DUMP_INTERVAL_S seconds
+METRICS_FILE = os.getenv("METRICS_FILE") or None
+METRICS_DUMP_INTERVAL_S = float(os.getenv("METRICS_DUMP_INTERVAL_S", "15"))
+# Serves /metrics over HTTP when set
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# --- Cancellation ---
+# Polls a running job's status on the RunPod API this often, so a cancel from the console or the
+# /cancel route stops denoising; 0 disables it. Without polling only deadline_ms stops a job early
+CANCEL_POLL_INTERVAL_S = float(os.getenv("CANCEL_POLL_INTERVAL_S", "2"))
+RUNPOD_API_BASE = os.getenv("RUNPOD_API_BASE", "https://api.runpod.ai/v2")
+# RunPod sets RUNPOD_ENDPOINT_ID and RUNPOD_AI_API_KEY in serverless workers, RUNPOD_API_KEY overrides the key.
+# Polling is off when either is missing, e.g. in local test runs
+RUNPOD_ENDPOINT_ID = os.getenv("RUNPOD_ENDPOINT_ID")
+RUNPOD_API_KEY = os.getenv("RUNPOD_API_KEY") or os.getenv("RUNPOD_AI_API_KEY")
@@ -0,0 +1,243 @@
+import base64
+import os
+import queue
+import shutil
+import struct
+import zlib
+from io import BytesIO
+from urllib.parse import urlparse
+
+# Optional dependency, only needed for s3:// output buckets
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+import numpy as np
+from PIL import Image
+
+OUTPUT_FORMATS = ("png", "jpeg", "webp", "raw")
+OUTPUT_DELIVERIES = ("inline", "url")
+
+MIME_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "raw": "application/octet-stream",
+}
+
+FILE_EXTENSIONS = {
+    "png": "png",
+    "jpeg": "jpg",
+    "webp": "webp",
+    "raw": "rgb",
+}
+
+def encode_image(image, output_format="png", quality=90, compress_level=6):
+    """
+    Encodes an image into a single in-memory buffer, positioned at its start.
+    `raw` is the bare pixel buffer in the image's mode, row-major.
+    """
+    if output_format == "raw":
+        return BytesIO(image.tobytes())
+
+    buffer = BytesIO()
+    if output_format == "png":
+        image.save(buffer, format="PNG", compress_level=compress_level)
+    elif output_format == "jpeg":
+        if image.mode == "RGBA":
+            image = image.convert("RGB")
+        image.save(buffer, format="JPEG", quality=quality)
+    elif output_format == "webp":
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    else:
+        raise ValueError(f"Unsupported output format: {output_format}")
+
+    buffer.seek(0)
+    return buffer
+
+
+class EncodedImage:
+    """An image encoded while it was produced, with the attributes results report about it."""
+
+    def __init__(self, buffer, width, height, mode="RGB"):
+        self.buffer = buffer
+        self.width = width
+        self.height = height
+        self.mode = mode
+
+
+class PngRowWriter:
+    """Encodes a PNG from rows of RGB pixels as they arrive, only the compressed bytes are kept."""
+
+    def __init__(self, width, height, compress_level=6):
+        self.width = width
+        self.height = height
+        self.buffer = BytesIO()
+        self.buffer.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per channel, truecolor, no interlacing
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        self.compressor = zlib.compressobj(compress_level)
+
+    def _chunk(self, kind, data):
+        self.buffer.write(struct.pack(">I", len(data)) + kind + data)
+        self.buffer.write(struct.pack(">I", zlib.crc32(kind + data)))
+
+    def write(self, rows):
+        # Sub filter, each byte minus the one a pixel to its left; photos compress far better than unfiltered
+        filtered = rows.copy()
+        filtered[:, 1:] -= rows[:, :-1]
+        data = np.concatenate([np.ones((len(rows), 1), np.uint8), filtered.reshape(len(rows), -1)], axis=1)
+        compressed = self.compressor.compress(data.tobytes())
+        if compressed:
+            self._chunk(b"IDAT", compressed)
+
+    def finish(self):
+        self._chunk(b"IDAT", self.compressor.flush())
+        self._chunk(b"IEND", b"")
+        self.buffer.seek(0)
+        return EncodedImage(self.buffer, self.width, self.height)
+
+
+class RawRowWriter:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.buffer = BytesIO()
+
+    def write(self, rows):
+        self.buffer.write(rows.tobytes())
+
+    def finish(self):
+        self.buffer.seek(0)
+        return EncodedImage(self.buffer, self.width, self.height)
+
+
+class FrameRowWriter:
+    """JPEG and WebP need the whole frame, so rows are collected as 8-bit pixels and encoded at the end."""
+
+    def __init__(self, width, height, output_format, quality=90):
+        self.frame = np.empty((height, width, 3), np.uint8)
+        self.output_format = output_format
+        self.quality = quality
+        self.filled = 0
+
+    def write(self, rows):
+        self.frame[self.filled:self.filled + len(rows)] = rows
+        self.filled += len(rows)
+
+    def finish(self):
+        image = Image.fromarray(self.frame)
+        buffer = encode_image(image, self.output_format, quality=self.quality)
+        return EncodedImage(buffer, image.width, image.height)
+
+
+def make_row_writer(output_format, width, height, quality=90, compress_level=6):
+    """Returns a writer taking uint8 (rows, width, 3) arrays top to bottom; `finish()` returns an EncodedImage."""
+    if output_format == "png":
+        return PngRowWriter(width, height, compress_level)
+    if output_format == "raw":
+        return RawRowWriter(width, height)
+    if output_format in ("jpeg", "webp"):
+        return FrameRowWriter(width, height, output_format, quality)
+    raise ValueError(f"Unsupported output format: {output_format}")
+
+
+class RowEncoder:
+    """
+    Feeds a row writer on an `executor` thread, while rows are produced on another one.
+
+    `write(rows)` hands a strip of rows over, blocking while `max_pending` strips wait for the
+    encoder, so memory stays bounded when encoding is the slower side. `finish()` returns a Future
+    of the writer's EncodedImage. A producer that fails half way calls `abort()` instead.
+    """
+
+    _ABORT = object()
+
+    def __init__(self, writer, executor, max_pending=8):
+        self._queue = queue.Queue(max(1, max_pending))
+        self._future = executor.submit(self._run, writer)
+
+    def _run(self, writer):
+        while True:
+            rows = self._queue.get()
+            if rows is None:
+                return writer.finish()
+            if rows is self._ABORT:
+                return None
+            writer.write(rows)
+
+    def _put(self, item):
+        while True:
+            if self._future.done():
+                # The writer failed, its error is the one to report
+                self._future.result()
+                raise RuntimeError("The row encoder stopped before the image was complete.")
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, rows):
+        self._put(rows)
+
+    def finish(self):
+        self._put(None)
+        return self._future
+
+    def abort(self):
+        if not self._future.done():
+            self._put(self._ABORT)
+
+
+def buffer_to_base64(buffer):
+    # getbuffer() exposes the encoded bytes without copying them out first
+    return base64.b64encode(buffer.getbuffer()).decode("utf-8")
+
+
+class FileUploader:
+    """Stand-in for an object store that writes into a local directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def upload(self, name, buffer, content_type):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(buffer, f)
+        return f"file://{path}"
+
+
+class S3Uploader:
+    """Uploads to an S3-compatible bucket (AWS, MinIO, R2, ...) and returns a presigned GET URL."""
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, expires_in=3600):
+        if boto3 is None:
+            raise RuntimeError("boto3 is required for s3:// output buckets.")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.expires_in = expires_in
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def upload(self, name, buffer, content_type):
+        key = f"{self.prefix}{name}"
+        # upload_fileobj streams the buffer in parts instead of reading it whole
+        self.client.upload_fileobj(buffer, self.bucket, key, ExtraArgs={"ContentType": content_type})
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=self.expires_in
+        )
+
+
+def make_uploader(output_url, endpoint_url=None, expires_in=3600):
+    """Builds an uploader from `s3://bucket/prefix/` or `file:///some/directory`."""
+    parsed = urlparse(output_url)
+    if parsed.scheme == "s3":
+        prefix = parsed.path.lstrip("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        return S3Uploader(parsed.netloc, prefix, endpoint_url=endpoint_url, expires_in=expires_in)
+    if parsed.scheme == "file":
+        return FileUploader(parsed.path)
+    raise ValueError(f"Unsupported output bucket URL: {output_url}. Expected 's3://' or 'file://'.")
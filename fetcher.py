@@ -0,0 +1,170 @@
+import json
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from io import BytesIO
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image, ImageFile
+
+from cache import DiskCache
+
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchError(ValueError):
+    pass
+
+
+class ImageFetcher:
+    """
+    Downloads input images over a pooled session with strict size limits.
+
+    The body is buffered up to `max_bytes`, and its header parsed as it arrives, so an
+    oversized download is rejected as soon as its dimensions are known. Images are returned
+    opened but not decoded, leaving `prepare_input_image` to decode at reduced scale. Responses carrying an ETag or
+    Last-Modified header are kept in an on-disk cache and revalidated with a
+    conditional request on the next fetch.
+    """
+
+    def __init__(self, max_bytes, max_pixels, timeout=(5, 30), pool_size=16,
+                 cache_dir=None, cache_max_bytes=0, prefetch_workers=4):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.cache = DiskCache(cache_dir, cache_max_bytes) if cache_dir else None
+        self.stats = {"downloads": 0, "not_modified": 0, "bytes_downloaded": 0}
+
+        self._inflight = {}  # url -> Future
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="image-prefetch")
+
+    def prefetch(self, url):
+        """Starts downloading `url` in the background. A later `fetch` of the same URL joins it."""
+        with self._lock:
+            if url in self._inflight:
+                return
+            future = self._executor.submit(self._fetch, url)
+            self._inflight[url] = future
+        future.add_done_callback(lambda _: self._forget(url, future))
+
+    def cancel_prefetch(self, url):
+        """Drops the prefetch of `url` if it has not started yet. A download already running finishes, within the limits."""
+        with self._lock:
+            future = self._inflight.get(url)
+        if future is not None:
+            future.cancel()
+
+    def _forget(self, url, future):
+        with self._lock:
+            if self._inflight.get(url) is future:
+                del self._inflight[url]
+
+    def fetch(self, url):
+        with self._lock:
+            future = self._inflight.get(url)
+        if future is not None:
+            try:
+                return future.result()
+            except CancelledError:
+                # Dropped for another job that was rejected
+                pass
+        return self._fetch(url)
+
+    def revalidate(self, url):
+        """Like `fetch`, but returns None rather than the image when the cached copy of `url` is still current."""
+        return self._fetch(url, open_not_modified=False)
+
+    def _fetch(self, url, open_not_modified=True):
+        meta = self._cached_meta(url)
+
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304:
+                data = self.cache.get(("body", url))
+                if data is not None:
+                    self.stats["not_modified"] += 1
+                    return self._open(data) if open_not_modified else None
+                # The body was evicted while its metadata survived, fall back to a plain download
+                return self._download(url, {})
+            return self._read_response(url, response)
+
+    def _download(self, url, headers):
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            return self._read_response(url, response)
+
+    def _read_response(self, url, response):
+        response.raise_for_status()
+
+        declared_length = response.headers.get("Content-Length")
+        if declared_length is not None and int(declared_length) > self.max_bytes:
+            raise FetchError(f"Input image is {declared_length} bytes, the limit is {self.max_bytes}.")
+
+        cacheable = self.cache is not None and (
+            response.headers.get("ETag") or response.headers.get("Last-Modified")
+        )
+
+        def chunks():
+            for chunk in response.iter_content(CHUNK_SIZE):
+                self.stats["bytes_downloaded"] += len(chunk)
+                yield chunk
+
+        data = self._read_body(chunks())
+        image = self._open(data)
+        self.stats["downloads"] += 1
+
+        if cacheable:
+            self.cache.put(("body", url), data)
+            self.cache.put(("meta", url), json.dumps({
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }).encode("utf-8"))
+
+        return image
+
+    def _check_size(self, width, height):
+        if width * height > self.max_pixels:
+            raise FetchError(f"Input image is {width}x{height}, the limit is {self.max_pixels} pixels.")
+
+    def _read_body(self, chunks):
+        body = BytesIO()
+        parser = ImageFile.Parser()
+        for chunk in chunks:
+            if body.tell() + len(chunk) > self.max_bytes:
+                raise FetchError(f"Input image exceeds the {self.max_bytes} byte limit.")
+            body.write(chunk)
+            if parser is None:
+                continue
+            parser.feed(chunk)
+            # The header is parsed after the first few chunks, reject huge images before downloading the rest
+            if parser.image is not None:
+                self._check_size(*parser.image.size)
+                # Only the header was wanted, the pixels are decoded later and maybe at reduced scale
+                parser = None
+        return body.getvalue()
+
+    def _open(self, data):
+        try:
+            image = Image.open(BytesIO(data))
+        except (OSError, SyntaxError) as e:
+            raise FetchError(f"Could not decode input image: {e}")
+        self._check_size(*image.size)
+        return image
+
+    def _cached_meta(self, url):
+        if self.cache is None:
+            return None
+        data = self.cache.get(("meta", url))
+        return json.loads(data) if data is not None else None
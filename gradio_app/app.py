@@ -2,7 +2,7 @@ import gradio as gr
 import runpod
 
 from config import RUNPOD_API_KEY, ratios
-from inference import generate
+from inference import generate, cancel_generation, batch_generation_flow
 
 # --- Gradio UI ---
 
@@ -15,25 +15,28 @@ def create_ui():
     """) as demo:
         with gr.Column(elem_classes="container"):
             gr.Markdown("# Flux Kontext Experiment Tool")
-            
-            with gr.Row():
+
+            execution_env = gr.Radio(
+                choices=["runpod", "local"], 
+                value="runpod", 
+                label="Execution Environment",
+                info="Choose 'runpod' for cloud-based generation or 'local' to use your own GPU (requires setup)."
+            )
+
+            with gr.Tab("Single"), gr.Row():
                 with gr.Column(scale=1):
-                    execution_env = gr.Radio(
-                        choices=["runpod", "local"], 
-                        value="runpod", 
-                        label="Execution Environment",
-                        info="Choose 'runpod' for cloud-based generation or 'local' to use your own GPU (requires setup)."
-                    )
                     image_input = gr.Image(type="filepath", label="Upload Image")
                     prompt_input = gr.Textbox(lines=2, label="Prompt", placeholder="e.g., make it a watercolor painting")
                     ratio_input = gr.Radio(choices=ratios, label="Aspect Ratio", value="Original")
-                    generate_button = gr.Button("Generate", variant="primary")
+                    with gr.Row():
+                        generate_button = gr.Button("Generate", variant="primary")
+                        cancel_button = gr.Button("Cancel", variant="stop")
 
                 with gr.Column(scale=1):
                     status_output = gr.Textbox(label="Status", interactive=False)
                     image_output = gr.Image(label="Generated Image", interactive=False)
 
-            async def wrapped_generate(execution_env, image_path, prompt, ratio):
+            async def wrapped_generate(execution_env, image_path, prompt, ratio, request: gr.Request):
                 """A wrapper to handle UI updates like button disabling and spinners."""
                 # Disable the button at the start of any generation attempt.
                 yield {generate_button: gr.Button(interactive=False)}
@@ -43,7 +46,7 @@ def create_ui():
                 final_status = ""
 
                 # Stream results from the underlying generator.
-                async for image, status in generate(execution_env, image_path, prompt, ratio):
+                async for image, status in generate(execution_env, image_path, prompt, ratio, request.session_hash):
                     # Store the current state
                     final_image = image
                     final_status = status
@@ -71,6 +74,45 @@ def create_ui():
                 inputs=[execution_env, image_input, prompt_input, ratio_input],
                 outputs=[image_output, status_output, generate_button]
             )
+
+            async def wrapped_cancel(request: gr.Request):
+                return await cancel_generation(request.session_hash)
+
+            # The generation keeps streaming and reports how far the job got once it has stopped
+            cancel_button.click(fn=wrapped_cancel, inputs=[], outputs=[status_output])
+
+            with gr.Tab("Batch"), gr.Row():
+                with gr.Column(scale=1):
+                    batch_images_input = gr.File(file_count="multiple", file_types=["image"], label="Upload Images")
+                    batch_prompts_input = gr.Textbox(lines=5, label="Prompts (one per line)",
+                                                     placeholder="make it a watercolor painting\nturn it into a pencil sketch")
+                    batch_ratios_input = gr.CheckboxGroup(choices=ratios, value=["Original"], label="Aspect Ratios")
+                    batch_in_flight_input = gr.Slider(1, 16, value=4, step=1, label="Max Jobs In Flight")
+                    batch_button = gr.Button("Run Batch", variant="primary")
+
+                with gr.Column(scale=1):
+                    batch_status_output = gr.Textbox(label="Status", interactive=False)
+                    batch_gallery_output = gr.Gallery(label="Results", columns=3, interactive=False)
+
+            async def wrapped_batch(execution_env, files, prompts_text, selected_ratios, max_in_flight):
+                """Streams the batch gallery while keeping the button disabled until every job has finished."""
+                yield {batch_button: gr.Button(interactive=False)}
+
+                image_paths = [file if isinstance(file, str) else file.name for file in files or []]
+                prompts = [line.strip() for line in (prompts_text or "").splitlines() if line.strip()]
+
+                async for gallery, status in batch_generation_flow(
+                    execution_env, image_paths, prompts, selected_ratios or [], max_in_flight
+                ):
+                    yield {batch_gallery_output: gallery, batch_status_output: status}
+
+                yield {batch_button: gr.Button(interactive=True)}
+
+            batch_button.click(
+                fn=wrapped_batch,
+                inputs=[execution_env, batch_images_input, batch_prompts_input, batch_ratios_input, batch_in_flight_input],
+                outputs=[batch_gallery_output, batch_status_output, batch_button]
+            )
     return demo
 
 # --- Main Execution ---
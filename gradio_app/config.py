@@ -7,6 +7,33 @@ load_dotenv()
 # --- RunPod Configuration ---
 RUNPOD_API_KEY = os.getenv("RUNPOD_API_KEY")
 RUNPOD_ENDPOINT_ID = os.getenv("RUNPOD_ENDPOINT_ID") 
+RUNPOD_API_BASE = os.getenv("RUNPOD_API_BASE", "https://api.runpod.ai/v2")
+# Upper bound on requests per second to RunPod across all jobs the UI is watching
+RUNPOD_MAX_RPS = float(os.getenv("RUNPOD_MAX_RPS", "10"))
+# Long-poll /stream instead of polling /status, for workers started with STREAM_PROGRESS
+RUNPOD_USE_STREAM = os.getenv("RUNPOD_USE_STREAM", "false").lower() == "true"
+
+# --- Input Preparation ---
+# Inputs are downscaled to their conditioning bucket and re-encoded in this format before they are sent
+INPUT_FORMAT = os.getenv("INPUT_FORMAT", "webp")
+INPUT_QUALITY = int(os.getenv("INPUT_QUALITY", "90"))
+# Prepared inputs remembered by content hash
+INPUT_CACHE_MAX_ENTRIES = int(os.getenv("INPUT_CACHE_MAX_ENTRIES", "64"))
+# Optional "s3://bucket/prefix/" (needs boto3): prepared inputs are uploaded once and sent as presigned URLs
+INPUT_UPLOAD_URL = os.getenv("INPUT_UPLOAD_URL") or None
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+INPUT_URL_EXPIRES_IN = int(os.getenv("INPUT_URL_EXPIRES_IN", "3600"))
+
+# --- Local Inference Worker ---
+# "module:function" returning the pipeline served by the local worker process; point it at a stub for testing
+LOCAL_PIPELINE_FACTORY = os.getenv("LOCAL_PIPELINE_FACTORY", "local_worker:load_flux_pipeline")
+# "auto" picks from free GPU memory, or force one of "none", "model", "sequential"
+LOCAL_OFFLOAD_STRATEGY = os.getenv("LOCAL_OFFLOAD_STRATEGY", "auto").lower()
+# Free GPU memory needed to keep every component resident, or to offload whole models instead of layers
+LOCAL_RESIDENT_MIN_GB = float(os.getenv("LOCAL_RESIDENT_MIN_GB", "22"))
+LOCAL_MODEL_OFFLOAD_MIN_GB = float(os.getenv("LOCAL_MODEL_OFFLOAD_MIN_GB", "12"))
+# Shared memory frames the worker can have in flight to the UI; previews are dropped when all are taken
+LOCAL_FRAME_SLOTS = int(os.getenv("LOCAL_FRAME_SLOTS", "4"))
 
 # --- UI and Model Configuration ---
 # List of aspect ratios for the UI, matching the API's expected format
@@ -1,127 +1,127 @@
 import asyncio
-import aiohttp
-from runpod import AsyncioEndpoint, AsyncioJob
+import atexit
+import itertools
+import os
+import uuid
 from PIL import Image
-import traceback
 
-# Optional imports for local inference
+from config import (
+    RUNPOD_API_KEY,
+    RUNPOD_ENDPOINT_ID,
+    RUNPOD_API_BASE,
+    RUNPOD_MAX_RPS,
+    RUNPOD_USE_STREAM,
+    LOCAL_PIPELINE_FACTORY,
+    INPUT_FORMAT,
+    INPUT_QUALITY,
+    INPUT_CACHE_MAX_ENTRIES,
+    INPUT_UPLOAD_URL,
+    S3_ENDPOINT_URL,
+    INPUT_URL_EXPIRES_IN,
+)
+from input_cache import InputPreparer
+from transport import RunPodTransport
+from utils import base64_to_pil, resize_to_target_area
+
+# Optional imports for local inference. The pipeline itself is only loaded in the worker process.
 try:
     import torch
-    from diffusers import FluxKontextPipeline
-    from diffusers.utils import load_image as diffusers_load_image
-    from nunchaku import NunchakuFluxTransformer2dModel
-    from nunchaku.utils import get_precision
-    LOCAL_INFERENCE_ENABLED = torch.cuda.is_available()
+    from local_worker import LocalWorker
+    # A custom pipeline factory (e.g. a CPU stub) does not need a GPU
+    LOCAL_INFERENCE_ENABLED = torch.cuda.is_available() or LOCAL_PIPELINE_FACTORY != "local_worker:load_flux_pipeline"
     if not LOCAL_INFERENCE_ENABLED:
         print("Warning: No CUDA device found, local inference will be disabled.")
 except ImportError:
     print("Warning: Some libraries for local inference are not installed. Local inference will be disabled.")
     LOCAL_INFERENCE_ENABLED = False
 
-from config import RUNPOD_ENDPOINT_ID, LATENT_RGB_FACTORS
-from utils import base64_to_pil, image_to_base64_uri, resize_to_target_area
+# Job currently running for each UI session, so it can be cancelled: session_key -> (execution_env, job_id)
+active_jobs = {}
 
-# --- Local Inference ---
-local_pipeline = None
-
-def _initialize_local_pipeline():
-    """Initializes and returns the local pipeline. Should not be called directly."""
-    global local_pipeline
-    if local_pipeline is None and LOCAL_INFERENCE_ENABLED:
-        print("Initializing local pipeline for the first time...")
-        try:
-            transformer = NunchakuFluxTransformer2dModel.from_pretrained(
-                f"mit-han-lab/nunchaku-flux.1-kontext-dev/svdq-{get_precision()}_r32-flux.1-kontext-dev.safetensors"
-            )
-            pipeline = FluxKontextPipeline.from_pretrained(
-                "black-forest-labs/FLUX.1-Kontext-dev", transformer=transformer, torch_dtype=torch.bfloat16
-            )
-            pipeline.enable_sequential_cpu_offload()
-            local_pipeline = pipeline
-            print("Local pipeline initialized successfully.")
-        except Exception as e:
-            print(f"Error initializing local pipeline: {e}")
-            local_pipeline = None  # Indicate failure
-    return local_pipeline
-
-def run_local_generation_sync(image_path: str, prompt: str, ratio: str, update_queue: asyncio.Queue, display_size: tuple[int, int]):
-    """Synchronous function for local generation with progress updates."""
-    pipeline = _initialize_local_pipeline()
-    if pipeline is None:
-        update_queue.put_nowait((None, "Status: Local pipeline initialization failed. Check server logs."))
-        return
+def describe_stopped(report: dict) -> str:
+    """Formats the handler's report for a job that stopped before finishing."""
+    steps = f"{report['steps_completed']}/{report['total_steps']}" if report.get("total_steps") else "0"
+    return f"stopped ({report['reason']}) after {steps} steps, {report['compute_saved']:.0%} of the compute saved"
 
-    try:
-        input_image = diffusers_load_image(image_path).convert("RGB")
-        width, height = resize_to_target_area(input_image, ratio)
-
-        def on_step_end_callback(pipe, step: int, timestep: int, callback_kwargs: dict):
-            total_steps = len(pipe.scheduler.timesteps)
-            progress = int(((step + 1) / total_steps) * 100)
-            
-            if (step + 1) % 5 != 0 and (step + 1) < (total_steps - 1):
-                return callback_kwargs
-
-            latents = callback_kwargs["latents"]
-            unpacked_latents = pipe._unpack_latents(latents, height, width, pipe.vae_scale_factor)
-            
-            with torch.no_grad():
-                latent_rgb_factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device='cpu')
-                rgb = torch.einsum("...lhw,lr -> ...rhw", unpacked_latents.cpu().float(), latent_rgb_factors)
-                rgb = (((rgb + 1) / 2).clamp(0, 1)).movedim(1, -1)
-                image_np = (rgb[0] * 255).byte().numpy()
-                pil_image = Image.fromarray(image_np)
-                resized_intermediate = pil_image.resize(display_size, Image.Resampling.LANCZOS)
-                update_queue.put_nowait((resized_intermediate, f"Status: In progress... ({progress}%)"))
-
-            return callback_kwargs
-
-        generated_image = pipeline(
-            image=input_image, prompt=prompt, width=width, height=height, guidance_scale=2.5,
-            callback_on_step_end=on_step_end_callback, callback_on_step_end_tensor_inputs=["latents"]
-        ).images[0]
-        
-        update_queue.put_nowait((generated_image, "Status: Local generation complete!"))
+def missed_reference(update) -> bool:
+    """Whether a job failed because the worker did not know the input reference it was sent."""
+    return (update.status == "FAILED" and isinstance(update.output, dict)
+            and update.output.get("error_type") == "SourceNotCached")
 
-    except Exception as e:
-        traceback.print_exc()
-        update_queue.put_nowait((None, f"Status: An error occurred during local generation: {e}"))
+# --- Local Inference ---
+local_worker = None
+
+def get_local_worker():
+    """Returns the worker process that owns the local pipeline, starting it on first use."""
+    global local_worker
+    if local_worker is None:
+        local_worker = LocalWorker()
+        local_worker.start()
+        atexit.register(local_worker.stop)
+    return local_worker
 
 
-async def local_generation_flow(image_path: str, prompt: str, ratio: str):
-    """Asynchronous wrapper for local image generation."""
+async def local_generation_flow(image_path: str, prompt: str, ratio: str, session_key: str = None):
+    """Runs one generation on the local worker process, yielding previews as they arrive."""
     if not LOCAL_INFERENCE_ENABLED:
         yield None, "Status: Local inference is not available. Check server logs for details."
         return
 
     yield None, "Status: Starting local generation..."
-    
-    update_queue = asyncio.Queue()
-    loop = asyncio.get_running_loop()
-    
+
     with Image.open(image_path) as img:
         display_size = resize_to_target_area(img, ratio)
 
-    generation_task = loop.run_in_executor(
-        None, run_local_generation_sync, image_path, prompt, ratio, update_queue, display_size
-    )
-
+    job_id = uuid.uuid4().hex
     last_known_image = None
-    while True:
-        try:
-            image, status = await asyncio.wait_for(update_queue.get(), timeout=1.0)
-            last_known_image = image if image else last_known_image
-            yield last_known_image, status
-            update_queue.task_done()
-        except asyncio.TimeoutError:
-            if generation_task.done():
-                break
-    
-    await generation_task
+    if session_key is not None:
+        active_jobs[session_key] = ("local", job_id)
+
+    async for kind, image, info in get_local_worker().generate(image_path, prompt, ratio, job_id=job_id):
+        if kind == "queued":
+            if info["jobs_ahead"]:
+                yield last_known_image, f"Status: Waiting for {info['jobs_ahead']} local job(s) ahead..."
+        elif kind == "started":
+            yield last_known_image, "Status: Local generation started..."
+        elif kind == "progress":
+            last_known_image = image.resize(display_size, Image.Resampling.LANCZOS)
+            yield last_known_image, f"Status: In progress... ({info['progress']}%)"
+        elif kind == "done":
+            yield image, "Status: Local generation complete!"
+        elif kind == "cancelled":
+            saved = 1 - info["steps_completed"] / info["total_steps"] if info.get("total_steps") else 1
+            yield last_known_image, (
+                f"Status: Local generation cancelled after {info['steps_completed']} steps, {saved:.0%} of the compute saved."
+            )
+        elif kind == "error":
+            yield None, f"Status: An error occurred during local generation: {info['message']}"
 
 
 # --- RunPod Inference ---
-async def runpod_generation_flow(image_path: str, prompt: str, ratio: str):
+transport = None
+
+def get_transport():
+    """Returns the transport shared by every generation, so they all reuse one connection pool."""
+    global transport
+    if transport is None:
+        transport = RunPodTransport(
+            RUNPOD_API_KEY, RUNPOD_ENDPOINT_ID, base_url=RUNPOD_API_BASE,
+            max_requests_per_second=RUNPOD_MAX_RPS, use_stream=RUNPOD_USE_STREAM,
+        )
+    return transport
+
+input_preparer = None
+
+def get_input_preparer():
+    global input_preparer
+    if input_preparer is None:
+        input_preparer = InputPreparer(
+            INPUT_FORMAT, INPUT_QUALITY, max_entries=INPUT_CACHE_MAX_ENTRIES, upload_url=INPUT_UPLOAD_URL,
+            endpoint_url=S3_ENDPOINT_URL, expires_in=INPUT_URL_EXPIRES_IN,
+        )
+    return input_preparer
+
+async def runpod_generation_flow(image_path: str, prompt: str, ratio: str, session_key: str = None):
     """Handles the image generation flow using the RunPod endpoint."""
     with Image.open(image_path) as img:
         display_size = resize_to_target_area(img, ratio)
@@ -129,75 +129,184 @@ async def runpod_generation_flow(image_path: str, prompt: str, ratio: str):
     last_known_image = None
     yield last_known_image, "Status: Starting..."
 
-    image_uri = image_to_base64_uri(image_path)
-    input_payload = {"image": image_uri, "prompt": prompt, "ratio": ratio.lower()}
-
-    async with aiohttp.ClientSession() as session:
-        try:
-            endpoint = AsyncioEndpoint(RUNPOD_ENDPOINT_ID, session)
-            job_request = endpoint.run(input_payload)
-            yield last_known_image, "Status: Job submitted. Waiting for processing..."
-            job: AsyncioJob = await job_request
-            
-            status_message = f"Status: Job {job.job_id} is in progress..."
-            yield last_known_image, status_message
-
-            last_progress = -1
-            while True:
-                status = await job.status()
-                
-                if status == "COMPLETED":
-                    output = await job.output()
+    try:
+        # Decoding, resizing and uploading are blocking, keep them off the event loop
+        prepared = await asyncio.to_thread(get_input_preparer().prepare, image_path)
+        input_payload = {"image": prepared.payload, "prompt": prompt, "ratio": ratio.lower()}
+        fallback = prepared.fallback
+
+        while input_payload is not None:
+            job_id = await get_transport().submit(input_payload)
+            if session_key is not None:
+                active_jobs[session_key] = ("runpod", job_id)
+            yield last_known_image, f"Status: Job {job_id} submitted ({prepared.describe()}). Waiting for processing..."
+
+            input_payload = None
+            async for update in get_transport().watch(job_id):
+                if fallback is not None and missed_reference(update):
+                    # The worker did not know the input, send the image itself
+                    input_payload = {"image": fallback, "prompt": prompt, "ratio": ratio.lower()}
+                    fallback = None
+                elif update.status == "COMPLETED":
+                    output = update.output
                     if output and "image" in output:
                         final_image = base64_to_pil(output["image"])
                         final_image.save("final_image.png")
-                        yield final_image, "Status: Generation complete!"
+                        yield final_image, f"Status: Generation complete! ({prepared.describe()})"
                     else:
                         error_detail = f"Output: {str(output)[:100]}..." if output else "No output."
                         yield None, f"Status: Job completed but no image in output. {error_detail}"
-                    break
-                elif status in ["FAILED", "CANCELLED"]:
-                    job_details = await job.error() or f"Job status was {status}"
+                elif update.status in ["FAILED", "CANCELLED", "TIMED_OUT"]:
+                    job_details = update.error or f"Job status was {update.status}"
+                    if isinstance(update.output, dict) and "cancelled" in update.output:
+                        job_details = describe_stopped(update.output["cancelled"])
                     yield last_known_image, f"Status: Job failed or was cancelled. Details: {job_details}"
-                    break
-                else:  # IN_QUEUE, IN_PROGRESS
-                    data = await job._fetch_job()
-                    if "output" in data and isinstance(data.get("output"), dict):
-                        stream_output = data["output"]
-                        progress = stream_output.get("progress")
-                        if progress is not None and progress > last_progress:
-                            last_progress = progress
-                            status_message = f"Status: In progress... ({progress}%)"
-                            
-                            if stream_output.get("image"):
-                                intermediate_pil = base64_to_pil(stream_output["image"])
-                                resized_intermediate = intermediate_pil.resize(display_size, Image.Resampling.LANCZOS)
-                                last_known_image = resized_intermediate
-                            
-                            yield last_known_image, status_message
-                    
-                    if status == "IN_PROGRESS":
-                        await asyncio.sleep(0.2)
-                    else:  # IN_QUEUE
-                        await asyncio.sleep(1)
-
-        except Exception as e:
-            yield last_known_image, f"Status: An error occurred: {e}"
+                elif update.progress is not None:
+                    # Only frames that changed since the last tick are decoded
+                    if update.preview:
+                        intermediate_pil = base64_to_pil(update.preview)
+                        last_known_image = intermediate_pil.resize(display_size, Image.Resampling.LANCZOS)
+                    yield last_known_image, f"Status: In progress... ({update.progress}%)"
+                elif update.status == "IN_PROGRESS":
+                    yield last_known_image, f"Status: Job {job_id} is in progress..."
+
+    except Exception as e:
+        yield last_known_image, f"Status: An error occurred: {e}"
+
+
+async def run_runpod_job(input_payload: dict, fallback: str = None) -> Image.Image:
+    """
+    Runs one job on the endpoint and returns its final image, without intermediate previews.
+    `fallback` is the image to send when the worker does not know the input reference in the payload.
+    """
+    job_id = await get_transport().submit(input_payload)
+    try:
+        async for update in get_transport().watch(job_id):
+            if fallback is not None and missed_reference(update):
+                break
+            if update.status == "COMPLETED":
+                if update.output and "image" in update.output:
+                    return base64_to_pil(update.output["image"])
+                raise RuntimeError(f"Job {job_id} completed but no image in output.")
+            if update.status in ["FAILED", "CANCELLED", "TIMED_OUT"]:
+                raise RuntimeError(update.error or f"Job {job_id} status was {update.status}")
+    except asyncio.CancelledError:
+        # Nobody will collect the result, so do not leave the endpoint working on it
+        await asyncio.shield(get_transport().cancel(job_id))
+        raise
+    return await run_runpod_job({**input_payload, "image": fallback})
+
+
+# --- Batch Experiments ---
+async def batch_generation_flow(execution_env: str, image_paths: list[str], prompts: list[str], ratios: list[str],
+                                max_in_flight: int):
+    """
+    Runs every (image, prompt, ratio) combination and yields the gallery as results finish.
+    Each input image is encoded once and shared by all jobs that use it.
+    """
+    combinations = list(itertools.product(image_paths, prompts, ratios))
+    if not combinations:
+        yield [], "Status: Add at least one image, prompt and ratio."
+        return
+
+    results = asyncio.Queue()
+
+    def caption(image_path, prompt, ratio):
+        return f"{os.path.basename(image_path)} | {ratio} | {prompt}"
+
+    if execution_env == "local":
+        # There is only one local pipeline, so combinations run one after another
+        async def run_all():
+            for image_path, prompt, ratio in combinations:
+                final_image, final_status = None, ""
+                try:
+                    async for final_image, final_status in local_generation_flow(image_path, prompt, ratio):
+                        pass
+                    error = None if "complete" in final_status.lower() else RuntimeError(final_status)
+                except Exception as e:
+                    error = e
+                await results.put((final_image, caption(image_path, prompt, ratio), error))
+
+        tasks = [asyncio.create_task(run_all())]
+    else:
+        prepared_inputs = {
+            image_path: await asyncio.to_thread(get_input_preparer().prepare, image_path) for image_path in image_paths
+        }
+        semaphore = asyncio.Semaphore(max(1, int(max_in_flight)))
+
+        async def run_one(image_path, prompt, ratio):
+            async with semaphore:
+                try:
+                    prepared = prepared_inputs[image_path]
+                    payload = {"image": prepared.payload, "prompt": prompt, "ratio": ratio.lower()}
+                    image = await run_runpod_job(payload, prepared.fallback)
+                    await results.put((image, caption(image_path, prompt, ratio), None))
+                except Exception as e:
+                    await results.put((None, caption(image_path, prompt, ratio), e))
+
+        tasks = [asyncio.create_task(run_one(*combination)) for combination in combinations]
+
+    gallery = []
+    failures = []
+    try:
+        status = f"Status: Submitted {len(combinations)} jobs..."
+        if execution_env != "local":
+            total_kb = sum(prepared.nbytes for prepared in prepared_inputs.values()) / 1024
+            encode_ms = sum(prepared.encode_ms for prepared in prepared_inputs.values())
+            status += f" ({len(prepared_inputs)} inputs, {total_kb:.0f} KB, encoded in {encode_ms:.0f} ms)"
+        yield gallery, status
+        for finished in range(1, len(combinations) + 1):
+            image, label, error = await results.get()
+            if error is None:
+                gallery.append((image, label))
+            else:
+                failures.append(f"{label}: {error}")
+            status = f"Status: {finished}/{len(combinations)} finished, {len(failures)} failed."
+            if finished == len(combinations):
+                status = f"Status: Batch complete! {len(gallery)} succeeded, {len(failures)} failed."
+                if failures:
+                    status += " " + " / ".join(failures[:3])
+            yield list(gallery), status
+    finally:
+        # Stop outstanding jobs if the UI stops listening
+        for task in tasks:
+            task.cancel()
 
 
 # --- Main Dispatcher ---
-async def generate(execution_env: str, image_path: str, prompt: str, ratio: str):
+async def generate(execution_env: str, image_path: str, prompt: str, ratio: str, session_key: str = None):
     """
     Main dispatcher function to handle image generation.
     It calls the appropriate generation flow based on the selected environment.
+    While it runs, `cancel_generation(session_key)` stops the job.
     """
     if not image_path:
         yield None, "Status: Please upload an image to generate."
         return
 
-    if execution_env == "local":
-        async for result in local_generation_flow(image_path, prompt, ratio):
-            yield result
-    else: # runpod
-        async for result in runpod_generation_flow(image_path, prompt, ratio):
-            yield result 
\ No newline at end of file
+    try:
+        if execution_env == "local":
+            async for result in local_generation_flow(image_path, prompt, ratio, session_key):
+                yield result
+        else: # runpod
+            async for result in runpod_generation_flow(image_path, prompt, ratio, session_key):
+                yield result
+    finally:
+        active_jobs.pop(session_key, None)
+
+
+async def cancel_generation(session_key: str) -> str:
+    """Cancels the job the session is running. The generation flow reports the outcome."""
+    job = active_jobs.get(session_key)
+    if job is None:
+        return "Status: Nothing to cancel."
+
+    execution_env, job_id = job
+    try:
+        if execution_env == "local":
+            get_local_worker().cancel(job_id)
+        else:
+            await get_transport().cancel(job_id)
+    except Exception as e:
+        return f"Status: Could not cancel job {job_id}: {e}"
+    return f"Status: Cancelling job {job_id}..." 
\ No newline at end of file
@@ -0,0 +1,133 @@
+import base64
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from PIL import Image, ImageOps
+
+from utils import resize_to_target_area
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+MIME_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+
+
+class PreparedInput:
+    def __init__(self, payload, nbytes, size, encode_ms, cached, fallback=None):
+        # Data URI, presigned URL when inputs are uploaded, or "sha256:" reference to a data URI sent before
+        self.payload = payload
+        self.nbytes = nbytes
+        self.size = size
+        self.encode_ms = encode_ms
+        self.cached = cached
+        # For a reference, the data URI to send instead when the worker does not know it
+        self.fallback = fallback
+
+    def describe(self):
+        """Short summary for the status line."""
+        source = "cached" if self.cached else f"encoded in {self.encode_ms:.0f} ms"
+        if self.fallback is not None:
+            kind = "reference"
+        else:
+            kind = "URL" if self.payload.startswith(("http://", "https://")) else "inline"
+        return f"input {self.size[0]}x{self.size[1]}, {self.nbytes / 1024:.0f} KB {kind}, {source}"
+
+
+class InputPreparer:
+    """
+    Turns an uploaded file into the smallest input the endpoint can use.
+
+    The server conditions on the input resized to its aspect ratio's bucket, so the
+    client sends it at that size (never upscaled), re-encoded as WebP, instead of the
+    original file. Results are remembered by content hash, so a repeated image is not
+    decoded or encoded again. A repeat is sent as "sha256:<hash of the data URI>", which the
+    worker resolves from its input cache; when it does not know the hash, the job fails with
+    `SourceNotCached` and the data URI in `fallback` has to be sent instead. With `upload_url`
+    ("s3://bucket/prefix/"), the prepared image is uploaded once and sent as a presigned URL
+    from then on.
+    """
+
+    def __init__(self, output_format="webp", quality=90, max_entries=64, upload_url=None, endpoint_url=None,
+                 expires_in=3600):
+        self.output_format = output_format
+        self.quality = quality
+        self.max_entries = max_entries
+        self.expires_in = expires_in
+        self._entries = OrderedDict()  # content hash -> (PreparedInput, expires_at, reference)
+        self._lock = threading.Lock()
+
+        self._bucket = None
+        if upload_url:
+            parsed = urlparse(upload_url)
+            if parsed.scheme != "s3":
+                raise ValueError(f"Unsupported input upload URL: {upload_url}. Expected 's3://'.")
+            if boto3 is None:
+                raise RuntimeError("boto3 is required for s3:// input uploads.")
+            self._bucket = parsed.netloc
+            self._prefix = parsed.path.lstrip("/")
+            if self._prefix and not self._prefix.endswith("/"):
+                self._prefix += "/"
+            self._client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _encode(self, data):
+        with Image.open(io.BytesIO(data)) as img:
+            image = ImageOps.exif_transpose(img).convert("RGB")
+
+        bucket = resize_to_target_area(image, "original")
+        if image.width * image.height > bucket[0] * bucket[1]:
+            image = image.resize(bucket, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format=self.output_format.upper(), quality=self.quality, method=4)
+        return buffer.getvalue(), image.size
+
+    def _upload(self, content_hash, encoded):
+        key = f"{self._prefix}{content_hash}.{self.output_format}"
+        self._client.put_object(
+            Bucket=self._bucket, Key=key, Body=encoded, ContentType=MIME_TYPES[self.output_format]
+        )
+        return self._client.generate_presigned_url(
+            "get_object", Params={"Bucket": self._bucket, "Key": key}, ExpiresIn=self.expires_in
+        )
+
+    def prepare(self, image_path):
+        with open(image_path, "rb") as f:
+            data = f.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+
+        with self._lock:
+            entry = self._entries.get(content_hash)
+            if entry is not None and entry[1] > time.time():
+                self._entries.move_to_end(content_hash)
+                prepared, _, reference = entry
+                if reference is None:
+                    return PreparedInput(prepared.payload, prepared.nbytes, prepared.size, 0.0, cached=True)
+                return PreparedInput(reference, len(reference), prepared.size, 0.0, cached=True,
+                                     fallback=prepared.payload)
+
+        start = time.perf_counter()
+        encoded, size = self._encode(data)
+        if self._bucket is not None:
+            payload = self._upload(content_hash, encoded)
+            # Stop reusing a presigned URL well before it expires, the job may sit in the queue
+            expires_at = time.time() + self.expires_in / 2
+            reference = None
+        else:
+            payload = f"data:{MIME_TYPES[self.output_format]};base64,{base64.b64encode(encoded).decode('utf-8')}"
+            expires_at = float("inf")
+            # The worker keys its input cache by the hash of the string it received
+            reference = "sha256:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        encode_ms = (time.perf_counter() - start) * 1000
+
+        prepared = PreparedInput(payload, len(payload), size, encode_ms, cached=False)
+        with self._lock:
+            self._entries[content_hash] = (prepared, expires_at, reference)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return prepared
@@ -0,0 +1,341 @@
+import asyncio
+import collections
+import importlib
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import traceback
+import uuid
+from multiprocessing import shared_memory
+
+from PIL import Image, ImageOps
+
+from config import (
+    LATENT_RGB_FACTORS,
+    LOCAL_FRAME_SLOTS,
+    LOCAL_MODEL_OFFLOAD_MIN_GB,
+    LOCAL_OFFLOAD_STRATEGY,
+    LOCAL_PIPELINE_FACTORY,
+    LOCAL_RESIDENT_MIN_GB,
+    PREFERED_KONTEXT_RESOLUTIONS,
+)
+from utils import resize_to_target_area
+
+# preview.py at the repository root, shared with the serverless worker, is the only copy of the renderer.
+# Appended, so this app's own config and utils modules still win over the root ones of the same name
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Largest RGB frame the worker can send back: a generated image at the biggest bucket
+FRAME_SLOT_BYTES = max(width * height for width, height in PREFERED_KONTEXT_RESOLUTIONS) * 3
+# How often the UI process checks that the worker process is still alive while no events arrive
+LIVENESS_CHECK_S = 1.0
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# --- Worker Process ---
+def choose_offload_strategy():
+    """Picks how much of the pipeline stays on the GPU from the memory that is currently free."""
+    if LOCAL_OFFLOAD_STRATEGY != "auto":
+        return LOCAL_OFFLOAD_STRATEGY
+
+    import torch
+
+    free_bytes, _ = torch.cuda.mem_get_info()
+    free_gb = free_bytes / 1024 ** 3
+    if free_gb >= LOCAL_RESIDENT_MIN_GB:
+        return "none"
+    if free_gb >= LOCAL_MODEL_OFFLOAD_MIN_GB:
+        return "model"
+    return "sequential"
+
+
+def load_flux_pipeline():
+    """Default pipeline factory, run inside the worker process."""
+    import torch
+    from diffusers import FluxKontextPipeline
+    from nunchaku import NunchakuFluxTransformer2dModel
+    from nunchaku.utils import get_precision
+
+    transformer = NunchakuFluxTransformer2dModel.from_pretrained(
+        f"mit-han-lab/nunchaku-flux.1-kontext-dev/svdq-{get_precision()}_r32-flux.1-kontext-dev.safetensors"
+    )
+    pipeline = FluxKontextPipeline.from_pretrained(
+        "black-forest-labs/FLUX.1-Kontext-dev", transformer=transformer, torch_dtype=torch.bfloat16
+    )
+
+    strategy = choose_offload_strategy()
+    if strategy == "none":
+        pipeline.to("cuda")
+    elif strategy == "model":
+        pipeline.enable_model_cpu_offload()
+    else:
+        pipeline.enable_sequential_cpu_offload()
+    print(f"Local pipeline initialized with offload strategy '{strategy}'.")
+    return pipeline
+
+
+def _load_factory(path):
+    module_name, function_name = path.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+class _WorkerState:
+    """The worker's side of the queues and frame slots."""
+
+    def __init__(self, events, cancels, free_slots, slot_names):
+        self.events = events
+        self.cancels = cancels
+        self.free_slots = free_slots
+        self.slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+        self.cancelled = set()
+        self.finished = collections.deque(maxlen=64)
+
+    def is_cancelled(self, job_id):
+        while True:
+            try:
+                cancelled_id = self.cancels.get_nowait()
+            except queue.Empty:
+                break
+            # A cancel can cross paths with its job finishing, it must not linger after that
+            if cancelled_id not in self.finished:
+                self.cancelled.add(cancelled_id)
+        return job_id in self.cancelled
+
+    def finish(self, job_id):
+        self.cancelled.discard(job_id)
+        self.finished.append(job_id)
+
+    def send(self, job_id, kind, image=None, **info):
+        """Writes `image` into a free frame slot and tells the UI process about it. Previews are dropped if none is free."""
+        slot = None
+        if image is not None:
+            try:
+                # Final images wait for a slot, previews are not worth waiting for
+                slot = self.free_slots.get(timeout=None if kind == "done" else 0)
+            except queue.Empty:
+                return
+            image = image.convert("RGB")
+            data = image.tobytes()
+            self.slots[slot].buf[:len(data)] = data
+            info["size"] = image.size
+        self.events.put((job_id, kind, slot, info))
+
+
+def worker_main(factory_path, requests, events, cancels, free_slots, slot_names):
+    """Serves generation requests one at a time, in the order they were submitted."""
+    state = _WorkerState(events, cancels, free_slots, slot_names)
+
+    try:
+        pipeline = _load_factory(factory_path)()
+        load_error = None
+    except Exception as e:
+        traceback.print_exc()
+        pipeline, load_error = None, f"Local pipeline initialization failed: {e}"
+
+    from preview import PreviewEngine
+    preview_engine = PreviewEngine(LATENT_RGB_FACTORS)
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        job_id = request["job_id"]
+        if load_error is not None:
+            state.send(job_id, "error", message=load_error)
+            state.finish(job_id)
+            continue
+        if state.is_cancelled(job_id):
+            state.send(job_id, "cancelled", steps_completed=0)
+            state.finish(job_id)
+            continue
+
+        state.send(job_id, "started")
+        steps = {"steps_completed": 0, "total_steps": None}
+        try:
+            with Image.open(request["image_path"]) as img:
+                input_image = ImageOps.exif_transpose(img).convert("RGB")
+            width, height = resize_to_target_area(input_image, request["ratio"])
+            preview_session = preview_engine.session()
+
+            def deliver_preview(pil_image, progress):
+                state.send(job_id, "progress", pil_image, progress=progress)
+
+            def on_step_end_callback(pipe, step, timestep, callback_kwargs):
+                total_steps = len(pipe.scheduler.timesteps)
+                steps.update(steps_completed=step + 1, total_steps=total_steps)
+                if state.is_cancelled(job_id):
+                    raise JobCancelled()
+
+                if preview_session.due(step, total_steps):
+                    latents = callback_kwargs["latents"]
+                    unpacked_latents = pipe._unpack_latents(latents, height, width, pipe.vae_scale_factor)
+                    preview_session.send(unpacked_latents, [deliver_preview], step, total_steps)
+                return callback_kwargs
+
+            generated_image = pipeline(
+                image=input_image, prompt=request["prompt"], width=width, height=height, guidance_scale=2.5,
+                callback_on_step_end=on_step_end_callback, callback_on_step_end_tensor_inputs=["latents"]
+            ).images[0]
+
+            # Late previews must not overwrite the final image
+            preview_engine.flush()
+            state.send(job_id, "done", generated_image)
+
+        except JobCancelled:
+            preview_engine.flush()
+            state.send(job_id, "cancelled", **steps)
+        except Exception as e:
+            traceback.print_exc()
+            preview_engine.flush()
+            state.send(job_id, "error", message=str(e))
+        finally:
+            state.finish(job_id)
+
+    for slot in state.slots:
+        slot.close()
+
+
+# --- UI Process ---
+class LocalWorker:
+    """
+    Owns the process that runs the local pipeline on behalf of the UI.
+
+    Requests are served one at a time in submission order, so concurrent clicks queue up
+    instead of sharing one pipeline object. Preview and final frames come back as raw RGB
+    in a small ring of shared memory slots rather than as pickled PIL images; a reader
+    thread copies each frame out, returns its slot and hands the update to the asyncio
+    loop that is waiting for it. If the process dies, that thread fails every job it still
+    owed an outcome, and the next job starts a new process.
+    """
+
+    def __init__(self, factory_path=LOCAL_PIPELINE_FACTORY, frame_slots=LOCAL_FRAME_SLOTS):
+        self.factory_path = factory_path
+        self.frame_slots = frame_slots
+        self._process = None
+        self._jobs = {}  # job_id -> (loop, asyncio.Queue)
+        self._queued = []  # job ids the worker has not finished yet, in order
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._process is not None:
+            if self._process.is_alive():
+                return
+            # Died since the last job, fail what it still owed before starting over
+            self._process_exited(self._process, self._slots)
+
+        context = multiprocessing.get_context("spawn")
+        self._slots = [shared_memory.SharedMemory(create=True, size=FRAME_SLOT_BYTES) for _ in range(self.frame_slots)]
+        self._requests = context.Queue()
+        self._events = context.Queue()
+        self._cancels = context.Queue()
+        self._free_slots = context.Queue()
+        for index in range(self.frame_slots):
+            self._free_slots.put(index)
+
+        self._process = context.Process(
+            target=worker_main, name="local-inference-worker", daemon=True,
+            args=(self.factory_path, self._requests, self._events, self._cancels, self._free_slots,
+                  [slot.name for slot in self._slots]),
+        )
+        self._process.start()
+        threading.Thread(
+            target=self._read_events, name="local-worker-events", daemon=True,
+            args=(self._process, self._events, self._free_slots, self._slots),
+        ).start()
+
+    def _read_events(self, process, events, free_slots, slots):
+        while True:
+            try:
+                job_id, kind, slot, info = events.get(timeout=LIVENESS_CHECK_S)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                self._process_exited(process, slots)
+                return
+
+            image = None
+            if slot is not None:
+                width, height = info["size"]
+                with slots[slot].buf[:width * height * 3] as view:
+                    image = Image.frombytes("RGB", (width, height), view)
+                free_slots.put(slot)
+
+            with self._lock:
+                if kind in ("done", "error", "cancelled") and job_id in self._queued:
+                    self._queued.remove(job_id)
+                waiter = self._jobs.get(job_id)
+            if waiter is not None:
+                loop, updates = waiter
+                loop.call_soon_threadsafe(updates.put_nowait, (kind, image, info))
+
+    def _process_exited(self, process, slots):
+        """Fails the jobs a dead worker process still owed an outcome. Only the first caller for `process` does anything."""
+        with self._lock:
+            if self._process is not process:
+                # Shut down by stop(), or already handled
+                return
+            self._process = None
+            outstanding = [self._jobs[job_id] for job_id in self._queued if job_id in self._jobs]
+            self._queued.clear()
+
+        info = {"message": f"Local worker process exited unexpectedly (exit code {process.exitcode})."}
+        for loop, updates in outstanding:
+            loop.call_soon_threadsafe(updates.put_nowait, ("error", None, info))
+        for slot in slots:
+            slot.close()
+            slot.unlink()
+
+    def jobs_ahead(self, job_id):
+        with self._lock:
+            return self._queued.index(job_id) if job_id in self._queued else 0
+
+    async def generate(self, image_path, prompt, ratio, job_id=None):
+        """Yields (kind, image, info) updates for one job, ending with "done", "error" or "cancelled"."""
+        self.start()
+        job_id = job_id or uuid.uuid4().hex
+        updates = asyncio.Queue()
+
+        with self._lock:
+            self._jobs[job_id] = (asyncio.get_running_loop(), updates)
+            self._queued.append(job_id)
+        self._requests.put({"job_id": job_id, "image_path": image_path, "prompt": prompt, "ratio": ratio})
+
+        finished = False
+        try:
+            yield "queued", None, {"jobs_ahead": self.jobs_ahead(job_id)}
+            while True:
+                kind, image, info = await updates.get()
+                finished = kind in ("done", "error", "cancelled")
+                yield kind, image, info
+                if finished:
+                    return
+        finally:
+            if not finished:
+                # Nobody is listening anymore, so free the worker for the next job
+                self.cancel(job_id)
+            with self._lock:
+                self._jobs.pop(job_id, None)
+
+    def cancel(self, job_id):
+        with self._lock:
+            if job_id not in self._queued:
+                # Finished already, or never submitted, the worker would hold on to the id for nothing
+                return
+        self._cancels.put(job_id)
+
+    def stop(self):
+        with self._lock:
+            process, self._process = self._process, None
+        if process is None:
+            return
+        self._requests.put(None)
+        process.join(timeout=10)
+        for slot in self._slots:
+            slot.close()
+            slot.unlink()
@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import aiohttp
+
+TERMINAL_STATUSES = ("COMPLETED", "FAILED", "CANCELLED", "TIMED_OUT")
+
+
+class RateLimiter:
+    """Spaces out requests so their total rate stays under `max_per_second`."""
+
+    def __init__(self, max_per_second):
+        self.interval = 1 / max_per_second
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class JobUpdate:
+    def __init__(self, status, progress=None, preview=None, output=None, error=None):
+        self.status = status
+        self.progress = progress
+        # Base64 preview frame, only set when it differs from the last one delivered
+        self.preview = preview
+        self.output = output
+        self.error = error
+
+
+def job_result(output):
+    """The handler's result from a job's output, which is the list of what it yielded for streaming handlers."""
+    if isinstance(output, list):
+        return output[-1] if output else None
+    return output
+
+
+class RunPodTransport:
+    """
+    One pooled HTTP session shared by every generation in the UI.
+
+    Each watched job costs a single `/status` request per tick. Ticks back off while nothing
+    changes, and all jobs share one rate limiter, so driving many jobs from one event
+    loop does not multiply the request rate. With `use_stream`, `/stream` is long-polled
+    instead, for workers started with STREAM_PROGRESS, which yield their progress.
+    """
+
+    def __init__(self, api_key, endpoint_id, base_url="https://api.runpod.ai/v2", max_requests_per_second=10,
+                 use_stream=False):
+        self.api_key = api_key
+        self.endpoint_url = f"{base_url.rstrip('/')}/{endpoint_id}"
+        self.use_stream = use_stream
+        self.limiter = RateLimiter(max_requests_per_second)
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                connector=aiohttp.TCPConnector(limit=16, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=60),
+            )
+        return self._session
+
+    async def _request(self, method, path, **kwargs):
+        await self.limiter.wait()
+        async with self._get_session().request(method, f"{self.endpoint_url}/{path}", **kwargs) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def submit(self, payload):
+        """Queues a job and returns its id."""
+        data = await self._request("POST", "run", json={"input": payload})
+        return data["id"]
+
+    async def cancel(self, job_id):
+        return await self._request("POST", f"cancel/{job_id}")
+
+    async def watch(self, job_id, min_interval=0.2, max_interval=2.0, queued_interval=1.0, max_queued_interval=5.0):
+        """Yields a JobUpdate whenever the job's status, progress or preview changes, ending on a terminal status."""
+        if self.use_stream:
+            async for update in self._watch_stream(job_id, queued_interval, max_queued_interval):
+                yield update
+            return
+
+        last_status, last_progress, last_preview = None, None, None
+        interval = min_interval
+
+        while True:
+            data = await self._request("GET", f"status/{job_id}")
+            status = data.get("status")
+
+            if status in TERMINAL_STATUSES:
+                yield JobUpdate(status, output=job_result(data.get("output")), error=data.get("error"))
+                return
+
+            output = data.get("output") if isinstance(data.get("output"), dict) else {}
+            progress = output.get("progress")
+            preview = output.get("image")
+
+            changed = status != last_status or progress != last_progress or preview != last_preview
+            if changed:
+                yield JobUpdate(status, progress=progress, preview=preview if preview != last_preview else None)
+                last_status, last_progress, last_preview = status, progress, preview
+
+            # Poll quickly while things change, back off while they do not
+            if status == "IN_QUEUE":
+                interval = queued_interval if changed else min(interval * 1.5, max_queued_interval)
+            else:
+                interval = min_interval if changed else min(interval * 1.5, max_interval)
+            await asyncio.sleep(interval)
+
+    async def _watch_stream(self, job_id, queued_interval, max_queued_interval):
+        last_preview, result = None, None
+        interval = queued_interval
+        while True:
+            data = await self._request("GET", f"stream/{job_id}")
+            chunks = data.get("stream") or []
+            for chunk in chunks:
+                output = chunk.get("output")
+                if isinstance(output, dict) and "progress" in output:
+                    preview = output.get("image")
+                    yield JobUpdate("IN_PROGRESS", progress=output["progress"],
+                                    preview=preview if preview != last_preview else None)
+                    last_preview = preview or last_preview
+                elif output is not None:
+                    # The result, or the details of a failure, whose message only /status has
+                    result = output
+
+            status = data.get("status")
+            if status in TERMINAL_STATUSES:
+                final = await self._request("GET", f"status/{job_id}")
+                output = job_result(final.get("output"))
+                yield JobUpdate(final.get("status"), output=output if output is not None else result,
+                                error=final.get("error"))
+                return
+
+            # /stream answers right away while the job is queued, so back off like `watch` does
+            if status == "IN_QUEUE" and not chunks:
+                await asyncio.sleep(interval)
+                interval = min(interval * 1.5, max_queued_interval)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
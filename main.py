@@ -1,14 +1,119 @@
+import asyncio
+import copy
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 from PIL import Image
 import torch
 import runpod
 from runpod.serverless.utils.rp_validator import validate
-from diffusers import FluxKontextPipeline
-from diffusers.utils import load_image
-from nunchaku import NunchakuFluxTransformer2dModel
-from nunchaku.utils import get_precision
+from config import (
+    MAX_CONCURRENCY,
+    MAX_BATCH_SIZE,
+    MAX_BATCH_WAIT_MS,
+    ADAPTER_AFFINITY_MAX_WAIT_MS,
+    ADMISSION_CONTROL,
+    ADMISSION_MEMORY_BUDGET_BYTES,
+    ADMISSION_MEMORY_FRACTION,
+    ADMISSION_PRIOR_FIXED_BYTES,
+    ADMISSION_PRIOR_BYTES_PER_PIXEL,
+    ADMISSION_MARGIN,
+    ADMISSION_MIN_SAMPLES,
+    ADMISSION_MAX_DELAY_MS,
+    ADMISSION_RETRY_MS,
+    ADMISSION_STATE_FILE,
+    LORA_DIR,
+    LORA_CACHE_MAX_ENTRIES,
+    LORA_CACHE_MAX_BYTES,
+    PROMPT_CACHE_MAX_ENTRIES,
+    PROMPT_CACHE_MAX_BYTES,
+    IMAGE_CACHE_MAX_ENTRIES,
+    IMAGE_CACHE_MAX_BYTES,
+    IMAGE_CACHE_DIR,
+    IMAGE_CACHE_DISK_MAX_BYTES,
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_MAX_BYTES,
+    WARMUP_BUCKETS,
+    WARMUP_STEPS,
+    COMPILE,
+    COMPILE_MODE,
+    COMPILE_CACHE_DIR,
+    COMPILE_PREWARM_BUCKETS,
+    QUALITY_PRESETS,
+    DEFAULT_QUALITY,
+    MAX_NUM_OUTPUTS,
+    MAX_OUTPUT_SCALE,
+    DECODE_TILE_SIZE,
+    DECODE_TILE_MIN_LATENT,
+    ENCODE_QUEUE_STRIPS,
+    PREVIEW_SIZE,
+    PREVIEW_EVERY_N_STEPS,
+    PREVIEW_MIN_INTERVAL_MS,
+    STREAM_PROGRESS,
+    OUTPUT_BUCKET_URL,
+    S3_ENDPOINT_URL,
+    OUTPUT_URL_EXPIRES_IN,
+    FETCH_MAX_BYTES,
+    FETCH_CONNECT_TIMEOUT,
+    FETCH_READ_TIMEOUT,
+    FETCH_POOL_SIZE,
+    FETCH_CACHE_DIR,
+    FETCH_CACHE_MAX_BYTES,
+    INPUT_MAX_PIXELS,
+    METRICS_FILE,
+    METRICS_DUMP_INTERVAL_S,
+    METRICS_PORT,
+    CANCEL_POLL_INTERVAL_S,
+    RUNPOD_API_BASE,
+    RUNPOD_ENDPOINT_ID,
+    RUNPOD_API_KEY,
+)
+from admission import (
+    AdmissionController,
+    AdmissionRejected,
+    memory_in_use,
+    memory_total,
+    peak_memory_bytes,
+    reset_peak_memory,
+)
+from adapters import ADAPTER_NAME, AdapterManager, UnknownAdapter
+from compile_cache import CompileCache
+from cache import (
+    PromptEmbeddingCache,
+    ConditioningImageCache,
+    ResultCache,
+    RequestCoalescer,
+    SourceNotCached,
+    hash_image_pixels,
+    is_source_ref,
+    normalize_prompt,
+)
+from encoders import (
+    OUTPUT_FORMATS,
+    OUTPUT_DELIVERIES,
+    MIME_TYPES,
+    FILE_EXTENSIONS,
+    EncodedImage,
+    RowEncoder,
+    encode_image,
+    make_row_writer,
+    buffer_to_base64,
+    make_uploader,
+)
+from fetcher import ImageFetcher
+from metrics import BYTES_BUCKETS, JobTrace, registry
+from preprocess import prepare_input_image
+from preview import PreviewEngine
+from residual_cache import enable_residual_cache
+from tiled_decode import TiledDecoder
+from scheduler import BatchScheduler, CancellationToken, JobCancelled
 from utils import (
     LATENT_RGB_FACTORS,
-    resize_to_target_area,
+    PREFERED_KONTEXT_RESOLUTIONS,
+    bucket_for_size,
     encode_image_to_base64,
     decode_base64_to_image,
 )
@@ -26,96 +131,949 @@ schema = {
         "type": str,
         "required": True,
     },
+    "seed": {
+        "type": int,
+        "required": False,
+        "default": None,
+    },
+    "output_format": {
+        "type": str,
+        "required": False,
+        "default": "png",
+        "constraints": lambda output_format: output_format in OUTPUT_FORMATS,
+    },
+    "output_quality": {
+        "type": int,
+        "required": False,
+        "default": 90,
+        "constraints": lambda output_quality: 1 <= output_quality <= 100,
+    },
+    "png_compress_level": {
+        "type": int,
+        "required": False,
+        "default": 6,
+        "constraints": lambda png_compress_level: 0 <= png_compress_level <= 9,
+    },
+    "output_delivery": {
+        "type": str,
+        "required": False,
+        "default": "inline",
+        "constraints": lambda output_delivery: output_delivery in OUTPUT_DELIVERIES,
+    },
+    "output_scale": {
+        "type": int,
+        "required": False,
+        "default": None,
+        "constraints": lambda output_scale: 1 <= output_scale <= MAX_OUTPUT_SCALE,
+    },
+    "num_outputs": {
+        "type": int,
+        "required": False,
+        "default": None,
+        "constraints": lambda num_outputs: 1 <= num_outputs <= MAX_NUM_OUTPUTS,
+    },
+    "seeds": {
+        "type": list,
+        "required": False,
+        "default": None,
+        "constraints": lambda seeds: 1 <= len(seeds) <= MAX_NUM_OUTPUTS and all(
+            isinstance(seed, int) for seed in seeds
+        ),
+    },
+    "lora": {
+        "type": str,
+        "required": False,
+        "default": None,
+        "constraints": lambda lora: ADAPTER_NAME.match(lora) is not None,
+    },
+    "lora_scale": {
+        "type": float,
+        "required": False,
+        "default": 1.0,
+        "constraints": lambda lora_scale: 0 <= lora_scale <= 2,
+    },
+    "quality": {
+        "type": str,
+        "required": False,
+        "default": DEFAULT_QUALITY,
+        "constraints": lambda quality: quality in QUALITY_PRESETS,
+    },
+    "deadline_ms": {
+        "type": int,
+        "required": False,
+        "default": None,
+        "constraints": lambda deadline_ms: deadline_ms > 0,
+    },
 }
 
-def load_model():
-    transformer = NunchakuFluxTransformer2dModel.from_pretrained(
-    f"mit-han-lab/nunchaku-flux.1-kontext-dev/svdq-{get_precision()}_r32-flux.1-kontext-dev.safetensors"
-    )
+# rp_validator skips the constraints of a value that has its default's type, so these run again
+# in the handler; otherwise e.g. "output_format": "gif" would only fail after generating
+RECHECKED_CONSTRAINTS = ("output_format", "output_quality", "png_compress_level", "output_delivery", "quality",
+                         "lora_scale")
+
+def check_constraints(validated_input, keys=RECHECKED_CONSTRAINTS):
+    """Returns the validator's error messages for the `keys` whose schema constraints do not hold."""
+    return [
+        f"{key} does not meet the constraints."
+        for key in keys
+        if validated_input.get(key) is not None and not schema[key]["constraints"](validated_input[key])
+    ]
+
+GUIDANCE_SCALE = 2.5
+
+MODEL_ID = "black-forest-labs/FLUX.1-Kontext-dev"
 
-    pipeline = FluxKontextPipeline.from_pretrained(
-        "black-forest-labs/FLUX.1-Kontext-dev", transformer=transformer, torch_dtype=torch.bfloat16
-    ).to("cuda")
+# Set once the model is loaded and warm, the worker does not take jobs before that
+ready = threading.Event()
+startup_report = {}
+
+# Set up before anything is compiled so inductor writes to the shared cache directory
+compile_cache = CompileCache(COMPILE_CACHE_DIR, mode=COMPILE_MODE) if COMPILE else None
+
+def _timed(timings, name, fn):
+    start = time.perf_counter()
+    value = fn()
+    timings[name] = round((time.perf_counter() - start) * 1000, 1)
+    return value
+
+def load_model(timings=None):
+    # Imported here so the handler can be driven with a stub pipeline on machines without them
+    from diffusers import FluxKontextPipeline, AutoencoderKL
+    from nunchaku import NunchakuFluxTransformer2dModel
+    from nunchaku.utils import get_precision
+    from transformers import CLIPTextModel, T5EncoderModel
+
+    timings = {} if timings is None else timings
+
+    # The components are independent, so they are read from the HF cache and moved to the GPU in parallel
+    loaders = {
+        "transformer": lambda: NunchakuFluxTransformer2dModel.from_pretrained(
+            f"mit-han-lab/nunchaku-flux.1-kontext-dev/svdq-{get_precision()}_r32-flux.1-kontext-dev.safetensors"
+        ).to("cuda"),
+        "text_encoder": lambda: CLIPTextModel.from_pretrained(
+            MODEL_ID, subfolder="text_encoder", torch_dtype=torch.bfloat16
+        ).to("cuda"),
+        "text_encoder_2": lambda: T5EncoderModel.from_pretrained(
+            MODEL_ID, subfolder="text_encoder_2", torch_dtype=torch.bfloat16
+        ).to("cuda"),
+        "vae": lambda: AutoencoderKL.from_pretrained(
+            MODEL_ID, subfolder="vae", torch_dtype=torch.bfloat16
+        ).to("cuda"),
+    }
+    with ThreadPoolExecutor(max_workers=len(loaders)) as executor:
+        futures = {
+            name: executor.submit(_timed, timings, f"load_{name}", loader) for name, loader in loaders.items()
+        }
+        components = {name: future.result() for name, future in futures.items()}
+
+    # Only the tokenizers and the scheduler are left to load here
+    pipeline = _timed(timings, "assemble_pipeline", lambda: FluxKontextPipeline.from_pretrained(
+        MODEL_ID, torch_dtype=torch.bfloat16, **components
+    ).to("cuda"))
+
+    # Installed before compiling, so the graphs warmup compiles are the ones jobs run
+    get_residual_cache(pipeline)
+    if compile_cache is not None:
+        # Only wraps the modules, each bucket compiles (or loads from the cache) on its first call
+        _timed(timings, "compile_setup", lambda: compile_cache.compile_pipeline(pipeline))
 
     return pipeline
 
-def handler(event):
+def warmup(pipeline, buckets, steps, timings):
+    """Runs a tiny generation per bucket so kernel selection and allocator growth happen before the first job."""
+    residual_cache = get_residual_cache(pipeline)
+    # Compiled graphs differ with the cache on and off, and on whether a step was skipped. An infinite
+    # threshold computes the first step and skips the next, so with 2+ steps both branches get compiled.
+    # The cached variant goes first: compiled the other way round, the first uncached job still recompiles
+    variants = {"": 0.0}
+    if residual_cache is not None and compile_cache is not None:
+        variants = {"_cached": float("inf"), **variants}
+
+    for width, height in buckets:
+        image = Image.new("RGB", (width, height))
+        run = lambda: pipeline(
+            image=image, prompt="", width=width, height=height,
+            guidance_scale=GUIDANCE_SCALE, num_inference_steps=steps,
+        )
+        for suffix, threshold in variants.items():
+            if residual_cache is not None:
+                residual_cache.reset(threshold)
+            if compile_cache is None:
+                _timed(timings, f"warmup_{width}x{height}{suffix}", run)
+            else:
+                _, report = _timed(timings, f"warmup_{width}x{height}{suffix}", lambda: compile_cache.run(
+                    ("warmup", width, height, threshold), run
+                ))
+                timings[f"compile_{width}x{height}{suffix}"] = report["compile_ms"]
+
+def prewarm_buckets():
+    """The warmup buckets, plus the ones COMPILE_PREWARM_BUCKETS asks to have compiled before taking jobs."""
+    buckets = list(WARMUP_BUCKETS)
+    if compile_cache is None or not COMPILE_PREWARM_BUCKETS.strip():
+        return buckets
+    if COMPILE_PREWARM_BUCKETS.strip() == "all":
+        extra = PREFERED_KONTEXT_RESOLUTIONS
+    else:
+        extra = [
+            tuple(int(side) for side in bucket.split("x"))
+            for bucket in COMPILE_PREWARM_BUCKETS.split(",") if bucket.strip()
+        ]
+    return buckets + [tuple(bucket) for bucket in extra if tuple(bucket) not in buckets]
+
+def startup():
+    """Loads and warms the model before the worker starts polling for jobs."""
+    global model
+
+    start = time.perf_counter()
+    timings = {}
+
+    _timed(timings, "cuda_init", torch.cuda.init)
+    model = _timed(timings, "load_model", lambda: load_model(timings))
+    _timed(timings, "warmup", lambda: warmup(model, prewarm_buckets(), WARMUP_STEPS, timings))
+    timings["total"] = round((time.perf_counter() - start) * 1000, 1)
+
+    startup_report.update(timings)
+    if ADMISSION_CONTROL:
+        startup_report["admission"] = get_admission().report()
+    if compile_cache is not None:
+        startup_report["compile"] = compile_cache.stats()
+        print(f"Compile cache: {json.dumps(startup_report['compile'])}")
+    if CANCEL_POLL_INTERVAL_S > 0 and not (RUNPOD_ENDPOINT_ID and RUNPOD_API_KEY):
+        print("Cancellation polling is off without RUNPOD_ENDPOINT_ID and an API key, only deadline_ms stops jobs early.")
+    ready.set()
+    print(f"Cold start timings (ms): {json.dumps(timings)}")
+
+def get_residual_cache(pipeline):
+    global residual_cache
+
+    if "residual_cache" not in globals():
+        transformer = getattr(pipeline, "transformer", None)
+        # Nothing to install when no preset ever skips blocks. The benchmark's stub pipeline has no transformer
+        wanted = any(preset["cache_threshold"] > 0 for preset in QUALITY_PRESETS.values())
+        residual_cache = enable_residual_cache(transformer) if transformer is not None and wanted else None
+
+    return residual_cache
+
+def get_model():
+    global model
+
+    if "model" not in globals():
+        model = load_model()
+        ready.set()
+
+    return model
+
+prompt_cache = PromptEmbeddingCache(PROMPT_CACHE_MAX_ENTRIES, PROMPT_CACHE_MAX_BYTES)
+image_cache = ConditioningImageCache(
+    IMAGE_CACHE_MAX_ENTRIES, IMAGE_CACHE_MAX_BYTES,
+    spill_dir=IMAGE_CACHE_DIR, spill_max_bytes=IMAGE_CACHE_DISK_MAX_BYTES,
+)
+fetcher = ImageFetcher(
+    FETCH_MAX_BYTES, INPUT_MAX_PIXELS, timeout=(FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT),
+    pool_size=FETCH_POOL_SIZE, cache_dir=FETCH_CACHE_DIR or None, cache_max_bytes=FETCH_CACHE_MAX_BYTES,
+)
+preview_engine = PreviewEngine(
+    LATENT_RGB_FACTORS, thumbnail_size=PREVIEW_SIZE, every_n_steps=PREVIEW_EVERY_N_STEPS,
+    min_interval=PREVIEW_MIN_INTERVAL_MS / 1000,
+)
+adapters = AdapterManager(LORA_DIR, LORA_CACHE_MAX_BYTES, max_entries=LORA_CACHE_MAX_ENTRIES)
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+# A cancelled or overdue request must not take identical requests sharing its result down with it
+coalescer = RequestCoalescer(private_errors=(JobCancelled,))
+
+def is_url(image_source):
+    return image_source.startswith(("http://", "https://"))
+
+def load_input_image(image_source, trace, revalidate=False):
+    """
+    Returns the input resized to its conditioning bucket and its original size. With `revalidate`,
+    returns None instead when the server confirms the fetcher's cached copy of a URL is current.
+    """
+    # Only the header is read here, the pixels are decoded by prepare_input_image, at reduced scale where possible
+    with trace.stage("fetch"):
+        if is_url(image_source):
+            input_image = fetcher.revalidate(image_source) if revalidate else fetcher.fetch(image_source)
+            if input_image is None:
+                return None
+        else:
+            input_image = decode_base64_to_image(image_source)
+
+    trace.current = "decode"
+    input_image, original_size, timings = prepare_input_image(input_image, INPUT_MAX_PIXELS)
+    trace.add("decode", timings["decode_ms"])
+    trace.add("resize", timings["resize_ms"])
+    trace.current = None
+
+    return input_image, original_size
+
+# Job id -> (event loop, queue) that stream_handler forwards the job's progress from
+progress_streams = {}
+
+def make_preview_target(event, output_index=None):
+    def deliver(pil_image, progress):
+        # Encode the preview image to a smaller JPEG format
+        image_base64 = encode_image_to_base64(pil_image, use_jpeg=True)
+        registry.observe("preview_bytes", "Size of base64 preview frames sent.", len(image_base64), BYTES_BUCKETS)
+
+        update = {"progress": progress, "image": image_base64}
+        if output_index is not None:
+            # Outputs of one request report separately
+            update["output_index"] = output_index
+        stream = progress_streams.get(event.get("id"))
+        if stream is not None:
+            loop, queue = stream
+            loop.call_soon_threadsafe(queue.put_nowait, update)
+        else:
+            runpod.serverless.progress_update(event, update)
+
+    return deliver
+
+def encode_condition_images(pipeline, jobs, condition_bucket):
+    """Returns the stacked VAE latents of the jobs' conditioning images, encoding only cache misses."""
+    condition_width, condition_height = condition_bucket
+    device = pipeline._execution_device
+
+    missing = {}  # pixel_hash -> jobs, outputs of one request share their conditioning image
+    for job in jobs:
+        if job.payload["image_latents"] is None:
+            # An earlier chunk of the same request may have encoded it by now
+            job.payload["image_latents"] = image_cache.get_latents(job.payload["pixel_hash"], condition_bucket)
+        if job.payload["image_latents"] is None:
+            missing.setdefault(job.payload["pixel_hash"], []).append(job)
+
+    if missing:
+        # Same resize and normalization the pipeline applies before its own VAE encode
+        pixels = pipeline.image_processor.preprocess(
+            [waiting[0].payload["image"] for waiting in missing.values()], condition_height, condition_width
+        ).to(device, pipeline.vae.dtype)
+        with torch.no_grad():
+            latents = pipeline._encode_vae_image(image=pixels, generator=None)
+
+        for index, (pixel_hash, waiting) in enumerate(missing.items()):
+            image_latents = latents[index:index + 1]
+            image_cache.put_latents(pixel_hash, condition_bucket, image_latents)
+            for job in waiting:
+                job.payload["image_latents"] = image_latents
+
+    return torch.cat([job.payload["image_latents"].to(device, pipeline.vae.dtype) for job in jobs])
+
+def decode_latents(pipeline, latents, height, width):
+    """The pipeline's own final VAE decode, run separately so it can be timed and replaced."""
+    latents = pipeline._unpack_latents(latents, height, width, pipeline.vae_scale_factor)
+    latents = (latents / pipeline.vae.config.scaling_factor) + pipeline.vae.config.shift_factor
+    with torch.no_grad():
+        images = pipeline.vae.decode(latents.to(pipeline.vae.dtype), return_dict=False)[0]
+    return pipeline.image_processor.postprocess(images, output_type="pil")
+
+def get_row_encode_executor():
+    global row_encode_executor
+
+    if "row_encode_executor" not in globals():
+        row_encode_executor = ThreadPoolExecutor(max_workers=MAX_BATCH_SIZE, thread_name_prefix="row-encode")
+
+    return row_encode_executor
+
+def decode_tiled(pipeline, latents, height, width, output_options):
+    """
+    Decodes one row of `latents` tile by tile at `output_options["scale"]`. Finished rows are encoded
+    on a row encoder thread meanwhile, the returned Future resolves to the EncodedImage.
+    """
+    scale = output_options["scale"]
+    latents = pipeline._unpack_latents(latents, height, width, pipeline.vae_scale_factor)
+    latents = (latents / pipeline.vae.config.scaling_factor) + pipeline.vae.config.shift_factor
+
+    # Tiles keep the same size in output pixels, so larger scales decode smaller latent tiles
+    tile_size = max(DECODE_TILE_MIN_LATENT, DECODE_TILE_SIZE // (pipeline.vae_scale_factor * scale))
+    decoder = TiledDecoder(
+        lambda tile: pipeline.vae.decode(tile.to(pipeline.vae.dtype), return_dict=False)[0],
+        vae_scale_factor=pipeline.vae_scale_factor, tile_size=tile_size, overlap=tile_size // 4, upscale=scale,
+    )
+    writer = make_row_writer(
+        output_options["format"], *decoder.output_size(latents),
+        quality=output_options["quality"], compress_level=output_options["compress_level"],
+    )
+    encoder = RowEncoder(writer, get_row_encode_executor(), max_pending=ENCODE_QUEUE_STRIPS)
+    try:
+        return decoder.decode_into(latents, encoder)
+    except BaseException:
+        encoder.abort()
+        raise
+
+def synchronize(device):
+    # Stage timings are only meaningful once queued GPU work has finished
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+def get_admission():
+    global admission
+
+    if "admission" not in globals():
+        # Created on first use, asking for the device's size initializes CUDA
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        budget = ADMISSION_MEMORY_BUDGET_BYTES or int(memory_total(device) * ADMISSION_MEMORY_FRACTION)
+        admission = AdmissionController(
+            device, budget, (ADMISSION_PRIOR_FIXED_BYTES, ADMISSION_PRIOR_BYTES_PER_PIXEL),
+            margin=ADMISSION_MARGIN, min_samples=ADMISSION_MIN_SAMPLES, state_path=ADMISSION_STATE_FILE,
+        )
+
+    return admission
+
+def job_pixels(bucket):
+    """What a job costs the memory model: its output pixels plus its conditioning image's."""
+    width, height, (condition_width, condition_height) = bucket[:3]
+    return width * height + condition_width * condition_height
+
+def admit_batch(bucket, jobs):
+    """Scheduler hook, how many of the bucket's oldest `jobs` fit in memory right now."""
+    admission = get_admission()
+    admitted = admission.admit(job_pixels(bucket), len(jobs))
+    decision = "admitted"
+    if admitted == 0 and not admission.fits_when_idle(job_pixels(bucket)):
+        # Waiting would not help, it fails like a missed deadline
+        decision = "rejected"
+        jobs[0].token.cancel("memory_budget")
+    elif admitted == 0:
+        # Memory held elsewhere may be released, jobs stop waiting for it after a while
+        decision = "delayed"
+        for job in jobs:
+            if (time.monotonic() - job.enqueued_at) * 1000 >= ADMISSION_MAX_DELAY_MS:
+                job.token.cancel("memory_budget")
+    registry.inc("admission_total", "Admission decisions.", decision=decision)
+    return admitted
+
+def run_batch(bucket, jobs):
+    """Runs every job in `jobs` through a single pipeline call. Called from the scheduler thread."""
+    width, height, condition_bucket, quality, adapter = bucket
+    preset = QUALITY_PRESETS[quality]
+    pipeline = get_model()
+    device = pipeline._execution_device
+    timings = {"preview": 0.0}
+    batch_pixels = job_pixels(bucket) * len(jobs)
+    # The estimate the batch was admitted on, before its own measurement updates the model
+    estimated_bytes = get_admission().model.estimate(batch_pixels) if ADMISSION_CONTROL else None
+    reset_peak_memory(device)
+    start_bytes = memory_in_use(device)
+
+    preview_session = preview_engine.session()
+    # Each row of the batch belongs to a different job, so previews are routed individually
+    preview_targets = [make_preview_target(job.payload["event"], job.payload["output_index"]) for job in jobs]
+
+    def on_step_end_callback(pipeline, step: int, timestep: int, callback_kwargs: dict):
+        total_steps = len(pipeline.scheduler.timesteps)
+        latents = callback_kwargs["latents"]
+
+        # Rows cannot leave a running batch, so it is only stopped once nobody wants any of its outputs
+        if all(job.token.is_cancelled() for job in jobs):
+            raise JobCancelled("cancelled", steps_completed=step + 1, total_steps=total_steps)
+
+        if preview_session.due(step, total_steps):
+            start = time.perf_counter()
+            unpacked_latents = pipeline._unpack_latents(latents, height, width, pipeline.vae_scale_factor)
+            preview_session.send(unpacked_latents, preview_targets, step, total_steps)
+            timings["preview"] += (time.perf_counter() - start) * 1000
+
+        return {"latents": latents}
+
+    def timed(name, fn):
+        start = time.perf_counter()
+        value = fn()
+        synchronize(device)
+        timings[name] = timings.get(name, 0) + (time.perf_counter() - start) * 1000
+        return value
+
+    compile_reports = {}
+
+    def compiled(stage, key, fn):
+        # Every bucket and batch size is a separate graph, its first call compiles or loads it
+        if compile_cache is None:
+            return fn()
+        value, report = compile_cache.run((stage, *key), fn)
+        compile_reports[stage] = report
+        if report.pop("first_call"):
+            registry.inc("compile_cache_total", "First calls per compiled shape.", stage=stage, status=report["status"])
+            registry.observe("compile_seconds", "Compile time on the first call per shape.",
+                             report["compile_ms"] / 1000, stage=stage)
+        return value
+
+    # Nothing to do when the batch uses the adapter that is already applied
+    adapter_report = adapters.activate(getattr(pipeline, "transformer", None), *(adapter or (None, None)))
+    timings["adapter_load"] = adapter_report["load_ms"]
+    timings["adapter_swap"] = adapter_report["swap_ms"]
+
+    # Repeated prompts skip the CLIP and T5 encoders entirely
+    prompt_embeds, pooled_prompt_embeds, prompt_hits = timed("text_encode", lambda: prompt_cache.encode(
+        pipeline, [job.payload["prompt"] for job in jobs]
+    ))
+    prompt_cache_stats = prompt_cache.stats()
+
+    # A tensor with latent channels is taken as already VAE-encoded by the pipeline
+    image_latents = timed("vae_encode", lambda: encode_condition_images(pipeline, jobs, condition_bucket))
+
+    # One generator per row keeps every job's noise independent of the batch it lands in
+    generators = [
+        torch.Generator(device=pipeline._execution_device).manual_seed(job.payload["seed"]) for job in jobs
+    ]
+
+    residual_cache = get_residual_cache(pipeline)
+    if residual_cache is not None:
+        residual_cache.reset(preset["cache_threshold"])
+
     try:
+        denoise_shape = (width, height, condition_bucket, len(jobs))
+        latents = timed("denoise", lambda: compiled("denoise", denoise_shape, lambda: pipeline(
+            image=image_latents,
+            prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled_prompt_embeds,
+            width=width, height=height, guidance_scale=GUIDANCE_SCALE, generator=generators,
+            num_inference_steps=preset["steps"],
+            callback_on_step_end=on_step_end_callback, callback_on_step_end_tensor_inputs=["latents"],
+            output_type="latent",
+        ).images))
+    except JobCancelled as e:
+        preview_engine.flush()
+        registry.inc("denoise_steps_saved_total", "Denoising steps skipped by cancelled jobs.",
+                     (e.total_steps - e.steps_completed) * len(jobs))
+        raise
+    # Preview callbacks run inside the denoising loop, keep the two apart
+    timings["denoise"] -= timings["preview"]
+
+    # Rows with an output_scale are decoded tile by tile here and encoded off this thread, the rest in one decode call
+    output_images = [None] * len(jobs)
+    whole = [index for index, job in enumerate(jobs) if job.payload["output"]["scale"] is None]
+    if whole:
+        whole_latents = latents if len(whole) == len(jobs) else latents[whole]
+        decoded = timed("vae_decode", lambda: compiled(
+            "vae_decode", (width, height, len(whole)), lambda: decode_latents(pipeline, whole_latents, height, width)
+        ))
+        for index, output_image in zip(whole, decoded):
+            output_images[index] = output_image
+    for index, job in enumerate(jobs):
+        if job.payload["output"]["scale"] is not None:
+            output_images[index] = timed("vae_decode_tiled", lambda: decode_tiled(
+                pipeline, latents[index:index + 1], height, width, job.payload["output"]
+            ))
+
+    # Make sure no progress update arrives after the final result
+    preview_engine.flush()
+
+    peak_memory = peak_memory_bytes(device)
+    added_bytes = max(0, peak_memory - start_bytes)
+    registry.observe("batch_peak_memory_bytes", "Peak memory allocated during a batch.", peak_memory, BYTES_BUCKETS)
+    if ADMISSION_CONTROL:
+        get_admission().record(batch_pixels, start_bytes, added_bytes)
+    registry.observe("batch_size", "Jobs per pipeline call.", len(jobs), buckets=(1, 2, 4, 8, 16))
+
+    sampling = {"quality": quality, "steps": preset["steps"], "cache_threshold": preset["cache_threshold"]}
+    if residual_cache is not None:
+        sampling.update(
+            steps_cached=residual_cache.stats["steps_cached"], blocks_skipped=residual_cache.stats["blocks_skipped"]
+        )
+        registry.inc("transformer_blocks_skipped_total", "Transformer blocks skipped by the residual cache.",
+                     residual_cache.stats["blocks_skipped"], quality=quality)
+
+    job_results = []
+    for job, output_image, prompt_hit in zip(jobs, output_images, prompt_hits):
+        # Encoding happens back on the handler side, so it does not hold up the next batch
+        job_results.append({
+            "output_image": output_image,
+            "seed": job.payload["seed"],
+            "timings": {"queue_wait": job.queue_wait_ms, **timings},
+            "metrics": {
+                "batch_size": len(jobs),
+                "sampling": sampling,
+                "adapter": adapter_report,
+                **({"compile": compile_reports} if compile_cache is not None else {}),
+                "peak_memory_bytes": peak_memory,
+                "memory": {
+                    "device": device.type,
+                    "start_bytes": start_bytes,
+                    "added_bytes": added_bytes,
+                    "estimated_added_bytes": estimated_bytes,
+                },
+                "prompt_cache": {
+                    "hit": prompt_hit,
+                    "hits": prompt_cache_stats["hits"],
+                    "misses": prompt_cache_stats["misses"],
+                },
+                "image_cache": job.payload["image_cache"],
+            },
+        })
+
+    return job_results
+
+def get_uploader():
+    global uploader
+
+    if "uploader" not in globals():
+        uploader = make_uploader(OUTPUT_BUCKET_URL, endpoint_url=S3_ENDPOINT_URL, expires_in=OUTPUT_URL_EXPIRES_IN)
+
+    return uploader
+
+def finalize_result(event, batch_result, output_options, trace, output_index=None):
+    """Encodes the generated image and returns it inline or as a URL to the uploaded object."""
+    output_image = batch_result.pop("output_image")
+    output_format = output_options["format"]
+
+    if isinstance(output_image, Future):
+        # Tiled decodes are encoded while decoding, by now the encoder is at most finishing up
+        with trace.stage("output_encode"):
+            output_image = output_image.result()
+    if isinstance(output_image, EncodedImage):
+        buffer = output_image.buffer
+    else:
+        with trace.stage("output_encode"):
+            buffer = encode_image(
+                output_image, output_format,
+                quality=output_options["quality"], compress_level=output_options["compress_level"],
+            )
+    batch_result["metrics"]["output_bytes"] = buffer.getbuffer().nbytes
+
+    job_result = {"format": output_format}
+    if output_format == "raw":
+        job_result.update({"width": output_image.width, "height": output_image.height, "mode": output_image.mode})
+
+    if output_options["delivery"] == "url":
+        name = event.get('id') or uuid.uuid4().hex
+        if output_index is not None:
+            name = f"{name}-{output_index}"
+        name = f"{name}.{FILE_EXTENSIONS[output_format]}"
+        with trace.stage("upload"):
+            job_result["image_url"] = get_uploader().upload(name, buffer, MIME_TYPES[output_format])
+    else:
+        with trace.stage("base64"):
+            job_result["image"] = buffer_to_base64(buffer)
+
+    job_result.update(batch_result)
+    return job_result
+
+def get_scheduler():
+    global scheduler
+
+    if "scheduler" not in globals():
+        scheduler = BatchScheduler(
+            run_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_BATCH_WAIT_MS,
+            # Batches for the adapter that is already applied avoid a swap
+            affinity=lambda bucket: bucket[4] == adapters.active,
+            affinity_max_wait_ms=ADAPTER_AFFINITY_MAX_WAIT_MS,
+            # Batches are cut down, or wait, to what fits in the memory budget
+            admission=admit_batch if ADMISSION_CONTROL else None,
+            admission_retry_ms=ADMISSION_RETRY_MS,
+        )
+        scheduler.start()
+
+    return scheduler
+
+def record_job(trace, job_result):
+    """Attaches the timing breakdown to the result and feeds the rolling histograms."""
+    timings = trace.summary()
+    job_result.setdefault("metrics", {})["timings"] = timings
+
+    for name, ms in timings.items():
+        registry.observe("job_stage_seconds", "Wall time per job stage.", ms / 1000, stage=name[:-len("_ms")])
+    registry.inc("jobs_total", "Jobs handled.", status="ok")
+
+    if METRICS_FILE:
+        registry.maybe_dump(METRICS_FILE, METRICS_DUMP_INTERVAL_S)
+    return job_result
+
+def record_cancellation(trace, cancelled):
+    """Reports how far a stopped job got and how much of its denoising was skipped."""
+    registry.inc("jobs_total", "Jobs handled.", status="cancelled")
+    return {
+        "error": str(cancelled),
+        "error_type": type(cancelled).__name__,
+        "stage": trace.current or "handler",
+        "cancelled": cancelled.report(),
+        "metrics": {"timings": trace.summary()},
+    }
+
+async def watch_for_cancellation(job_id, token):
+    """Cancels `token` once the RunPod API reports the job as cancelled."""
+    url = f"{RUNPOD_API_BASE.rstrip('/')}/{RUNPOD_ENDPOINT_ID}/status/{job_id}"
+    headers = {"Authorization": f"Bearer {RUNPOD_API_KEY}"}
+    while not token.is_cancelled():
+        await asyncio.sleep(CANCEL_POLL_INTERVAL_S)
+        try:
+            response = await asyncio.to_thread(fetcher.session.get, url, headers=headers, timeout=5)
+            if response.ok and response.json().get("status") == "CANCELLED":
+                token.cancel("cancelled")
+        except Exception as e:
+            print(f"Cancellation check for job {job_id} failed: {e}")
+
+def record_failure(trace, error):
+    stage = trace.current or "handler"
+    registry.inc("jobs_total", "Jobs handled.", status="error")
+    registry.inc("job_failures_total", "Failed jobs by stage and error type.", stage=stage, error=type(error).__name__)
+    return {"error": str(error), "error_type": type(error).__name__, "stage": stage}
+
+async def handler(event):
+    trace = JobTrace()
+    watcher = None
+    try:
+        trace.current = "validate"
         validated_input = validate(event["input"], schema)
         if "errors" in validated_input:
             return {"error": validated_input["errors"]}
-        
-        global model
-
-        if "model" not in globals():
-            model = load_model()
 
         validated_input = validated_input["validated_input"]
+        errors = check_constraints(validated_input)
+        if errors:
+            return {"error": errors}
+        trace.current = None
 
+        # Start the download once the input is known to be valid, it overlaps with everything up to
+        # the first use of the image. Should a later check reject the job, it is dropped again.
         image_source = validated_input["image"]
+        prefetching = is_url(image_source) and image_cache.lookup_source(image_source) is None
+        if prefetching:
+            fetcher.prefetch(image_source)
+
+        def reject(error):
+            if prefetching:
+                fetcher.cancel_prefetch(image_source)
+            return {"error": error}
+
+        # The deadline runs from when the worker picked the job up, queueing on RunPod's side is not included
+        token = CancellationToken(validated_input["deadline_ms"])
+        if CANCEL_POLL_INTERVAL_S > 0 and RUNPOD_ENDPOINT_ID and RUNPOD_API_KEY and event.get("id"):
+            watcher = asyncio.create_task(watch_for_cancellation(event["id"], token))
+
         prompt = validated_input["prompt"]
         ratio = validated_input["ratio"]
+        seed = validated_input["seed"]
+        quality = validated_input["quality"]
+        seeds = validated_input["seeds"]
+        # The scale is meaningless without an adapter and must not split batches
+        adapter = (validated_input["lora"], validated_input["lora_scale"]) if validated_input["lora"] else None
+        num_outputs = validated_input["num_outputs"]
+        output_options = {
+            "format": validated_input["output_format"],
+            "quality": validated_input["output_quality"],
+            "compress_level": validated_input["png_compress_level"],
+            "delivery": validated_input["output_delivery"],
+            "scale": validated_input["output_scale"],
+        }
+
+        if output_options["delivery"] == "url" and OUTPUT_BUCKET_URL is None:
+            return reject("output_delivery 'url' requires OUTPUT_BUCKET_URL to be configured.")
+
+        if adapter is not None:
+            try:
+                adapters.path(adapter[0])
+            except UnknownAdapter as e:
+                return reject(str(e))
+
+        # Multiple outputs are described either by explicit seeds or by a count
+        if seeds is not None:
+            if num_outputs is not None and num_outputs != len(seeds):
+                return reject(f"num_outputs is {num_outputs} but {len(seeds)} seeds were given.")
+        elif num_outputs is not None and num_outputs > 1:
+            # Consecutive seeds keep a seeded multi-output request reproducible
+            seeds = [seed + index if seed is not None else None for index in range(num_outputs)]
 
-        if image_source.startswith(("http://", "https://")):
-            input_image = load_image(image_source)
+        # A repeated input is recognized before it is downloaded or decoded. A URL can serve new
+        # content though, so its entry only stands once the server answered a revalidation with 304.
+        # Decoding and downloading are blocking, keep them off the event loop.
+        input_image = None
+        loaded = None
+        source_entry = image_cache.lookup_source(image_source)
+        if source_entry is None and is_source_ref(image_source):
+            raise SourceNotCached(f"Input {image_source} is not known to this worker, send the image itself.")
+        if source_entry is not None and is_url(image_source):
+            loaded = await asyncio.to_thread(load_input_image, image_source, trace, True)
+            if loaded is not None:
+                source_entry = None
+        if source_entry is not None:
+            pixel_hash, image_size = source_entry
         else:
-            input_image = decode_base64_to_image(image_source)
+            if loaded is None:
+                loaded = await asyncio.to_thread(load_input_image, image_source, trace)
+            input_image, image_size = loaded
+            with trace.stage("hash"):
+                pixel_hash = await asyncio.to_thread(hash_image_pixels, input_image)
+            image_cache.remember_source(image_source, pixel_hash, image_size)
 
-        input_image = input_image.convert("RGB")
-        
         try:
-            width, height = resize_to_target_area(input_image, ratio)
+            width, height = bucket_for_size(image_size, ratio)
         except ValueError as e:
             return {"error": str(e)}
-        
-        def on_step_end_callback(pipeline, step: int, timestep: int, callback_kwargs: dict):
-            # Send progress update every 5 steps
-            
-            total_steps = len(pipeline.scheduler.timesteps)
-            progress = int(((step + 1) / total_steps) * 100)
-
-            # Send progress update every 5 steps, or on the second to last step to ensure final progress is shown
-            if (step + 1) % 5 != 0 and (step + 1) < (total_steps - 1):
-                return {"latents": callback_kwargs["latents"]}
-            
-            latents = callback_kwargs["latents"]
-
-            # Unpack latents, decode, and convert to PIL
-            unpacked_latents = pipeline._unpack_latents(latents, height, width, pipeline.vae_scale_factor)  # (1, 16, 128, 128)
-            with torch.no_grad():
-                latent_rgb_factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device='cpu')
-                
-                rgb = torch.einsum("...lhw,lr -> ...rhw", unpacked_latents.cpu().float(), latent_rgb_factors)
-                rgb = (((rgb + 1) / 2).clamp(0, 1))  # Change scale from -1..1 to 0..1
-                rgb = rgb.movedim(1,-1)
-
-                image_np = (rgb[0] * 255).byte().numpy()
-                pil_image = Image.fromarray(image_np)
-                
-                # Encode the preview image to a smaller JPEG format
-                image_base64 = encode_image_to_base64(pil_image, use_jpeg=True)
-
-                runpod.serverless.progress_update(event, {
-                    "progress": progress,
-                    "image": image_base64
-                })
-
-            return {"latents": latents}
-
-        output_image = model(image=input_image, prompt=prompt, width=width, height=height, guidance_scale=2.5, callback_on_step_end=on_step_end_callback,
-    callback_on_step_end_tensor_inputs=["latents"]).images[0]
-        
-        # Convert the image to base64
-        image_base64 = encode_image_to_base64(output_image)
-
-        job_result = {
-            "image": image_base64,
-        }
 
-        return job_result
+        # The pipeline resizes the conditioning image to the bucket matching its own aspect ratio,
+        # and a batch can only stack images of one size, so that bucket is part of the key as well.
+        condition_bucket = bucket_for_size(image_size, "original")
+
+        if ADMISSION_CONTROL:
+            # A job the worker could never fit fails here, before any work is spent on it
+            trace.current = "admission"
+            try:
+                get_admission().check(job_pixels((width, height, condition_bucket)))
+            except AdmissionRejected as e:
+                registry.inc("admission_total", "Admission decisions.", decision="rejected")
+                return {
+                    **record_failure(trace, e),
+                    "estimated_bytes": e.estimated_bytes,
+                    "capacity_bytes": e.capacity_bytes,
+                }
+            trace.current = None
+
+        condition = None
+
+        async def load_condition():
+            image_latents = await asyncio.to_thread(image_cache.get_latents, pixel_hash, condition_bucket)
+            condition_image = input_image
+            if image_latents is None and condition_image is None:
+                # Known input, but its latents were evicted since
+                if is_source_ref(image_source):
+                    raise SourceNotCached(f"Input {image_source} is no longer cached on this worker, send the image itself.")
+                condition_image, _ = await asyncio.to_thread(load_input_image, image_source, trace)
+            return condition_image, image_latents
+
+        async def generate(seed, output_index):
+            nonlocal condition
+
+            # Every output conditions on the same image, it is looked up or loaded once
+            if condition is None:
+                condition = asyncio.ensure_future(load_condition())
+            condition_image, image_latents = await condition
+
+            # Quality and adapter decide how the whole batch runs, so they are part of the key too
+            future = get_scheduler().submit((width, height, condition_bucket, quality, adapter), token=token, payload={
+                "event": event,
+                "output_index": output_index,
+                "image": condition_image,
+                "image_latents": image_latents,
+                "pixel_hash": pixel_hash,
+                "prompt": prompt,
+                "output": output_options,
+                "seed": seed if seed is not None else random.randrange(2**32),
+                "image_cache": {
+                    "source_hit": source_entry is not None,
+                    "latent_hit": image_latents is not None,
+                },
+            })
+            trace.current = "generate"
+            try:
+                batch_result = await asyncio.wrap_future(future)
+            except asyncio.CancelledError:
+                # The job's task was cancelled, let the batch stop denoising on its behalf
+                token.cancel("cancelled")
+                raise
+            trace.current = None
+
+            timings = batch_result.pop("timings")
+            if output_index is None:
+                for name, ms in timings.items():
+                    trace.add(name, ms)
+                return await asyncio.to_thread(finalize_result, event, batch_result, output_options, trace)
+
+            # Outputs overlap in time, so each keeps its own timings instead of adding up in the shared trace
+            output_trace = JobTrace()
+            for name, ms in timings.items():
+                if ms is not None:
+                    output_trace.add(name, ms)
+            job_result = await asyncio.to_thread(
+                finalize_result, event, batch_result, output_options, output_trace, output_index
+            )
+            job_result["metrics"]["timings"] = {f"{name}_ms": round(ms, 1) for name, ms in output_trace.stages.items()}
+            return job_result
+
+        async def produce(seed, output_index=None):
+            # Without a seed the output is not reproducible, so there is nothing to share
+            if seed is None:
+                return await generate(None, output_index)
+
+            result_key = ResultCache.make_key(
+                pixel_hash=pixel_hash,
+                prompt=normalize_prompt(prompt),
+                bucket=[width, height],
+                seed=seed,
+                guidance_scale=GUIDANCE_SCALE,
+                sampling=QUALITY_PRESETS[quality],
+                adapter=adapter,
+                output=output_options,
+            )
+            cached_result = await asyncio.to_thread(result_cache.get, result_key)
+            if cached_result is not None:
+                cached_result["metrics"] = {"result_cache": {"hit": True}}
+                return cached_result
+
+            # An identical job already running is awaited instead of generated twice
+            job_result, coalesced = await coalescer.run(result_key, lambda: generate(seed, output_index))
+            job_result = copy.deepcopy(job_result)
+            job_result["metrics"]["result_cache"] = {"hit": False, "coalesced": coalesced}
+
+            # Presigned URLs expire, so only inline results are worth keeping
+            if not coalesced and output_options["delivery"] == "inline":
+                stored_result = {key: value for key, value in job_result.items() if key != "metrics"}
+                await asyncio.to_thread(result_cache.put, result_key, stored_result)
+
+            return job_result
+
+        if seeds is None:
+            return record_job(trace, await produce(seed))
+
+        # All outputs are queued at once, so the scheduler runs them as one batch, or in
+        # MAX_BATCH_SIZE chunks, sharing the text and image encodes
+        outputs = await asyncio.gather(
+            *(produce(output_seed, index) for index, output_seed in enumerate(seeds)), return_exceptions=True
+        )
+        for output in outputs:
+            if isinstance(output, BaseException):
+                raise output
+
+        return record_job(trace, {
+            "format": output_options["format"],
+            "num_outputs": len(outputs),
+            "seeds": [output["seed"] for output in outputs],
+            "images": outputs,
+            "metrics": {},
+        })
+    except JobCancelled as e:
+        return record_cancellation(trace, e)
     except Exception as e:
-        return {"error": str(e)}
+        return record_failure(trace, e)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+async def stream_handler(event):
+    """
+    Runs `handler`, yielding the job's progress updates as they happen and its result last,
+    for clients long-polling /stream.
+    """
+    queue = asyncio.Queue()
+    progress_streams[event["id"]] = (asyncio.get_running_loop(), queue)
+    job = asyncio.ensure_future(handler(event))
+    job.add_done_callback(lambda _: queue.put_nowait(None))
+    try:
+        while True:
+            update = await queue.get()
+            if update is None:
+                break
+            yield update
+    finally:
+        del progress_streams[event["id"]]
+        job.cancel()
+
+    result = job.result()
+    if "error" in result:
+        # RunPod keeps only the message of a streamed job that failed, so the details are streamed first
+        yield {key: value for key, value in result.items() if key != "error"}
+        yield {"error": result["error"]}
+    else:
+        yield result
+
+def concurrency_modifier(current_concurrency):
+    return MAX_CONCURRENCY if ready.is_set() else 0
 
 
-if __name__ == "__main__":   
-    runpod.serverless.start({"handler": handler})
\ No newline at end of file
+if __name__ == "__main__":
+    if METRICS_PORT:
+        registry.serve(METRICS_PORT)
+    startup()
+    if STREAM_PROGRESS:
+        # The aggregated stream is what /status returns once the job is done, the result is its last item
+        runpod.serverless.start({
+            "handler": stream_handler, "return_aggregate_stream": True, "concurrency_modifier": concurrency_modifier,
+        })
+    else:
+        runpod.serverless.start({"handler": handler, "concurrency_modifier": concurrency_modifier})
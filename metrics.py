@@ -0,0 +1,171 @@
+import bisect
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Prometheus-style cumulative bucket bounds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+BYTES_BUCKETS = tuple(2 ** exponent for exponent in range(10, 36, 2))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Histogram:
+    """
+    Cumulative bucket counts for export plus a rolling window of recent values for quantiles.
+    Observing is a lock, a bisect and two appends, cheap enough to leave on for every job.
+    """
+
+    def __init__(self, buckets, window=2048):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.total += value
+            self.count += 1
+            self.recent.append(value)
+
+    def quantiles(self, qs=(0.5, 0.95, 0.99)):
+        with self._lock:
+            values = sorted(self.recent)
+        if not values:
+            return {}
+        return {f"p{round(q * 100)}": values[min(len(values) - 1, int(q * len(values)))] for q in qs}
+
+
+class MetricsRegistry:
+    """Process-wide counters and histograms, exportable in the Prometheus text format."""
+
+    def __init__(self):
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._counters = {}  # (name, labels) -> float
+        self._help = {}
+        self._lock = threading.Lock()
+        self._last_dump = 0.0
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(buckets))
+                self._help.setdefault(name, ("histogram", help_text))
+        return histogram
+
+    def observe(self, name, help_text, value, buckets=LATENCY_BUCKETS, **labels):
+        self.histogram(name, help_text, buckets, **labels).observe(value)
+
+    def inc(self, name, help_text, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._help.setdefault(name, ("counter", help_text))
+
+    def summary(self):
+        """Rolling quantiles of every histogram, keyed by name and labels."""
+        return {
+            f"{name}{_format_labels(dict(labels))}": histogram.quantiles()
+            for (name, labels), histogram in list(self._histograms.items())
+        }
+
+    def render_prometheus(self):
+        lines = []
+        emitted = set()
+
+        for (name, labels), value in sorted(self._counters.items()):
+            if name not in emitted:
+                lines += [f"# HELP {name} {self._help[name][1]}", f"# TYPE {name} counter"]
+                emitted.add(name)
+            lines.append(f"{name}{_format_labels(dict(labels))} {value}")
+
+        for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+            if name not in emitted:
+                lines += [f"# HELP {name} {self._help[name][1]}", f"# TYPE {name} histogram"]
+                emitted.add(name)
+            labels = dict(labels)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """Atomically writes the Prometheus text export, e.g. for a node_exporter textfile collector."""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+    def maybe_dump(self, path, interval):
+        now = time.monotonic()
+        if now - self._last_dump < interval:
+            return
+        self._last_dump = now
+        self.dump(path)
+
+    def serve(self, port):
+        """Serves `/metrics` from a daemon thread."""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        return server
+
+
+class JobTrace:
+    """Wall-clock time per stage of a single job. The stage that raised stays in `current`."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = {}
+        self.current = None
+
+    @contextmanager
+    def stage(self, name):
+        self.current = name
+        start = time.perf_counter()
+        yield
+        self.add(name, (time.perf_counter() - start) * 1000)
+        self.current = None
+
+    def add(self, name, ms):
+        self.stages[name] = self.stages.get(name, 0) + ms
+
+    def summary(self):
+        timings = {f"{name}_ms": round(ms, 1) for name, ms in self.stages.items()}
+        timings["total_ms"] = round((time.perf_counter() - self.started_at) * 1000, 1)
+        return timings
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,64 @@
+import time
+
+from PIL import ExifTags, Image
+
+from utils import bucket_for_size
+
+# What undoes each EXIF orientation, as in ImageOps.exif_transpose
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+class InputTooLarge(ValueError):
+    pass
+
+
+def prepare_input_image(image, max_pixels):
+    """
+    Brings an opened (not necessarily decoded) image to the size the pipeline conditions on.
+
+    The conditioning bucket only depends on the image dimensions and EXIF orientation,
+    which are known from the header. JPEGs are then decoded directly at reduced scale with
+    `draft`, and the result is resized to the bucket so the pipeline never sees the
+    full-size original. The orientation is applied last, to the small image. Returns
+    (image, original_size, timings), the size as displayed, i.e. after orientation.
+    """
+    width, height = image.size
+    if width * height > max_pixels:
+        raise InputTooLarge(f"Input image is {width}x{height}, the limit is {max_pixels} pixels.")
+
+    transpose = ORIENTATION_TRANSPOSE.get(image.getexif().get(ExifTags.Base.Orientation))
+    # Orientations 5 to 8 turn the image on its side
+    swapped = transpose in (Image.Transpose.TRANSPOSE, Image.Transpose.ROTATE_270,
+                            Image.Transpose.TRANSVERSE, Image.Transpose.ROTATE_90)
+    original_size = (height, width) if swapped else (width, height)
+    bucket = bucket_for_size(original_size, "original")
+    if swapped:
+        # Decoded and resized as stored, turned upright at the end
+        bucket = bucket[::-1]
+    timings = {}
+
+    start = time.perf_counter()
+    # JPEG can decode at 1/2, 1/4 or 1/8 scale, never going below the requested size
+    image.draft("RGB", bucket)
+    image.load()
+    timings["decode_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    start = time.perf_counter()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.size != bucket:
+        # reducing_gap lets PIL shrink by whole factors first, which is much cheaper than a full LANCZOS pass
+        image = image.resize(bucket, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    if transpose is not None:
+        image = image.transpose(transpose)
+    timings["resize_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    return image, original_size, timings
@@ -0,0 +1,121 @@
+import queue
+import threading
+import time
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+
+class PreviewEngine:
+    """
+    Renders latent previews without holding up the denoising loop.
+
+    The RGB projection and the downsample to `thumbnail_size` (longest side, in pixels)
+    run on the latents' device. Only the small uint8 thumbnail is copied to the host,
+    and PIL conversion plus delivery happen on a background thread. When that thread
+    falls behind, new previews are dropped instead of queued.
+    """
+
+    def __init__(self, rgb_factors, thumbnail_size=128, every_n_steps=5, min_interval=0.5, max_pending=4):
+        self.rgb_factors = rgb_factors
+        self.thumbnail_size = thumbnail_size
+        self.every_n_steps = max(1, every_n_steps)
+        self.min_interval = min_interval
+
+        self._factors = {}  # (device, dtype) -> resident projection matrix
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def session(self):
+        """Returns the throttle state for a single pipeline call."""
+        return PreviewSession(self)
+
+    def _projection(self, device, dtype):
+        key = (device, dtype)
+        factors = self._factors.get(key)
+        if factors is None:
+            factors = torch.tensor(self.rgb_factors, dtype=dtype, device=device)
+            self._factors[key] = factors
+        return factors
+
+    def render(self, unpacked_latents):
+        """Projects (B, C, H, W) latents to a (B, 3, h, w) uint8 thumbnail on the latents' device."""
+        with torch.no_grad():
+            factors = self._projection(unpacked_latents.device, unpacked_latents.dtype)
+            rgb = torch.einsum("...lhw,lr -> ...rhw", unpacked_latents, factors)
+
+            height, width = rgb.shape[-2:]
+            scale = self.thumbnail_size / max(height, width) if self.thumbnail_size else 1
+            if scale < 1:
+                size = (max(1, round(height * scale)), max(1, round(width * scale)))
+                rgb = F.interpolate(rgb.float(), size=size, mode="area")
+
+            rgb = ((rgb.float() + 1) / 2).clamp(0, 1)  # Change scale from -1..1 to 0..1
+            return (rgb * 255).to(torch.uint8)
+
+    def submit(self, thumbnails, targets, progress):
+        """Hands thumbnails to the background thread. `targets[i](image, progress)` receives row i."""
+        if thumbnails.is_cuda:
+            # Copy into pinned memory asynchronously, the worker waits on the event instead of the loop
+            host = torch.empty(thumbnails.shape, dtype=thumbnails.dtype, pin_memory=True)
+            host.copy_(thumbnails, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record()
+        else:
+            host, ready = thumbnails, None
+
+        try:
+            self._queue.put_nowait((host, ready, targets, progress))
+        except queue.Full:
+            self.dropped += 1
+            return
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="preview-engine", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            host, ready, targets, progress = self._queue.get()
+            try:
+                if ready is not None:
+                    ready.synchronize()
+                for thumbnail, deliver in zip(host, targets):
+                    deliver(Image.fromarray(thumbnail.permute(1, 2, 0).numpy()), progress)
+            except Exception as e:
+                print(f"Preview delivery failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Blocks until every submitted preview has been delivered."""
+        self._queue.join()
+
+
+class PreviewSession:
+    """Decides which steps of one pipeline call get a preview."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.last_sent = None
+
+    def due(self, step, total_steps):
+        # Every n steps, or on the second to last step to ensure final progress is shown
+        is_last = (step + 1) >= (total_steps - 1)
+        if (step + 1) % self.engine.every_n_steps != 0 and not is_last:
+            return False
+        now = time.monotonic()
+        if not is_last and self.last_sent is not None and now - self.last_sent < self.engine.min_interval:
+            return False
+        self.last_sent = now
+        return True
+
+    def send(self, unpacked_latents, targets, step, total_steps):
+        progress = int(((step + 1) / total_steps) * 100)
+        self.engine.submit(self.engine.render(unpacked_latents), targets, progress)
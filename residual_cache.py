@@ -0,0 +1,142 @@
+import torch
+
+
+class ResidualCache:
+    """
+    Decides, step by step, whether the transformer blocks after the first one can be skipped.
+
+    Every step still runs the first block. When its residual differs by less than `threshold`
+    (mean absolute difference, relative) from the one seen at the last fully computed step,
+    the residual the remaining blocks produced then is added instead of running them again.
+    Comparing against the last computed step rather than the previous one keeps a run of
+    cached steps from drifting arbitrarily far. A threshold of 0 never skips, and then the
+    blocks run as if the cache were not there, without keeping any residuals.
+
+    The skip decision reads a value back from the device, so it is kept out of torch.compile
+    graphs: a compiled transformer breaks its graph there and resumes on either branch.
+    """
+
+    def __init__(self, num_blocks):
+        self.num_blocks = num_blocks
+        self.threshold = 0.0
+        self.active = False
+        self.reset()
+
+    def reset(self, threshold=None):
+        """Forgets the previous step, call before every pipeline run."""
+        if threshold is not None:
+            self.threshold = threshold
+            self.active = threshold > 0
+        self._first_residual = None
+        self._hidden_residual = None
+        self._encoder_residual = None
+        self.stats = {"steps": 0, "steps_cached": 0, "blocks_skipped": 0}
+
+    @torch.compiler.disable
+    def can_skip(self, first_residual):
+        self.stats["steps"] += 1
+        previous = self._first_residual
+        if not self.threshold or previous is None or previous.shape != first_residual.shape:
+            return False
+        change = (first_residual - previous).abs().mean() / previous.abs().mean().clamp_min(1e-8)
+        if change.item() >= self.threshold:
+            return False
+        self.stats["steps_cached"] += 1
+        self.stats["blocks_skipped"] += self.num_blocks - 1
+        return True
+
+    def apply(self, hidden_states, encoder_hidden_states):
+        return hidden_states + self._hidden_residual, encoder_hidden_states + self._encoder_residual
+
+    def store(self, first_residual, hidden_residual, encoder_residual):
+        self._first_residual = first_residual
+        self._hidden_residual = hidden_residual
+        self._encoder_residual = encoder_residual
+
+
+class CachedTransformerBlocks(torch.nn.Module):
+    """
+    Stands in for a Flux transformer's whole block stack behind the first-block cache.
+
+    Blocks follow the diffusers calling convention, taking keyword arguments and returning
+    (encoder_hidden_states, hidden_states). Nunchaku packs every layer into one module; it
+    is driven through `forward_layer_at(0, ...)` for the first layer and
+    `skip_first_layer=True` for the rest, calling the forward it had before the cache
+    took it over.
+    """
+
+    def __init__(self, blocks, cache):
+        super().__init__()
+        self.blocks = torch.nn.ModuleList(blocks)
+        self.cache = cache
+        self.packed = len(self.blocks) == 1 and hasattr(self.blocks[0], "forward_layer_at")
+        self._packed_forward = self.blocks[0].forward if self.packed else None
+
+    def _run_first(self, **kwargs):
+        if self.packed:
+            return self.blocks[0].forward_layer_at(0, **kwargs)
+        return self.blocks[0](**kwargs)
+
+    def _run_all(self, **kwargs):
+        if self.packed:
+            return self._packed_forward(**kwargs)
+        return self._run_rest(**kwargs, first=0)
+
+    def _run_rest(self, first=1, **kwargs):
+        if self.packed:
+            return self._packed_forward(skip_first_layer=True, **kwargs)
+        encoder_hidden_states, hidden_states = kwargs.pop("encoder_hidden_states"), kwargs.pop("hidden_states")
+        for block in self.blocks[first:]:
+            encoder_hidden_states, hidden_states = block(
+                hidden_states=hidden_states, encoder_hidden_states=encoder_hidden_states, **kwargs
+            )
+        return encoder_hidden_states, hidden_states
+
+    def forward(self, hidden_states, encoder_hidden_states, **kwargs):
+        if not self.cache.active:
+            return self._run_all(hidden_states=hidden_states, encoder_hidden_states=encoder_hidden_states, **kwargs)
+
+        original_hidden_states = hidden_states
+        encoder_hidden_states, hidden_states = self._run_first(
+            hidden_states=hidden_states, encoder_hidden_states=encoder_hidden_states, **kwargs
+        )
+
+        first_residual = hidden_states - original_hidden_states
+        if self.cache.can_skip(first_residual):
+            hidden_states, encoder_hidden_states = self.cache.apply(hidden_states, encoder_hidden_states)
+            return encoder_hidden_states, hidden_states
+
+        first_hidden_states, first_encoder_hidden_states = hidden_states, encoder_hidden_states
+        encoder_hidden_states, hidden_states = self._run_rest(
+            hidden_states=hidden_states, encoder_hidden_states=encoder_hidden_states, **kwargs
+        )
+        self.cache.store(
+            first_residual, hidden_states - first_hidden_states, encoder_hidden_states - first_encoder_hidden_states
+        )
+        return encoder_hidden_states, hidden_states
+
+
+def enable_residual_cache(transformer):
+    """
+    Routes the transformer's blocks through a first-block cache and returns the cache.
+
+    The double and single stream blocks are folded into one stack that sits in
+    `transformer_blocks`, so the transformer's own forward keeps working unchanged. A
+    Nunchaku packed stack stays where it is and only its forward is routed through the
+    cache, because Nunchaku's LoRA methods expect `transformer_blocks[0]` to be that module.
+    """
+    blocks = list(transformer.transformer_blocks) + list(transformer.single_transformer_blocks)
+    config = getattr(transformer, "config", None)
+    num_blocks = len(blocks)
+    if config is not None and len(blocks) == 1:
+        # A packed stack counts as all the layers it runs
+        num_blocks = config.num_layers + config.num_single_layers
+
+    cache = ResidualCache(num_blocks)
+    cached = CachedTransformerBlocks(blocks, cache)
+    if cached.packed:
+        blocks[0].forward = cached.forward
+        return cache
+    transformer.transformer_blocks = torch.nn.ModuleList([cached])
+    transformer.single_transformer_blocks = torch.nn.ModuleList()
+    return cache
@@ -0,0 +1,256 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, InvalidStateError
+
+
+def settle(future, result=None, exception=None):
+    """Resolves `future`, unless its waiter gave up on it first, e.g. a cancelled asyncio task cancels it."""
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class JobCancelled(Exception):
+    """Raised for a job that was cancelled or ran past its deadline before it finished denoising."""
+
+    def __init__(self, reason, steps_completed=0, total_steps=None):
+        super().__init__(f"Job stopped early: {reason}")
+        self.reason = reason
+        self.steps_completed = steps_completed
+        self.total_steps = total_steps
+
+    def report(self):
+        """How far the job got, and the share of its denoising steps that never ran."""
+        if not self.total_steps:
+            return {"reason": self.reason, "steps_completed": self.steps_completed, "compute_saved": 1.0}
+        return {
+            "reason": self.reason,
+            "steps_completed": self.steps_completed,
+            "total_steps": self.total_steps,
+            "compute_saved": round(1 - self.steps_completed / self.total_steps, 3),
+        }
+
+
+class CancellationToken:
+    """Set by whoever wants a job stopped, polled by the code doing the work. Also trips on an optional deadline."""
+
+    def __init__(self, deadline_ms=None):
+        self.deadline = None if deadline_ms is None else time.monotonic() + deadline_ms / 1000
+        self._reason = None
+
+    def cancel(self, reason="cancelled"):
+        if self._reason is None:
+            self._reason = reason
+
+    @property
+    def reason(self):
+        if self._reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self._reason = "deadline_exceeded"
+        return self._reason
+
+    def is_cancelled(self):
+        return self.reason is not None
+
+
+class Job:
+    """A single pending request waiting to be merged into a batch."""
+
+    def __init__(self, bucket, payload, token=None):
+        self.bucket = bucket
+        self.payload = payload
+        self.token = token or CancellationToken()
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+
+    @property
+    def queue_wait_ms(self):
+        if self.started_at is None:
+            return None
+        return (self.started_at - self.enqueued_at) * 1000
+
+
+class BatchScheduler:
+    """
+    Groups pending jobs by bucket and runs each group as one batched call.
+
+    `run_batch(bucket, jobs)` is called from the scheduler thread and must return
+    one result per job, in order. A batch is dispatched as soon as a bucket holds
+    `max_batch_size` jobs, or once its oldest job has waited `max_wait_ms`. Jobs whose
+    token is cancelled by then are failed with `JobCancelled` instead of being run.
+
+    When several buckets are due, those for which `affinity(bucket)` is true go first,
+    e.g. the ones that need no model state change, unless some due job has already
+    waited `affinity_max_wait_ms`.
+
+    `admission(bucket, jobs)`, when given, returns how many of the oldest `jobs` of the
+    chosen bucket may run now. Jobs whose tokens it cancelled are failed with `JobCancelled`.
+    A bucket it refuses without cancelling anything is passed over for the other due buckets,
+    and once all of them were refused they are looked at again after `admission_retry_ms`.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait_ms=50, affinity=None, affinity_max_wait_ms=2000,
+                 admission=None, admission_retry_ms=100):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.affinity = affinity
+        self.affinity_max_wait = max(0, affinity_max_wait_ms) / 1000
+        self.admission = admission
+        self.admission_retry = max(1, admission_retry_ms) / 1000
+
+        self._queues = OrderedDict()  # bucket -> deque[Job]
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+        self.stats = {"batches": 0, "jobs": 0, "largest_batch": 0}
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops accepting work, drains what is already queued and joins the thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        self._thread = None
+
+    def submit(self, bucket, payload, token=None):
+        """Queues a job and returns a Future that resolves to its result."""
+        job = Job(bucket, payload, token)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Scheduler is stopped.")
+            self._queues.setdefault(bucket, deque()).append(job)
+            self._cond.notify()
+        return job.future
+
+    def pending(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _pick_bucket(self, now, refused=()):
+        """Returns (bucket, seconds_to_wait), leaving out the `refused` buckets. A wait of 0 means dispatch now."""
+        oldest_bucket, oldest_time = None, None
+        due = []  # (bucket, seconds its oldest job has waited)
+        for bucket, queue in self._queues.items():
+            if bucket in refused:
+                continue
+            waited = now - queue[0].enqueued_at
+            if len(queue) >= self.max_batch_size or waited >= self.max_wait or self._stopped:
+                due.append((bucket, waited))
+            if oldest_time is None or queue[0].enqueued_at < oldest_time:
+                oldest_bucket, oldest_time = bucket, queue[0].enqueued_at
+
+        if oldest_bucket is None:
+            return None, None
+        if not due:
+            return oldest_bucket, max(0, self.max_wait - (now - oldest_time))
+
+        if self.affinity is not None and all(waited < self.affinity_max_wait for _, waited in due):
+            for bucket, _ in due:
+                if self.affinity(bucket):
+                    return bucket, 0
+        for bucket, _ in due:
+            if len(self._queues[bucket]) >= self.max_batch_size:
+                return bucket, 0
+        return max(due, key=lambda item: item[1])[0], 0
+
+    def _next_batch(self):
+        with self._cond:
+            refused = set()
+            while True:
+                bucket, wait = self._pick_bucket(time.monotonic(), refused)
+                if refused and (bucket is None or wait > 0):
+                    # No due bucket is admitted right now
+                    self._cond.wait(self.admission_retry if bucket is None else min(wait, self.admission_retry))
+                    refused.clear()
+                    continue
+                if bucket is None:
+                    if self._stopped:
+                        return None
+                    self._cond.wait()
+                    continue
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                queue = self._queues[bucket]
+                size = min(self.max_batch_size, len(queue))
+                if self.admission is not None and not self._stopped:
+                    size = min(size, self.admission(bucket, [queue[index] for index in range(size)]))
+                    if size == 0:
+                        if not self._drop_cancelled(bucket):
+                            refused.add(bucket)
+                        continue
+
+                jobs = [queue.popleft() for _ in range(size)]
+                if not queue:
+                    del self._queues[bucket]
+                return bucket, jobs
+
+    def _drop_cancelled(self, bucket):
+        """Fails the bucket's cancelled jobs without running them. Returns whether there were any."""
+        queue = self._queues[bucket]
+        cancelled = [job for job in queue if job.token.is_cancelled()]
+        for job in cancelled:
+            queue.remove(job)
+            settle(job.future, exception=JobCancelled(job.token.reason))
+        if not queue:
+            del self._queues[bucket]
+        return bool(cancelled)
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            bucket, jobs = batch
+
+            for job in jobs:
+                if job.token.is_cancelled():
+                    settle(job.future, exception=JobCancelled(job.token.reason))
+            jobs = [job for job in jobs if not job.future.done()]
+            if not jobs:
+                continue
+
+            started_at = time.monotonic()
+            for job in jobs:
+                job.started_at = started_at
+
+            self.stats["batches"] += 1
+            self.stats["jobs"] += len(jobs)
+            self.stats["largest_batch"] = max(self.stats["largest_batch"], len(jobs))
+
+            try:
+                results = self.run_batch(bucket, jobs)
+            except JobCancelled as e:
+                # Only raised once every job in the batch was cancelled, each keeps its own reason
+                for job in jobs:
+                    settle(job.future, exception=JobCancelled(job.token.reason, e.steps_completed, e.total_steps))
+                continue
+            except Exception as e:
+                for job in jobs:
+                    settle(job.future, exception=e)
+                continue
+
+            # Nothing a single job's result does may take the scheduler thread down with it
+            for job, result in zip(jobs, results):
+                try:
+                    settle(job.future, result)
+                except Exception as e:
+                    print(f"Delivering a result from bucket {bucket} failed: {e}")
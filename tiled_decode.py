@@ -0,0 +1,110 @@
+import torch
+import torch.nn.functional as F
+
+
+def tile_starts(length, tile, overlap):
+    """Offsets of `tile` sized windows covering `length`, neighbours sharing at least `overlap`."""
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    # The last window is pulled back to end at the border rather than shrunk, so tiles keep one shape
+    return starts + [length - tile]
+
+
+def blend_ramp(size, lead, trail):
+    """Weights along one side of a tile, rising over the `lead` values shared with the previous
+    tile and falling over the `trail` values shared with the next one."""
+    weights = torch.ones(size)
+    if lead:
+        weights[:lead] = torch.arange(1, lead + 1) / (lead + 1)
+    if trail:
+        weights[size - trail:] = torch.minimum(weights[size - trail:], torch.arange(trail, 0, -1) / (trail + 1))
+    return weights
+
+
+def ramps(starts, tile, factor):
+    """Blend weights in output pixels for every tile along one axis."""
+    weights = []
+    for index, start in enumerate(starts):
+        lead = (starts[index - 1] + tile - start) * factor if index > 0 else 0
+        trail = (start + tile - starts[index + 1]) * factor if index + 1 < len(starts) else 0
+        weights.append(blend_ramp(tile * factor, lead, trail))
+    return weights
+
+
+class TiledDecoder:
+    """
+    Decodes latents tile by tile and hands out finished rows of 8-bit pixels, top to bottom.
+
+    `decode` maps a (1, C, h, w) latent tile to (1, 3, h * vae_scale_factor, w * vae_scale_factor)
+    pixels in [-1, 1], as `AutoencoderKL.decode` does. Each tile is optionally upscaled by the
+    integer `upscale` right after decoding, moved to host memory and added into a strip one tile
+    row high with linear ramps over the overlaps, which hides the seams. Rows are handed out as
+    soon as no later tile touches them, so device memory is set by the tile size alone and host
+    memory by one strip of the output's width; the full image never exists as floats.
+    """
+
+    def __init__(self, decode, vae_scale_factor=8, tile_size=64, overlap=16, upscale=1):
+        if not 0 <= overlap < tile_size:
+            raise ValueError(f"Tile overlap must be smaller than the tile size, got {overlap} and {tile_size}.")
+        self.decode = decode
+        self.vae_scale_factor = vae_scale_factor
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.upscale = upscale
+
+    def output_size(self, latents):
+        """(width, height) of the image `decode_rows(latents)` produces."""
+        factor = self.vae_scale_factor * self.upscale
+        return latents.shape[-1] * factor, latents.shape[-2] * factor
+
+    def _decode_tile(self, tile):
+        with torch.no_grad():
+            pixels = self.decode(tile)
+            if self.upscale > 1:
+                pixels = F.interpolate(pixels.float(), scale_factor=self.upscale, mode="bicubic", align_corners=False)
+        return pixels[0].float().cpu()
+
+    def decode_rows(self, latents):
+        """Yields uint8 arrays of shape (rows, width, 3) for a single image's (1, C, h, w) latents."""
+        _, _, height, width = latents.shape
+        factor = self.vae_scale_factor * self.upscale
+        output_width = width * factor
+        tile_height, tile_width = min(self.tile_size, height), min(self.tile_size, width)
+
+        rows = tile_starts(height, tile_height, self.overlap)
+        columns = tile_starts(width, tile_width, self.overlap)
+        row_ramps = ramps(rows, tile_height, factor)
+        column_ramps = ramps(columns, tile_width, factor)
+
+        # Weighted sums and weights of one tile row, its first row is the output row of the current tiles' top
+        strip_height = tile_height * factor
+        strip = torch.zeros(3, strip_height, output_width)
+        strip_weights = torch.zeros(1, strip_height, output_width)
+        for row_index, y in enumerate(rows):
+            for column_index, x in enumerate(columns):
+                pixels = self._decode_tile(latents[:, :, y:y + tile_height, x:x + tile_width])
+                weights = row_ramps[row_index][:, None] * column_ramps[column_index][None, :]
+                x0, x1 = x * factor, (x + tile_width) * factor
+                strip[:, :, x0:x1] += pixels * weights
+                strip_weights[:, :, x0:x1] += weights
+
+            # Everything above the next tile row is final
+            done = (rows[row_index + 1] - y) * factor if row_index + 1 < len(rows) else strip_height
+            finished = strip[:, :done].div(strip_weights[:, :done])
+            # Same mapping as the pipeline's postprocess to PIL
+            finished.div_(2).add_(0.5).clamp_(0, 1).mul_(255).round_()
+            yield finished.to(torch.uint8).permute(1, 2, 0).numpy()
+
+            # The overlap with the next tile row moves up, the strip is reused rather than reallocated
+            remaining = strip_height - done
+            strip[:, :remaining] = strip[:, done:].clone()
+            strip_weights[:, :remaining] = strip_weights[:, done:].clone()
+            strip[:, remaining:] = 0
+            strip_weights[:, remaining:] = 0
+
+    def decode_into(self, latents, writer):
+        """Streams the decoded rows of `latents` into a row writer from `encoders.make_row_writer`."""
+        for rows in self.decode_rows(latents):
+            writer.write(rows)
+        return writer.finish()
@@ -42,8 +42,14 @@ PREFERED_KONTEXT_RESOLUTIONS = [
 ]
 
 def resize_to_target_area(image, ratio):
+    return bucket_for_size(image.size, ratio)
+
+def bucket_for_size(image_size, ratio):
+    """
+    Same as `resize_to_target_area`, but only needs the (width, height) of the image.
+    """
     if ratio == "original":
-        original_width, original_height = image.size
+        original_width, original_height = image_size
         if original_height == 0:
             raise ValueError("Original image height cannot be zero.")
         target_aspect_ratio = original_width / original_height